@@ -0,0 +1,527 @@
+#! /usr/bin/python
+"""End-to-end benchmark of iam_logger using simulated EnviR base units.
+
+Each simulated unit is a pseudo-terminal (pty) pair.  A thread writes
+Current Cost <msg> lines to the master side at a configurable rate
+(including histogram bursts and malformed XML) and iam_logger.py is run
+in a subprocess with the slave sides listed as its serial ports.
+
+Every real-time message carries, as its watts, the time it was sent (in
+milliseconds, modulo 100000) so the end-to-end lag between a message
+being sent and its sample appearing in a channel file can be measured.
+Transmitters are given distinct radio IDs and each one sends at most once
+per second, so no samples are discarded as same-second duplicates.
+
+Results are appended to a JSON-lines file so runs can be compared:
+
+    ./benchmark.py --units 2 --transmitters 50 --rate 40 --duration 30
+    ./benchmark.py --compare
+
+To see how --engine processes scales, offer more messages than one core
+can handle and give a list of worker counts:
+
+    ./benchmark.py --engine processes --workers 1,2,4 --units 8 \
+        --transmitters 400 --rate 400
+
+The main process's own CPU time (excluding its workers) is reported too:
+with --engine processes it is the part of the work which can't be
+spread over more cores, so 1E6 / main_cpu_us_per_message bounds the
+messages per second any number of workers can reach.
+
+"""
+
+from __future__ import print_function, division
+import argparse
+import errno
+import fcntl
+import json
+import multiprocessing
+import os
+import random
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+IAM_LOGGER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'iam_logger.py')
+
+HIST_LINE = ('<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>{}</time>'
+             '<hist><dsw>00032</dsw><type>1</type><units>kwhr</units>'
+             + '<data><sensor>{}</sensor>'
+             + ''.join('<h{:03d}>001.1</h{:03d}>'.format(h, h)
+                       for h in range(2, 26, 2))
+             + '</data></hist></msg>\r\n')
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class FakeEnviR(threading.Thread):
+    """A simulated EnviR base unit attached to a pty.
+
+    Attributes:
+
+        port (str): the slave device to give to iam_logger, e.g. /dev/pts/3
+
+        transmitters (list): (radio_id, sensor, n_channels) for each
+            transmitter this unit hears.
+
+        sent (dict): number of lines sent, keyed by 'realtime', 'hist'
+            and 'malformed'.
+
+        writes (int): number of write syscalls made to the pty.
+
+    """
+
+    def __init__(self, number, transmitters, rate, hist_every, malformed):
+        """
+        Args:
+            number (int): this unit's number (used in its name).
+
+            transmitters (list): (radio_id, sensor, n_channels) tuples.
+
+            rate (float): real-time messages per second.
+
+            hist_every (float): seconds between histogram bursts (0 = never).
+
+            malformed (float): probability of sending a malformed line.
+        """
+
+        threading.Thread.__init__(self, name='fake_envir_{}'.format(number))
+        self.daemon = True
+        self.transmitters = transmitters
+        self.rate = rate
+        self.hist_every = hist_every
+        self.malformed = malformed
+        self.sent = {'realtime': 0, 'hist': 0, 'malformed': 0}
+        self.writes = 0
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd) # no echo or line discipline
+        flags = fcntl.fcntl(self.master_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.port = os.ttyname(self.slave_fd)
+        self._stop_event = threading.Event()
+
+    def message(self, radio_id, sensor, n_channels, now):
+        watts = int(now * 1000) % 100000
+        channels = ''.join('<ch{0}><watts>{1:05d}</watts></ch{0}>'
+                           .format(chan, watts)
+                           for chan in range(1, n_channels + 1))
+        return ('<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>{}</time>'
+                '<tmpr>18.7</tmpr><sensor>{}</sensor><id>{:05d}</id>'
+                '<type>1</type>{}</msg>\r\n'
+                .format(time.strftime('%H:%M:%S', time.localtime(now)),
+                        sensor, radio_id, channels))
+
+    def _write(self, line):
+        """Write line to the pty, waiting while the pty buffer is full."""
+
+        while line and not self._stop_event.is_set():
+            try:
+                written = os.write(self.master_fd, line)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    self._stop_event.set() # the pty has gone away
+                    return
+                select.select([], [self.master_fd], [], 0.1)
+            else:
+                line = line[written:]
+            self.writes += 1
+
+    def run(self):
+        period = 1 / self.rate
+        next_send = time.time()
+        next_hist = next_send + self.hist_every
+        i = 0
+        while not self._stop_event.is_set():
+            now = time.time()
+            if now < next_send:
+                time.sleep(next_send - now)
+                continue
+            next_send += period
+
+            if self.hist_every and now >= next_hist:
+                next_hist += self.hist_every
+                for sensor in range(10):
+                    self._write(HIST_LINE.format(time.strftime('%H:%M:%S'),
+                                                 sensor))
+                    self.sent['hist'] += 1
+
+            if random.random() < self.malformed:
+                self._write('<msg><src>CC128-v0.11</src><dsb>000\r\n')
+                self.sent['malformed'] += 1
+                continue
+
+            radio_id, sensor, n_channels = \
+                self.transmitters[i % len(self.transmitters)]
+            i += 1
+            self._write(self.message(radio_id, sensor, n_channels, time.time()))
+            self.sent['realtime'] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+class LagWatcher(threading.Thread):
+    """Tails every channel file and measures end-to-end lag.
+
+    Attributes:
+        samples (int): number of samples seen on disk.
+
+        lags (list): seconds between each sample being sent and being
+            seen on disk.
+    """
+
+    def __init__(self, directory, poll=0.05):
+        threading.Thread.__init__(self, name='lag_watcher')
+        self.daemon = True
+        self.directory = directory
+        self.poll = poll
+        self.samples = 0
+        self.lags = []
+        self._offsets = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.scan()
+            time.sleep(self.poll)
+
+    def scan(self):
+        for name in os.listdir(self.directory):
+            if not (name.startswith('channel_') and name.endswith('.dat')):
+                continue
+            filename = os.path.join(self.directory, name)
+            offset = self._offsets.get(filename, 0)
+            with open(filename, 'rb') as fh:
+                fh.seek(offset)
+                data = fh.read()
+            # Stamped after the read, not before the scan, or samples
+            # written while many files are scanned show a negative lag
+            now_ms = int(time.time() * 1000)
+            end = data.rfind('\n') + 1
+            self._offsets[filename] = offset + end
+            for line in data[:end].splitlines():
+                fields = line.split()
+                if len(fields) != 2:
+                    continue
+                self.samples += 1
+                lag_ms = (now_ms - int(fields[1])) % 100000
+                self.lags.append(lag_ms / 1000)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.scan()
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def read_proc_io(pid):
+    """Return /proc/<pid>/io as a dict, or None if it can't be read."""
+    try:
+        with open('/proc/{}/io'.format(pid)) as fh:
+            return dict((key, int(value)) for key, value in
+                        (line.split(':') for line in fh))
+    except (IOError, OSError):
+        return None
+
+
+def read_proc_cpu(pid):
+    """Return CPU seconds used by pid itself (not its children), or None."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fh:
+            fields = fh.read().rpartition(')')[2].split()
+    except (IOError, OSError):
+        return None
+    # utime and stime are fields 14 and 15 of stat(5), in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def poll_exit(pid):
+    """Reap pid if it has exited.
+
+    Returns:
+        None if pid is still running, otherwise (exit status, rusage).
+    """
+    reaped_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+    if reaped_pid == 0:
+        return None
+    return status, rusage
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(IAM_LOGGER),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    """Run one benchmark.  Returns a dict of results."""
+
+    if args.rate > args.transmitters:
+        sys.exit("--rate must not exceed --transmitters, otherwise "
+                 "transmitters send more than once a second.")
+
+    workdir = tempfile.mkdtemp(prefix='iam_benchmark_')
+    datadir = os.path.join(workdir, 'data')
+    os.mkdir(datadir)
+
+    units = []
+    radio_ids = []
+    for unit in range(args.units):
+        transmitters = []
+        for i in range(args.transmitters):
+            radio_id = unit * args.transmitters + i + 1
+            n_channels = (i % args.channels) + 1
+            transmitters.append((radio_id, (i % 9) + 1, n_channels))
+            radio_ids.extend((radio_id, chan) for chan in range(1, n_channels+1))
+        units.append(FakeEnviR(unit, transmitters, args.rate,
+                               args.hist_every, args.malformed))
+
+    with open(os.path.join(workdir, 'config.xml'), 'w') as fh:
+        fh.write('<config>\n<directory>{}</directory>\n'.format(datadir))
+        for unit in units:
+            fh.write('<serialport>{}</serialport>\n'.format(unit.port))
+        for element in args.config:
+            key, dummy, value = element.partition('=')
+            fh.write('<{0}>{1}</{0}>\n'.format(key, value))
+        fh.write('</config>\n')
+
+    with open(os.path.join(workdir, 'radioIDs.dat'), 'w') as fh:
+        for channel, (radio_id, chan) in enumerate(radio_ids, 1):
+            fh.write('{} tx{}_{} {}/{}\n'.format(channel, radio_id, chan,
+                                                 radio_id, chan))
+
+    for unit in units:
+        unit.start()
+
+    watcher = LagWatcher(datadir)
+    devnull = open(os.devnull, 'w')
+    command = [sys.executable, IAM_LOGGER, '--no_display', '--log', 'WARNING',
+               '--engine', args.engine]
+    if args.workers is not None:
+        command += ['--workers', str(args.workers)]
+    process = subprocess.Popen(command,
+                               cwd=workdir,
+                               stdout=devnull, stderr=subprocess.STDOUT)
+    start = time.time()
+    watcher.start()
+
+    last_io = None
+    main_cpu = None
+    exited = None # (status, rusage) once the logger has exited
+    while time.time() - start < args.duration:
+        time.sleep(0.2)
+        last_io = read_proc_io(process.pid) or last_io
+        main_cpu = read_proc_cpu(process.pid) or main_cpu
+        exited = poll_exit(process.pid)
+        if exited is not None:
+            break
+
+    duration = time.time() - start
+    sent = dict((key, sum(unit.sent[key] for unit in units))
+                for key in units[0].sent)
+    if exited is None:
+        process.send_signal(signal.SIGTERM)
+    while exited is None: # keep sampling /proc until it exits
+        last_io = read_proc_io(process.pid) or last_io
+        main_cpu = read_proc_cpu(process.pid) or main_cpu
+        time.sleep(0.05)
+        exited = poll_exit(process.pid)
+    status, rusage = exited
+    for unit in units:
+        unit.stop()
+    watcher.stop()
+
+    samples_per_message = (sum(n for r, s, n in units[0].transmitters) /
+                           len(units[0].transmitters))
+    messages_logged = watcher.samples / samples_per_message
+    lags = watcher.lags
+
+    results = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'label': args.label,
+        'params': {'units': args.units, 'transmitters': args.transmitters,
+                   'channels': args.channels, 'rate': args.rate,
+                   'duration': args.duration, 'hist_every': args.hist_every,
+                   'malformed': args.malformed, 'config': args.config,
+                   'engine': args.engine, 'workers': args.workers},
+        'sent': sent,
+        'samples_on_disk': watcher.samples,
+        'messages_per_sec': messages_logged / duration,
+        'write_syscalls': last_io['syscw'] if last_io else None,
+        'lag_p50': percentile(lags, 0.5),
+        'lag_p95': percentile(lags, 0.95),
+        'lag_max': max(lags) if lags else float('nan'),
+        'exit_status': status,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'main_cpu_seconds': main_cpu,
+        'cpus': multiprocessing.cpu_count(),
+    }
+    if messages_logged:
+        results['cpu_us_per_message'] = (results['cpu_seconds'] /
+                                         messages_logged * 1E6)
+        if main_cpu is not None:
+            results['main_cpu_us_per_message'] = (main_cpu /
+                                                  messages_logged * 1E6)
+        if last_io:
+            results['write_syscalls_per_message'] = (last_io['syscw'] /
+                                                     messages_logged)
+
+    if args.keep:
+        results['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir)
+    return results
+
+
+def print_results(results):
+    print("{} messages/sec logged ({} samples on disk)"
+          .format(int(results['messages_per_sec']), results['samples_on_disk']))
+    print("sent: {}".format(results['sent']))
+    print("CPU: {:.2f}s total, {:.1f} us/message"
+          .format(results['cpu_seconds'],
+                  results.get('cpu_us_per_message', float('nan'))))
+    print("main process CPU (excluding workers): {:.1f} us/message"
+          .format(results.get('main_cpu_us_per_message', float('nan'))))
+    print("write syscalls: {} ({:.3f}/message)"
+          .format(results['write_syscalls'],
+                  results.get('write_syscalls_per_message', float('nan'))))
+    print("lag (s): p50={:.3f} p95={:.3f} max={:.3f}"
+          .format(results['lag_p50'], results['lag_p95'], results['lag_max']))
+
+
+def print_sweep(runs):
+    """Print a table of throughput against the number of workers."""
+
+    fmt = '{:>7} {:>10} {:>10} {:>15} {:>5}'
+    print(fmt.format('WORKERS', 'MSGS/SEC', 'CPU_US/MSG', 'MAIN_CPU_US/MSG',
+                     'CPUS'))
+    for results in runs:
+        print(fmt.format(results['params']['workers'],
+                         '{:.1f}'.format(results['messages_per_sec']),
+                         '{:.1f}'.format(results.get('cpu_us_per_message',
+                                                     float('nan'))),
+                         '{:.1f}'.format(results.get('main_cpu_us_per_message',
+                                                     float('nan'))),
+                         results['cpus']))
+    most_workers = max(results['params']['workers'] for results in runs)
+    if runs[0]['cpus'] < most_workers:
+        print("Only {} CPUs: throughput can't rise beyond {} workers."
+              .format(runs[0]['cpus'], runs[0]['cpus']))
+
+
+def compare(filename):
+    """Print a table of every run stored in filename."""
+
+    fmt = '{:>19} {:>9} {:>12} {:>10} {:>10} {:>10} {:>8}  {}'
+    print(fmt.format('TIME', 'REVISION', 'MSGS/SEC', 'CPU_US/MSG',
+                     'WRITES/MSG', 'LAG_P95', 'RATE', 'LABEL'))
+    with open(filename) as fh:
+        for line in fh:
+            run = json.loads(line)
+            print(fmt.format(run['time'], run['revision'],
+                             '{:.1f}'.format(run['messages_per_sec']),
+                             '{:.1f}'.format(run.get('cpu_us_per_message',
+                                                     float('nan'))),
+                             '{:.3f}'.format(run.get('write_syscalls_per_message',
+                                                     float('nan'))),
+                             '{:.3f}'.format(run['lag_p95']),
+                             run['params']['rate'] * run['params']['units'],
+                             run['label'] or ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of '
+                                     'iam_logger with simulated EnviR units.')
+    parser.add_argument('--units', type=int, default=2,
+                        help='number of simulated base units (default: 2)')
+    parser.add_argument('--transmitters', type=int, default=20,
+                        help='transmitters per unit (default: 20)')
+    parser.add_argument('--channels', type=int, default=3, choices=[1, 2, 3],
+                        help='transmitters have between 1 and this many '
+                        'channels (default: 3)')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='real-time messages per second per unit. Must '
+                        'not exceed --transmitters (default: 10)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for (default: 30)')
+    parser.add_argument('--hist_every', type=float, default=10,
+                        help='seconds between histogram bursts. 0 = never '
+                        '(default: 10)')
+    parser.add_argument('--malformed', type=float, default=0.01,
+                        help='probability of a malformed line (default: 0.01)')
+    parser.add_argument('--config', action='append', default=[],
+                        metavar='KEY=VALUE', help='extra config.xml element, '
+                        'e.g. --config flush_interval=1. May be repeated.')
+    parser.add_argument('--engine', choices=['threads', 'select', 'processes'],
+                        default='threads', help='iam_logger --engine to '
+                        'benchmark (default: threads)')
+    parser.add_argument('--workers', default=None,
+                        help='iam_logger --workers, for --engine processes. '
+                        'A comma-separated list (e.g. 1,2,4) runs the '
+                        'benchmark for each and prints throughput against '
+                        'workers (default: iam_logger\'s default)')
+    parser.add_argument('--label', default=None,
+                        help='label stored with the results')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file to append results to '
+                        '(default: benchmark_results.jsonl)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary working directory')
+    parser.add_argument('--compare', action='store_true',
+                        help='print previous results and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+        return
+
+    if args.workers is None:
+        sweep = [None]
+    else:
+        sweep = [int(workers) for workers in args.workers.split(',')]
+
+    runs = []
+    for workers in sweep:
+        args.workers = workers
+        if len(sweep) > 1:
+            print("\n--workers {}".format(workers))
+        results = run_benchmark(args)
+        print_results(results)
+        with open(args.results, 'a') as fh:
+            fh.write(json.dumps(results, sort_keys=True) + '\n')
+        runs.append(results)
+
+    if len(runs) > 1:
+        print()
+        print_sweep(runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#! /usr/bin/python
+"""Micro-benchmark comparing cc_parser's fast path with ElementTree.
+
+Usage:
+    ./benchmark_parser.py [CAPTURE_FILE] [--repeat N]
+
+CAPTURE_FILE is any file containing Current Cost XML lines, for example
+the output of "iam_logger.py --print_xml".  Lines which don't start with
+<msg> are ignored.  If no file is given then lines are built from
+currentCostTest.XML plus a histogram message.
+
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import re
+import timeit
+import xml.etree.ElementTree as ET
+import cc_parser
+
+SAMPLE_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'currentCostTest.XML')
+
+# The keys CurrentCost.update() asks for
+KEYS = ['id', 'sensor', 'ch1/watts', 'ch2/watts', 'ch3/watts']
+
+HIST_LINE = ('<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:10:50</time>'
+             '<hist><dsw>00032</dsw><type>1</type><units>kwhr</units>'
+             '<data><sensor>0</sensor><h024>001.1</h024><h022>000.9</h022>'
+             '<h020>000.3</h020><h018>000.4</h018></data>'
+             '<data><sensor>1</sensor><h024>000.0</h024><h022>000.0</h022>'
+             '<h020>000.0</h020><h018>000.0</h018></data></hist></msg>')
+
+
+def load_lines(filename):
+    with open(filename) as fh:
+        return [line for line in fh if line.startswith('<msg>')]
+
+
+def sample_lines():
+    """Build single-line messages from currentCostTest.XML."""
+    with open(SAMPLE_XML) as fh:
+        xml = fh.read()
+    xml = re.sub(r'<!--.*?-->', '', xml)
+    msg = re.sub(r'>\s+<', '><', xml.strip()) + '\r\n'
+    iam = msg.replace('<sensor>1</sensor>', '<sensor>2</sensor>')
+    iam = re.sub(r'<ch2>.*</ch3>', '', iam)
+    return [msg, iam] * 9 + [HIST_LINE + '\r\n', msg]
+
+
+def parse_etree_old(line):
+    """What CurrentCost.read_xml used to do for every line."""
+    tree = ET.XML(line)
+    if tree.findtext('hist') is not None:
+        return None
+    return dict((key, tree.findtext(key)) for key in KEYS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Current Cost '
+                                     'XML parsers.')
+    parser.add_argument('capture', nargs='?', default=None,
+                        help='file of recorded XML lines')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='number of passes over the lines (default: 200)')
+    args = parser.parse_args()
+
+    if args.capture:
+        lines = load_lines(args.capture)
+    else:
+        lines = sample_lines()
+
+    # Check both parsers agree before timing them
+    for line in lines:
+        if cc_parser.parse(line, KEYS) != parse_etree_old(line):
+            print("MISMATCH:", line)
+
+    parsers = [('ElementTree', parse_etree_old),
+               ('cc_parser.parse', lambda line: cc_parser.parse(line, KEYS))]
+
+    n_lines = len(lines) * args.repeat
+    print("{} lines x {} repeats".format(len(lines), args.repeat))
+    results = {}
+    for name, func in parsers:
+        def run():
+            for line in lines:
+                func(line)
+        seconds = min(timeit.repeat(run, number=args.repeat, repeat=3))
+        results[name] = seconds
+        print("{:>16}: {:8.2f} us/line {:10.0f} lines/sec"
+              .format(name, seconds / n_lines * 1E6, n_lines / seconds))
+
+    print("Speedup: {:.1f}x".format(results['ElementTree'] /
+                                    results['cc_parser.parse']))
+
+
+if __name__ == "__main__":
+    main()
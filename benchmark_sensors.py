@@ -0,0 +1,147 @@
+#! /usr/bin/python
+"""Memory and allocation benchmark for the per-sample Sensor update path.
+
+Creates hundreds of sensors, each heard by two simulated base units, and
+pushes already-parsed messages through CurrentCost.process() (parsing
+and disk I/O are benchmarked elsewhere, so samples go to a writer which
+discards them).  Reports:
+
+    - bytes per Sensor (Sensor, TimeInfo and locations dict)
+    - growth in the number of GC-tracked objects after many samples
+    - function calls and string formats made per sample
+    - time per sample
+
+Usage:
+    ./benchmark_sensors.py [--sensors N] [--rounds N]
+
+"""
+
+from __future__ import print_function, division
+import argparse
+import collections
+import gc
+import resource
+import sys
+import time
+import iam_logger
+
+
+class NullWriter(object):
+    """Stands in for storage.WriterThread and discards every sample."""
+
+    def put(self, chan, timecode, watts):
+        pass
+
+
+class Clock(object):
+    """Virtual clock which advances one second per round."""
+
+    def __init__(self):
+        self.now = 1360000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_messages(n_sensors, current_costs):
+    """Return a list of (current_cost, data) for one round of samples."""
+
+    messages = []
+    for i in range(n_sensors):
+        data = {'id': str(1000 + i), 'sensor': str(i % 10),
+                'ch1/watts': str(100 + i), 'ch2/watts': None,
+                'ch3/watts': None}
+        for current_cost in current_costs:
+            messages.append((current_cost, data))
+    return messages
+
+
+def run_round(messages, clock):
+    clock.now += 1
+    for current_cost, data in messages:
+        current_cost.process(data)
+
+
+def count_calls(messages, clock):
+    """Return a Counter of the calls made during one round."""
+
+    calls = collections.Counter()
+
+    def profiler(frame, event, arg):
+        if event == 'call':
+            calls[frame.f_code.co_name] += 1
+        elif event == 'c_call':
+            calls[arg.__name__] += 1
+
+    sys.setprofile(profiler)
+    try:
+        run_round(messages, clock)
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+def object_bytes(obj):
+    """Size of obj including its __dict__ (if it has one)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def sensor_bytes(sensor):
+    return (object_bytes(sensor) + object_bytes(sensor.time_info) +
+            sys.getsizeof(sensor.locations))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark memory use and '
+                                     'allocations of Sensor updates.')
+    parser.add_argument('--sensors', type=int, default=500,
+                        help='number of sensors (default: 500)')
+    parser.add_argument('--rounds', type=int, default=200,
+                        help='number of samples per sensor (default: 200)')
+    args = parser.parse_args()
+
+    clock = Clock()
+    iam_logger._clock = clock
+    iam_logger._writer = NullWriter()
+    current_costs = [iam_logger.ReplayCurrentCost('bench_a'),
+                     iam_logger.ReplayCurrentCost('bench_b')]
+    messages = make_messages(args.sensors, current_costs)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run_round(messages, clock) # create every Sensor and Location
+    sensors = iam_logger.CurrentCost.sensors.values()
+    print("{} sensors, {} samples per round".format(len(sensors),
+                                                    len(messages)))
+    print("bytes per sensor: {:.0f}".format(
+          sum(sensor_bytes(sensor) for sensor in sensors) / len(sensors)))
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    start = time.time()
+    for i in xrange(args.rounds):
+        run_round(messages, clock)
+    elapsed = time.time() - start
+    gc.collect()
+    objects_after = len(gc.get_objects())
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    n_samples = len(messages) * args.rounds
+    print("GC-tracked objects: {} -> {} after {} samples"
+          .format(objects_before, objects_after, n_samples))
+    print("max RSS: {} KB -> {} KB".format(rss_before, rss_after))
+
+    calls = count_calls(messages, clock)
+    n_calls = sum(calls.itervalues())
+    print("calls per sample: {:.1f} (string formats: {:.2f})"
+          .format(n_calls / len(messages),
+                  (calls['format'] + calls['__str__']) / len(messages)))
+    for name, count in calls.most_common():
+        print("    {:>24}: {:.2f}".format(name, count / len(messages)))
+    print("{:.2f} us per sample".format(elapsed / n_samples * 1E6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Fast parsing of the XML lines produced by Current Cost CC128 / EnviR units.
+
+Every line from the Current Cost is a single <msg> element with a fixed,
+flat schema (see currentCostTest.XML and currentcost.com/cc128/xml.htm).
+Building a full ElementTree for every line and walking it once per field
+is wasteful, so parse() pulls the fields straight out of the string with
+a single regular expression pass and only falls back to ElementTree
+if the line doesn't look like a well-formed <msg>.
+
+Histogram messages (which contain <hist>) are detected before any
+parsing is done.  parse_hist() extracts their contents, again in a single
+regular expression pass.
+
+"""
+
+from __future__ import print_function, division
+import re
+import xml.etree.ElementTree as ET
+
+#==============================================================================
+# CONSTANTS
+#==============================================================================
+
+# Fields which the fast path understands.  Keys are the same paths
+# which would be passed to ElementTree's findtext().
+FAST_KEYS = frozenset(['src', 'dsb', 'time', 'tmpr', 'tmprF', 'sensor', 'id',
+                       'type', 'ch1/watts', 'ch2/watts', 'ch3/watts'])
+
+_FIELD_RE = re.compile(r'<(src|dsb|time|tmprF|tmpr|sensor|id|type)>([^<]*)</\1>'
+                       r'|<ch([1-3])>\s*<watts>([^<]*)</watts>\s*</ch\3>')
+
+# Fields present in every real-time <msg>.  If any are missing then the
+# line is probably corrupt so let ElementTree have a look at it.
+_REQUIRED_KEYS = ('src', 'dsb', 'time', 'sensor', 'id', 'type')
+
+# In a <hist> message: the message time, each <data> block's <sensor>
+# and the kWh for each period, e.g. <h024>001.3</h024> or <d001>...
+_HIST_RE = re.compile(r'<(time|sensor)>([^<]*)</\1>'
+                      r'|<([hdm])(\d{3})>([^<]*)</\3\4>')
+
+_MSG_START = '<msg>'
+_MSG_END = '</msg>'
+_HIST_TAG = '<hist>'
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class FastParseError(ValueError):
+    """Raised by parse_fast() when a line is not a simple <msg>."""
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def is_hist(line):
+    """Return True if line is a histogram message."""
+    return _HIST_TAG in line
+
+
+def parse_fast(line):
+    """Extract the fields of a real-time <msg> line without building a tree.
+
+    Args:
+        line (str): a single line of XML from the Current Cost.
+
+    Returns:
+        dict mapping each field found (e.g. 'id', 'ch1/watts') to its text.
+
+    Raises:
+        FastParseError: if line does not look like a single, complete
+            real-time <msg> element.
+    """
+
+    line = line.strip()
+    if not (line.startswith(_MSG_START) and line.endswith(_MSG_END)):
+        raise FastParseError('not a single <msg> element')
+
+    fields = {}
+    for match in _FIELD_RE.finditer(line):
+        tag, text, sens_chan, watts = match.groups()
+        if tag is None:
+            fields['ch' + sens_chan + '/watts'] = watts
+        else:
+            fields[tag] = text
+
+    for key in _REQUIRED_KEYS:
+        if key not in fields:
+            raise FastParseError('missing <{}>'.format(key))
+
+    return fields
+
+
+def parse_etree(line, keys):
+    """Extract keys from line using ElementTree.  The slow but general path.
+
+    Raises:
+        ET.ParseError: if line is malformed XML.
+    """
+
+    tree = ET.XML(line)
+    fields = {}
+    for key in keys:
+        fields[key] = tree.findtext(key)
+    return fields
+
+
+def parse(line, keys):
+    """Extract keys from a line of Current Cost XML.
+
+    Uses parse_fast() when every key is one it understands and the line
+    is a well-formed <msg>; otherwise falls back to parse_etree().
+
+    Args:
+        line (str): a single line of XML from the Current Cost.
+
+        keys (iterable): ElementTree paths to extract, e.g. 'ch1/watts'.
+
+    Returns:
+        None if line is a histogram message.  Otherwise a dict mapping
+        each of keys to its text, or to None if it is absent.
+
+    Raises:
+        ET.ParseError: if line is malformed XML.
+    """
+
+    if is_hist(line):
+        return None
+
+    if FAST_KEYS.issuperset(keys):
+        try:
+            fields = parse_fast(line)
+        except FastParseError:
+            pass
+        else:
+            return dict((key, fields.get(key)) for key in keys)
+
+    return parse_etree(line, keys)
+
+
+def parse_hist(line):
+    """Extract the history from a <hist> message.
+
+    Args:
+        line (str): a single line of XML containing <hist>.
+
+    Returns:
+        (time, periods).  time is the message's <time> text (or None).
+        periods is a list of (sensor, kind, ago, kwh) tuples in the order
+        they appear, where sensor is the Current Cost <sensor> number
+        (int), kind is 'h' (two hour blocks), 'd' (days) or 'm' (months),
+        ago (int) is the number in the tag (e.g. 24 for <h024>) and kwh
+        (float) is the energy used.
+
+    Raises:
+        ValueError: if a value can't be parsed.
+    """
+
+    device_time = None
+    sensor = None
+    periods = []
+    for match in _HIST_RE.finditer(line):
+        tag, text, kind, ago, kwh = match.groups()
+        if tag == 'time':
+            device_time = text
+        elif tag == 'sensor':
+            sensor = int(text)
+        elif sensor is not None:
+            periods.append((sensor, kind, int(ago), float(kwh)))
+    return device_time, periods
@@ -0,0 +1,367 @@
+"""Read channel data files written by iam_logger into NumPy arrays.
+
+Channel files are memory-mapped and, because timecodes are written in
+increasing order, a time range can be found with a binary search so only
+the requested window is ever parsed.  For example:
+
+    import channel_reader
+    timecodes, watts = channel_reader.read_channel('/data/', 99,
+                                                   start=1360000000,
+                                                   end=1360086400)
+
+    for chan, label, timecodes, watts in channel_reader.iter_channels('/data/'):
+        ...
+
+Both the text (channel_N.dat) and binary (channel_N.bin) formats written
+by the storage module are supported.  If a text file has a channel_N.idx
+time index sidecar then it is used to narrow the binary search down to
+a single block.
+
+If the channel files are rotated then read_channel() and stream_channel()
+read every segment (plain or gzipped) which overlaps the time range, in
+order.  Compressed segments are decompressed into memory one at a time.
+
+"""
+
+from __future__ import print_function, division
+import mmap
+import os
+import numpy as np
+import storage
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class TextChannelReader(object):
+    """Memory-mapped reader for "<unixtime> <watts>" channel_N.dat files.
+
+    Attributes:
+        filename (str)
+
+        index (storage.TimeIndex): the file's time index, or None if
+            the file has no (valid) index.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, 'rb')
+        self._size = os.fstat(self._fh.fileno()).st_size
+        if self._size == 0: # mmap can't map an empty file
+            self._mm = ''
+        else:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            # Ignore an incomplete last line (e.g. one still being written)
+            self._size = self._mm.rfind('\n') + 1
+
+        try:
+            self.index = storage.TimeIndex.load(
+                                    storage.TimeIndex.filename_for(filename))
+        except (IOError, storage.StorageError):
+            self.index = None
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def offset_of(self, timecode, lo=0, hi=None):
+        """Binary search for the first line with a timecode >= timecode.
+
+        Args:
+            timecode (int): unix timecode.
+
+        Kwargs:
+            lo, hi (int): byte offsets of line starts bounding the search.
+                hi may be the file size.  If neither is given and the
+                file has a time index then the index provides them.
+
+        Returns:
+            byte offset of the start of that line, or the file size if
+            every line is earlier than timecode.
+        """
+
+        if lo == 0 and hi is None and self.index is not None:
+            lo, hi = self.index.bounds(timecode, self._size)
+        elif hi is None:
+            hi = self._size
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._line_start_after(mid)
+            if start >= hi:
+                # No line starts in [mid, hi) so step through from lo
+                if self._timecode_at(lo) >= timecode:
+                    return lo
+                lo = self._line_start_after(lo + 1)
+            elif self._timecode_at(start) >= timecode:
+                hi = start
+            else:
+                lo = self._line_start_after(start + 1)
+
+        return lo
+
+    def read(self, start=None, end=None):
+        """Return samples with start <= timecode < end.
+
+        Kwargs:
+            start, end (int): unix timecodes.  None means unbounded.
+
+        Returns:
+            (timecodes, watts) as int64 NumPy arrays.
+        """
+
+        begin = 0 if start is None else self.offset_of(start)
+        if end is None:
+            finish = self._size
+        elif self.index is None:
+            finish = self.offset_of(end, lo=begin)
+        else:
+            finish = max(begin, self.offset_of(end))
+        return parse_text(self._mm[begin:finish])
+
+    def _line_start_after(self, pos):
+        """Return the offset of the first line starting at or after pos."""
+        if pos <= 0:
+            return 0
+        newline = self._mm.find('\n', pos - 1)
+        if newline == -1:
+            return self._size
+        return newline + 1
+
+    def _timecode_at(self, pos):
+        return int(self._mm[pos:self._mm.find(' ', pos)])
+
+
+class BinaryChannelReader(object):
+    """Reader for channel_N.bin files written by storage.BinaryBackend.
+
+    Attributes:
+        filename (str)
+
+        records (numpy.memmap): every record in the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = storage.load_binary(filename)
+
+    def close(self):
+        del self.records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, start=None, end=None):
+        """Return samples with start <= timecode < end.
+
+        Kwargs:
+            start, end (int): unix timecodes.  None means unbounded.
+
+        Returns:
+            (timecodes, watts) as int64 NumPy arrays.
+        """
+
+        timecodes = self.records['timecode']
+        begin = 0 if start is None else np.searchsorted(timecodes, start)
+        finish = (len(timecodes) if end is None
+                  else np.searchsorted(timecodes, end))
+        window = self.records[begin:finish]
+        return (window['timecode'].astype(np.int64),
+                window['watts'].astype(np.int64))
+
+
+class CompressedChannelReader(object):
+    """Reader for gzipped segments (channel_N.<segment>.dat.gz or .bin.gz).
+
+    The whole segment is decompressed when the reader is created.
+
+    Attributes:
+        filename (str)
+
+        timecodes, watts (numpy.ndarray): every sample in the segment.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        data = storage.read_compressed(filename)
+        if filename.endswith(storage.BinaryBackend.EXTENSION +
+                             storage.COMPRESSED_EXTENSION):
+            storage.check_binary_header(data, filename)
+            record_size = storage.BinaryBackend.RECORD.size
+            body = data[storage.BinaryBackend.HEADER.size:]
+            records = np.frombuffer(body[:len(body) - len(body) % record_size],
+                                    dtype=storage.BinaryBackend.DTYPE)
+            self.timecodes = records['timecode'].astype(np.int64)
+            self.watts = records['watts'].astype(np.int64)
+        else:
+            self.timecodes, self.watts = parse_text(data[:data.rfind('\n') + 1])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, start=None, end=None):
+        """Return samples with start <= timecode < end.
+
+        Kwargs:
+            start, end (int): unix timecodes.  None means unbounded.
+
+        Returns:
+            (timecodes, watts) as int64 NumPy arrays.
+        """
+
+        begin = 0 if start is None else np.searchsorted(self.timecodes, start)
+        finish = (len(self.timecodes) if end is None
+                  else np.searchsorted(self.timecodes, end))
+        return self.timecodes[begin:finish], self.watts[begin:finish]
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def parse_text(data):
+    """Parse "<unixtime> <watts>" lines into (timecodes, watts) arrays."""
+
+    values = np.fromstring(data, dtype=np.int64, sep=' ')
+    if len(values) % 2:
+        raise ValueError("channel data does not have two columns")
+    values = values.reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+
+def open_channel(filename):
+    """Return a TextChannelReader, BinaryChannelReader or
+    CompressedChannelReader for filename."""
+
+    if filename.endswith(storage.COMPRESSED_EXTENSION):
+        return CompressedChannelReader(filename)
+    if filename.endswith(storage.BinaryBackend.EXTENSION):
+        return BinaryChannelReader(filename)
+    return TextChannelReader(filename)
+
+
+def channel_filename(directory, chan):
+    """Return the data file for chan in directory (.bin is preferred).
+
+    Raises:
+        IOError: if there is no data file for chan.
+    """
+
+    for backend in (storage.BinaryBackend, storage.TextBackend):
+        filename = os.path.join(directory,
+                                'channel_{}{}'.format(chan, backend.EXTENSION))
+        if os.path.exists(filename):
+            return filename
+    raise IOError("No data file found for channel {} in {}"
+                  .format(chan, directory))
+
+
+def channel_filenames(directory, chan):
+    """Return every data file (segment) for chan in directory, oldest first.
+
+    .bin files are preferred over .dat files.
+
+    Raises:
+        IOError: if there is no data file for chan.
+    """
+
+    for backend in (storage.BinaryBackend, storage.TextBackend):
+        filenames = storage.list_segments(directory,
+                                          backend.EXTENSION).get(str(chan))
+        if filenames:
+            return filenames
+    raise IOError("No data file found for channel {} in {}"
+                  .format(chan, directory))
+
+
+def stream_channel(directory, chan, start=None, end=None):
+    """Read chan one segment at a time.
+
+    Segments outside [start, end) aren't opened.  Samples which are not
+    later than the previous segment's last sample are dropped (they can
+    only be duplicates left by a crash during compression).
+
+    Yields:
+        (timecodes, watts) for start <= timecode < end, for each segment
+        which has samples in that range.
+    """
+
+    last = None
+    for filename in channel_filenames(directory, chan):
+        segment = storage.parse_channel_filename(os.path.basename(filename))[1]
+        segment_start, segment_end = storage.segment_bounds(segment)
+        if segment_start is not None and (
+                (end is not None and segment_start >= end) or
+                (start is not None and segment_end <= start)):
+            continue
+        with open_channel(filename) as reader:
+            timecodes, watts = reader.read(start, end)
+        if last is not None and len(timecodes) and timecodes[0] <= last:
+            later = timecodes > last
+            timecodes, watts = timecodes[later], watts[later]
+        if len(timecodes):
+            last = timecodes[-1]
+            yield timecodes, watts
+
+
+def read_channel(directory, chan, start=None, end=None):
+    """Return (timecodes, watts) for start <= timecode < end."""
+
+    chunks = list(stream_channel(directory, chan, start, end))
+    if len(chunks) == 1:
+        return chunks[0]
+    if not chunks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return (np.concatenate([timecodes for timecodes, _ in chunks]),
+            np.concatenate([watts for _, watts in chunks]))
+
+
+def load_labels(directory):
+    """Load labels.dat.
+
+    Returns:
+        list of (channel, label) tuples in the order they appear in the file.
+    """
+
+    labels = []
+    with open(os.path.join(directory, 'labels.dat')) as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) == 2:
+                labels.append((fields[0], fields[1]))
+    return labels
+
+
+def iter_channels(directory, start=None, end=None):
+    """Iterate over every channel listed in labels.dat.
+
+    Channels without a data file are skipped.
+
+    Yields:
+        (channel, label, timecodes, watts)
+    """
+
+    for chan, label in load_labels(directory):
+        try:
+            timecodes, watts = read_channel(directory, chan, start, end)
+        except IOError:
+            continue
+        yield chan, label, timecodes, watts
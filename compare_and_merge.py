@@ -5,24 +5,9 @@ from matplotlib import pyplot as plt
 import pandas
 
 """
-TODO: Take a look at TimeSeries.combine using a function something like this:
-
-rng = pandas.date_range('1/1/2011', periods=10, freq='H')
-rng2 = pandas.date_range('1/1/2011 05:00:00', periods=10, freq='H')
-ts1 = pandas.Series(2*(len(rng)), index=rng)
-ts2 = pandas.Series(2*(len(rng)), index=rng2)
-
-def comparison(a,b):
-    if numpy.isnan(a):
-        return b
-    elif numpy.isnan(b):
-        return a
-    elif a==b:
-        return a
-    else:
-        raise Exception("oops. a={}, b={}".format(a,b))
-
-ts2.combine(ts1, f)
+To merge channel files recorded by several loggers (deduplicating and
+resolving conflicting readings) use merge_channels.py, which replaces the
+element-by-element TimeSeries.combine approach that used to be sketched here.
 """
 
 filename = '/home/jack/workingcopies/domesticPowerData/BellendenRd/version2/channel_99.dat'
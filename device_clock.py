@@ -0,0 +1,135 @@
+"""Timestamp samples using the Current Cost's own clock.
+
+Every real-time <msg> carries the time of day on the Current Cost's
+clock (<time>HH:MM:SS</time>).  When the host is busy, lines queue up in
+the serial buffer and are then read in a burst, so stamping them with
+the host's clock squashes several readings into the same second.
+
+DeviceClock tracks the offset between the device clock and the host
+clock.  A line can only ever be read after it was sent, so the smallest
+(host time - device time) seen over the last few minutes is taken as
+the offset, and each message is stamped with device time + offset.
+Lines read promptly get (within a second) the host time; lines read
+late get the time they were actually sent.
+
+The device clock only gives the time of day.  Each <time> is placed on
+the day which puts it closest to the host's expectation, so midnight
+and device clocks in other time zones are handled.  If the device clock
+is changed, the offset is re-learnt straight away.
+
+"""
+
+from __future__ import print_function, division
+import collections
+import logging
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class DeviceClock(object):
+    """Converts one Current Cost's <time> values to host unix times.
+
+    Attributes:
+
+        samples (int): number of messages timestamped.
+
+        corrected (int): number of messages whose timestamp was moved
+            back by more than tolerance seconds (i.e. messages which
+            were read late).
+
+        invalid (int): number of messages with an unreadable <time>.
+            These are stamped with the host time.
+
+        resets (int): number of times the offset was re-learnt because
+            the device clock appeared to have been changed.
+
+    """
+
+    def __init__(self, window=600, tolerance=2, max_delay=300):
+        """
+        Kwargs:
+            window (float): seconds over which the minimum offset is
+                taken.  Allows the offset to follow clock drift.
+
+            tolerance (float): messages stamped more than this many
+                seconds before the host time count as corrected.
+
+            max_delay (float): a message apparently read more than this
+                many seconds late is taken to mean that the device clock
+                has been set back, and the offset is re-learnt.
+        """
+
+        self.window = window
+        self.tolerance = tolerance
+        self.max_delay = max_delay
+        self.samples = 0
+        self.corrected = 0
+        self.invalid = 0
+        self.resets = 0
+        # (host time, host - device) with increasing offsets, so the
+        # minimum over the window is at the left.
+        self._offsets = collections.deque()
+
+    @property
+    def offset(self):
+        """Seconds to add to device time to get host time (or None)."""
+        return self._offsets[0][1] if self._offsets else None
+
+    def timestamp(self, device_time, host_time):
+        """Return the unix time at which a message was sent.
+
+        Args:
+            device_time (str): the message's <time>, e.g. '13:10:50'.
+            host_time (float): unix time at which the message was read.
+        """
+
+        try:
+            hours, minutes, seconds = device_time.split(':')
+            seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        except (AttributeError, ValueError):
+            self.invalid += 1
+            return host_time
+        if not 0 <= seconds < SECONDS_PER_DAY:
+            self.invalid += 1
+            return host_time
+
+        offsets = self._offsets
+        if offsets:
+            # Choose the day which puts the device time nearest to where
+            # the current offset says it should be
+            expected = host_time - offsets[0][1]
+            seconds += (round((expected - seconds) / SECONDS_PER_DAY) *
+                        SECONDS_PER_DAY)
+
+        difference = host_time - seconds
+        while offsets and offsets[-1][1] >= difference:
+            offsets.pop()
+        offsets.append((host_time, difference))
+        while offsets[0][0] < host_time - self.window:
+            offsets.popleft()
+
+        delay = difference - offsets[0][1]
+        if delay > self.max_delay:
+            logging.warning("DEVICECLOCK: message apparently {:.0f}s late. "
+                            "Assuming the device clock changed."
+                            .format(delay))
+            self.resets += 1
+            offsets.clear()
+            offsets.append((host_time, difference))
+            delay = 0
+
+        self.samples += 1
+        if delay > self.tolerance:
+            self.corrected += 1
+        return host_time - delay
+
+    def __str__(self):
+        offset = self.offset
+        return ('offset={} corrected={}/{} invalid={} resets={}'
+                .format('-' if offset is None else '{:.1f}s'.format(offset),
+                        self.corrected, self.samples, self.invalid,
+                        self.resets))
@@ -0,0 +1,357 @@
+"""Capture the history stored by Current Cost units to backfill gaps.
+
+Every few hours each Current Cost sends a burst of <hist> messages giving
+the kWh used by each of its <sensor>s in recent two hour blocks (<hNNN>),
+days (<dNNN>) and months (<mNNN>).  iam_logger used to discard these.
+
+When enabled, the reader threads hand each <hist> line (with the time it
+was read) to a HistoryIngester thread, so parsing never slows down the
+real-time path.  The ingester:
+
+1. parses the line with cc_parser.parse_hist(),
+2. places each two hour block and day on the unix time-line using the
+   message's <time> (block boundaries are on the Current Cost's clock).
+   With device timestamps the time the message was sent (its <time>
+   plus the DeviceClock's offset) is used, as for real-time samples,
+   rather than the time it was read,
+3. maps the Current Cost <sensor> number to the single Sensor last heard
+   on it (blocks for <sensor>s with several sensors, e.g. a three-phase
+   clamp, are only counted as unmatched),
+4. stores new blocks in a HistoryStore: one small text file per channel,
+   <directory>/history/channel_N.dat, of "<start> <seconds> <Wh>" lines,
+5. merges each new block into the rollups, but only into rollup buckets
+   which lie wholly inside the block, for which no row has been written
+   and which are before the bucket the RollupStage has open.  Backfilled
+   rows have a count of 0 and the block's mean power as their mean, min
+   and max, and are written to the rollups' backfill files (see
+   rollup.read_rows).
+
+Month totals are parsed but not stored.
+
+"""
+
+from __future__ import print_function, division
+import collections
+import logging
+import os
+import Queue
+import threading
+import cc_parser
+
+SECONDS_PER_DAY = 24 * 60 * 60
+BLOCK_SECONDS = {'h': 2 * 60 * 60, 'd': SECONDS_PER_DAY}
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class HistoryStore(object):
+    """Energy used by each channel in blocks of time, saved to disk.
+
+    Only used by the HistoryIngester thread, so not thread safe.
+
+    Attributes:
+
+        directory (str): where the channel_N.dat history files live.
+
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): the data directory.  History is kept in its
+                'history' sub-directory.
+        """
+
+        self.directory = os.path.join(directory, 'history', '')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._blocks = {} # chan -> {(start, seconds): Wh}
+
+    def filename(self, chan):
+        return self.directory + 'channel_' + str(chan) + '.dat'
+
+    def blocks(self, chan):
+        """Return {(start, seconds): Wh} for chan, loading it if needed."""
+
+        blocks = self._blocks.get(chan)
+        if blocks is not None:
+            return blocks
+
+        blocks = {}
+        try:
+            with open(self.filename(chan)) as fh:
+                for line in fh:
+                    try:
+                        start, seconds, watt_hours = line.split()
+                        blocks[(int(start), int(seconds))] = int(watt_hours)
+                    except ValueError:
+                        pass # torn last line
+        except IOError:
+            pass
+        self._blocks[chan] = blocks
+        return blocks
+
+    def add(self, chan, new_blocks):
+        """Store blocks which haven't been seen before.
+
+        Args:
+            new_blocks (list): (start, seconds, Wh) tuples.
+
+        Returns:
+            list of the (start, seconds, Wh) tuples which were new.
+        """
+
+        blocks = self.blocks(chan)
+        added = []
+        for start, seconds, watt_hours in new_blocks:
+            if (start, seconds) not in blocks:
+                blocks[(start, seconds)] = watt_hours
+                added.append((start, seconds, watt_hours))
+        if added:
+            with open(self.filename(chan), 'a') as fh:
+                fh.write(''.join('{:d} {:d} {:d}\n'.format(*block)
+                                 for block in added))
+        return added
+
+
+class HistoryIngester(threading.Thread):
+    """Thread which parses <hist> lines, stores and merges their blocks.
+
+    Attributes:
+
+        messages (int): <hist> messages parsed.
+
+        blocks (int): new blocks stored.
+
+        backfilled (int): rollup rows written from history.
+
+        unmatched (int): blocks for a <sensor> which couldn't be mapped to
+            exactly one Sensor.
+
+        errors (int): messages which couldn't be parsed.
+
+        dropped (int): messages discarded because the queue was full.
+
+    """
+
+    _STOP = None
+
+    def __init__(self, store, sensors, rollups=None, max_queue_size=1000):
+        """
+        Args:
+            store (HistoryStore)
+
+            sensors (callable): returns a list of every Sensor (e.g.
+                CurrentCost.sensors.values).
+
+        Kwargs:
+            rollups (rollup.RollupStage): rollups to backfill, or None.
+
+            max_queue_size (int): <hist> lines waiting to be parsed.
+        """
+
+        threading.Thread.__init__(self, name="history")
+        self.daemon = True
+        self.store = store
+        self.sensors = sensors
+        self.rollups = rollups
+        self.messages = 0
+        self.blocks = 0
+        self.backfilled = 0
+        self.unmatched = 0
+        self.errors = 0
+        self.dropped = 0
+        self._queue = Queue.Queue(max(1, max_queue_size))
+        # (pool directory, chan) -> (bytes of rollup file read, bucket starts)
+        self._rollup_rows = {}
+
+    def put(self, line, host_time, current_cost, clock_offset=None):
+        """Queue a <hist> line.  Called from reader threads; never blocks.
+
+        Args:
+            line (str)
+            host_time (float): unix time the line was read.
+            current_cost (CurrentCost): the unit which sent it.
+
+        Kwargs:
+            clock_offset (float): the unit's DeviceClock offset when the
+                line was read, or None to place blocks by host time.
+        """
+
+        try:
+            self._queue.put_nowait((line, host_time, current_cost,
+                                    clock_offset))
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is HistoryIngester._STOP:
+                break
+            try:
+                self.ingest(*item)
+            except (ValueError, IOError, OSError), e:
+                self.errors += 1
+                logging.warning("HISTORY: failed to ingest <hist> from {}: {}"
+                                .format(item[2].port, e))
+
+    def ingest(self, line, host_time, current_cost, clock_offset=None):
+        device_time, periods = cc_parser.parse_hist(line)
+        self.messages += 1
+        by_chan = collections.defaultdict(list)
+        chans = self._chans(current_cost)
+        for sensor, kind, ago, kwh in periods:
+            block = block_bounds(kind, ago, device_time, host_time,
+                                 clock_offset)
+            if block is None:
+                continue
+            chan = chans.get(sensor)
+            if chan is None:
+                self.unmatched += 1
+                continue
+            by_chan[chan].append(block + (int(round(kwh * 1000)),))
+
+        for chan, blocks in by_chan.iteritems():
+            added = self.store.add(chan, blocks)
+            self.blocks += len(added)
+            if self.rollups is not None:
+                for block in added:
+                    self._backfill(chan, *block)
+
+    def _chans(self, current_cost):
+        """Map each <sensor> number on current_cost to a channel, if
+        exactly one Sensor was last heard on it."""
+
+        chans = {}
+        ambiguous = set()
+        for sensor in self.sensors():
+            location = sensor.location
+            if location is None or location.current_cost is not current_cost:
+                continue
+            if location.cc_channel in chans:
+                ambiguous.add(location.cc_channel)
+            chans[location.cc_channel] = sensor.chan
+        for cc_channel in ambiguous:
+            del chans[cc_channel]
+        return chans
+
+    def _backfill(self, chan, start, seconds, watt_hours):
+        """Write rollup rows for buckets inside the block with no row yet."""
+
+        watts = watt_hours * 3600 / seconds
+        for bucket_seconds, pool in self.rollups.backfill_pools.iteritems():
+            first = -(-start // bucket_seconds) * bucket_seconds
+            end = start + seconds - bucket_seconds + 1
+            # The open bucket (and any after it) will get a live row
+            open_start = self.rollups.open_bucket(chan, bucket_seconds)
+            if open_start is not None:
+                end = min(end, open_start)
+            if first >= end:
+                continue
+            live = self._existing_buckets(self.rollups.pools[bucket_seconds],
+                                          chan)
+            existing = self._existing_buckets(pool, chan)
+            rows = []
+            for bucket_start in xrange(first, end, bucket_seconds):
+                if bucket_start not in existing and bucket_start not in live:
+                    existing.add(bucket_start)
+                    rows.append('{:d} {:.1f} {:d} {:d} 0 {:.3f}\n'.format(
+                                    bucket_start, watts, int(round(watts)),
+                                    int(round(watts)),
+                                    watt_hours * bucket_seconds / seconds))
+            if rows:
+                pool.write(chan, ''.join(rows))
+                self.backfilled += len(rows)
+
+    def _existing_buckets(self, pool, chan):
+        """Return the set of bucket starts in chan's file in pool (a live
+        or backfill rollup pool), reading only what has been written since
+        the last call."""
+
+        key = (pool.directory, chan)
+        offset, starts = self._rollup_rows.get(key, (0, set()))
+        pool.flush() # so rows the writer thread has buffered are seen
+        try:
+            with open(pool.filename(chan), 'rb') as fh:
+                fh.seek(offset)
+                data = fh.read()
+        except IOError:
+            data = ''
+        data = data[:data.rfind('\n') + 1]
+        for line in data.splitlines():
+            try:
+                starts.add(int(line.split(None, 1)[0]))
+            except (ValueError, IndexError):
+                pass
+        self._rollup_rows[key] = (offset + len(data), starts)
+        return starts
+
+    def stop(self):
+        """Parse everything queued so far then stop."""
+
+        if self.is_alive():
+            self._queue.put(HistoryIngester._STOP)
+            self.join()
+
+    def __str__(self):
+        return ('messages={} blocks={} backfilled={} unmatched={} errors={} '
+                'dropped={}'.format(self.messages, self.blocks,
+                                    self.backfilled, self.unmatched,
+                                    self.errors, self.dropped))
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def block_bounds(kind, ago, device_time, host_time, clock_offset=None):
+    """Place a history period on the unix time-line.
+
+    <hNNN> is the two hour block which ended NNN - 2 hours before the
+    start of the current two hour block on the Current Cost's clock, and
+    <dNNN> is the day NNN days before today on the Current Cost's clock.
+    Boundaries are rounded to the nearest minute of host time.
+
+    Args:
+        kind (str): 'h', 'd' or 'm'.
+        ago (int): the number in the tag.
+        device_time (str): the message's <time>, e.g. '13:10:50'.
+        host_time (float): unix time the message was read.
+
+    Kwargs:
+        clock_offset (float): host - device time, from a DeviceClock.  If
+            given, blocks are placed relative to the time the message
+            was sent (device_time + clock_offset, as device timestamps
+            are) instead of host_time.
+
+    Returns:
+        (start, seconds) or None for months or an unreadable time.
+    """
+
+    seconds = BLOCK_SECONDS.get(kind)
+    if seconds is None or device_time is None:
+        return None
+    try:
+        hours, minutes, secs = device_time.split(':')
+        time_of_day = int(hours) * 3600 + int(minutes) * 60 + int(secs)
+    except ValueError:
+        return None
+
+    if clock_offset is not None:
+        # Put device_time on the day nearest the device's clock now
+        device_now = host_time - clock_offset
+        delta = (time_of_day - device_now) % SECONDS_PER_DAY
+        if delta > SECONDS_PER_DAY / 2:
+            delta -= SECONDS_PER_DAY
+        host_time = device_now + delta + clock_offset
+
+    if kind == 'h':
+        end = host_time - (time_of_day % seconds) - (ago - 2) * 3600
+    else:
+        end = host_time - time_of_day - (ago - 1) * SECONDS_PER_DAY
+    end = int(round(end / 60)) * 60
+    return end - seconds, seconds
@@ -11,13 +11,40 @@ import argparse
 import threading
 import signal
 import logging
+import collections
+import contextlib
+import re
+import select
+import errno
+import fcntl
+import multiprocessing
+import Queue
+import storage
+import cc_parser
+import rollup
+import journal
+import history
+import reconnect
+import status_screen
+import quantile
+import device_clock
+import stats_export
+import metrics_server
 
 #==============================================================================
 # GLOBALS
 #==============================================================================
 
 _abort = False # Make this True to halt all threads
+_abort_event = threading.Event() # Set with _abort, to wake sleeping threads
+_clock = time.time # Source of sample timestamps. Replaced by --replay
 _directory = None # The _directory to write data to. Set by config.xml
+_writer_pool = None # storage.ChannelWriterPool. Set by load_config()
+_writer = None # storage.WriterThread feeding _writer_pool. Set by load_config()
+_start_time = time.time() # Reset by main(); used to log how long startup took
+_file_cache = {} # filename -> ((mtime, size), parsed contents). See _load_cached()
+_radio_id_keys = set() # (radio_id, sens_chan) of each Sensor in radioIDs.dat
+_signatures = {} # filename -> (mtime, size) just before it was last parsed
 
 #==============================================================================
 # UTILITY FUNCTIONS
@@ -48,10 +75,54 @@ def check_for_duplicates(list_, label):
                         .format(label, duplicates))        
 
 
-def load_config():
+def load_config(open_serial_ports=True, directory=None):
     """Load config data from config files and init Current Costs.
     
-    Sets global _directory variable.
+    Kwargs:
+        open_serial_ports (bool): if False then don't create a CurrentCost
+            for each serialport.  Used by --replay.
+        
+        directory (str): write data here instead of the directory in
+            config.xml.
+    
+    Sets global _directory, _writer_pool and _writer variables.
+    
+    Optional config.xml elements controlling how data is written to disk:
+    
+        - storage (str): 'text' for channel_N.dat files (default) or
+          'binary' for fixed-width records in channel_N.bin files
+        - max_open_files (int): channel files kept open at once (default 32)
+        - flush_interval (float): max seconds before data is flushed (default 10)
+        - flush_bytes (int): flush once this many bytes are pending (default 4096)
+        - index_minutes (int): block length of the channel_N.idx time index
+          kept for text channel files. 0 disables the index (default 60)
+        - rotate (str): 'day' or 'month' to split each channel into dated
+          segments (e.g. channel_N.2013-02-04.dat) or 'none' (default)
+        - compress (str): 'on' to gzip each segment in the background
+          once it is closed (default) or 'off'
+        - history (str): 'on' to store the history sent in <hist>
+          messages and use it to fill gaps in the rollups, or 'off'
+          (default)
+        - queue_size (int): max samples waiting for the writer (default 10000)
+        - queue_policy (str): 'block' or 'drop' when the queue is full
+          (default 'block')
+        - rollup_minutes (str): space-separated bucket sizes, in minutes,
+          for rolled-up data (e.g. "1 60 1440").  Default: no rollups.
+        - rollup_max_gap (int): longest gap in seconds between samples
+          which is integrated for energy (default 60)
+        - journal (str): 'on' to pass every sample through the
+          journal.wal write-ahead journal or 'off' (default).  The
+          journal trades SD card wear for durability: every batch the
+          writer takes is also written to journal.wal and the journal
+          is fsync'd every journal_commit_interval seconds, whereas
+          without it a power cut can lose up to flush_interval seconds
+          of samples but the disk is only written once per flush
+        - journal_commit_interval (float): max seconds between fsyncs
+          of the journal, i.e. the most a power cut can lose (default:
+          flush_interval, so the card is synced no more often than
+          without the journal; use e.g. 1 for less loss)
+        - journal_checkpoint_seconds (float): how often the channel
+          files are fsync'd and the journal emptied (default 600)
     
     For each "serialport" listed in config.xml, init a new CurrentCost.
     
@@ -59,27 +130,178 @@ def load_config():
         a list of initialised CurrentCost objects.
     
     """
+    _signatures["config.xml"] = _file_signature("config.xml")
     config_tree   = ET.parse("config.xml") # load config from config file
     
     # load _directory
     global _directory
     _directory    = config_tree.findtext("directory") # File to save data to
+    if directory is not None:
+        _directory = directory
     if not _directory.endswith('/'):
         _directory = _directory + '/'
+    if not os.path.isdir(_directory):
+        os.makedirs(_directory)
+    
+    # set up the writer pool
+    global _writer_pool
+    backend = storage.get_backend(config_tree.findtext("storage", "text").strip())
+    rotate = config_tree.findtext("rotate", "none").strip()
+    if rotate != "none" and config_tree.findtext("compress", "on").strip() == "on":
+        compressor = storage.SegmentCompressor(_directory, backend.EXTENSION)
+    else:
+        compressor = None
+    _writer_pool = storage.ChannelWriterPool(_directory, backend=backend,
+                      max_open_files=int(config_tree.findtext("max_open_files", 32)),
+                      flush_interval=float(config_tree.findtext("flush_interval", 10)),
+                      flush_bytes=int(config_tree.findtext("flush_bytes", 4096)),
+                      index_seconds=int(config_tree.findtext("index_minutes", 60))*60,
+                      rotate=rotate,
+                      on_rotate=None if compressor is None else compressor.put)
+    rollup_minutes = config_tree.findtext("rollup_minutes", "").split()
+    if rollup_minutes:
+        rollups = rollup.RollupStage(_directory,
+                      [int(minutes) * 60 for minutes in rollup_minutes],
+                      max_gap=int(config_tree.findtext("rollup_max_gap", 60)),
+                      flush_interval=_writer_pool.flush_interval)
+    else:
+        rollups = None
+    if config_tree.findtext("journal", "off").strip() == "on":
+        wal = journal.Journal(_directory + journal.Journal.FILENAME,
+                      commit_interval=float(config_tree.findtext(
+                                 "journal_commit_interval",
+                                 _writer_pool.flush_interval)),
+                      checkpoint_seconds=float(config_tree.findtext(
+                                 "journal_checkpoint_seconds", 600)))
+    else:
+        wal = None
+    
+    global _writer
+    _writer = storage.WriterThread(_writer_pool,
+                      max_queue_size=int(config_tree.findtext("queue_size", 10000)),
+                      policy=config_tree.findtext("queue_policy", "block").strip(),
+                      on_error=_abort_now, rollups=rollups, journal=wal,
+                      compressor=compressor)
+    
+    if config_tree.findtext("history", "off").strip() == "on":
+        CurrentCost.history = history.HistoryIngester(
+                      history.HistoryStore(_directory),
+                      CurrentCost.sensors.values, rollups=rollups)
+    else:
+        CurrentCost.history = None
     
     # load serialports
     serials_etree = config_tree.findall("serialport")
 
     # Start a CurrentCost for each serial port in config.xml
     current_costs = []
-    for serial_port in serials_etree:
-        current_costs.append(CurrentCost(serial_port.text))
+    if open_serial_ports:
+        start = time.time()
+        current_costs = _open_current_costs([serial_port.text for serial_port
+                                             in serials_etree])
+        logging.info("LOADING CONFIG: opened {} serial ports in {:.3f}s"
+                     .format(len(current_costs), time.time() - start))
         
     load_radio_id_mapping('radioIDs.dat')
 
     return current_costs
 
 
+def _open_current_costs(ports, abort_on_error=True):
+    """Construct a CurrentCost for each port, opening the ports concurrently.
+    
+    Kwargs:
+        abort_on_error (bool): passed to CurrentCost.
+    
+    Returns:
+        list of CurrentCost, in the same order as ports.
+    
+    Raises:
+        the first error raised by any CurrentCost (after every port
+        has been tried).
+    """
+    
+    results = [None] * len(ports)
+    
+    def open_port(i, port):
+        try:
+            results[i] = CurrentCost(port, abort_on_error)
+        except Exception, e:
+            results[i] = e
+    
+    threads = [threading.Thread(target=open_port, args=(i, port),
+                                name="open_"+port)
+               for i, port in enumerate(ports)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def load_serial_ports(filename="config.xml"):
+    """Return the list of serial ports in config.xml."""
+    
+    _signatures[filename] = _file_signature(filename)
+    config_tree = ET.parse(filename)
+    return [serial_port.text for serial_port in config_tree.findall("serialport")]
+
+
+def _load_cached(filename, parse):
+    """Return parse(filename), only re-parsing if the file's mtime or
+    size has changed since it was last parsed.
+    
+    Raises:
+        IOError, OSError: if filename can't be read.
+    """
+    
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        _signatures[filename] = None
+        raise
+    key = (stat.st_mtime, stat.st_size)
+    _signatures[filename] = key
+    cached = _file_cache.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    parsed = parse(filename)
+    _file_cache[filename] = (key, parsed)
+    return parsed
+
+
+def _file_signature(filename):
+    """Return (mtime, size) of filename, or None if it doesn't exist."""
+    
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def recover_data():
+    """Repair channel files and replay the journal after a crash.
+    
+    Must be called after load_config() and before _writer is started.
+    """
+    
+    result = journal.recover(_writer_pool, _writer.journal)
+    if result['torn_bytes'] or result['rebuilt_indexes'] or result['replayed']:
+        print_to_stdout_and_log("RECOVERY: replayed {replayed} of {records} "
+                                "journalled samples, truncated {torn_bytes} "
+                                "bytes of torn lines and rebuilt "
+                                "{rebuilt_indexes} indexes".format(**result),
+                                logging.WARNING)
+    else:
+        logging.info("RECOVERY: nothing to recover ({records} journalled "
+                     "samples already on disk)".format(**result))
+
+
 def load_radio_id_mapping(filename):
     """Loads and processes radioIDs.dat or radioIDs_override.dat.
     
@@ -88,101 +310,177 @@ def load_radio_id_mapping(filename):
     If filename is not found then ignores (after printing an info message
     to stderr.)
     
+    The parsed file and labels.dat are cached (keyed by mtime) so calling
+    this again when nothing has changed does no parsing and no writing.
+    
+    May be called again while the Current Costs are running (see
+    ConfigWatcher).  Existing Sensors are updated in place: the channel,
+    label and never_zero of every Sensor are changed while holding every
+    registry lock, so readers see either the old or the new mapping.
+    Sensors which have been removed from filename revert to having no
+    channel or label.
+    
     Args:
         filename (str): the filename to load.  e.g. "radioIDs.dat"
+    
+    Returns:
+        the entries applied (see _parse_radio_ids), or None if filename
+        was not found.
 
     Raises:
         IAMLoggerError: if duplicate channels or radioIDs are found
     """
 
     try:
-        radio_id_fh = open(filename, "r") # "fh" = file handle
-    except IOError, e: # file not found
+        entries = _load_cached(filename, _parse_radio_ids)
+    except (IOError, OSError), e: # file not found
         logging.info("LOADING CONFIG: {} file not found. Ignoring.\n{}"
                      .format((filename), str(e)))
-    else:
+        return None
+    except IAMLoggerError, e: # duplicates found        
+        logging.exception(str(e))
+        raise
+
+    labels, changed = _apply_radio_ids(entries)
+    if changed:
+        logging.info("LOADING CONFIG: {} sensors configured from {}"
+                     .format(changed, filename))
+    _write_labels(labels)
+    return entries
+
+
+def _apply_radio_ids(entries):
+    """Set the channel, label and never_zero of every Sensor in the
+    registry from entries parsed by _parse_radio_ids.
+    
+    Returns:
+        (labels, changed): a dict mapping channel to label, and the
+        number of Sensors which were changed.
+    """
+    
+    global _radio_id_keys
+    registry = CurrentCost.sensors
+    labels = {} # map channel to label (for creating labels.dat)
+    keys = set()
+    changed = 0
+    with registry.locked_all():
+        for channel, label, radio_id, sens_chan, never_zero in entries:
+            key = (radio_id, sens_chan)
+            sensor = registry.get_or_create(key,
+                                            lambda: Sensor(radio_id, sens_chan))
+            if (sensor.channel, sensor.label, sensor.never_zero) != \
+               (channel, label, never_zero):
+                sensor.channel = channel
+                sensor.label = label
+                sensor.never_zero = never_zero
+                changed += 1
+            labels[channel] = label
+            keys.add(key)
+        
+        for key in _radio_id_keys - keys:
+            sensor = registry.get(key)
+            sensor.channel = '-'
+            sensor.label = '-'
+            sensor.never_zero = False
+            changed += 1
+        _radio_id_keys = keys
+    return labels, changed
+
+
+def _parse_radio_ids(filename):
+    """Parse radioIDs.dat.
+    
+    Returns:
+        list of (channel, label, radio_id, sens_chan, never_zero) tuples.
+    
+    Raises:
+        IAMLoggerError: if duplicate channels or radioIDs are found
+    """
+    
+    with open(filename, "r") as radio_id_fh: # "fh" = file handle
         lines = radio_id_fh.readlines()
-        radio_id_fh.close()
 
-        radio_ids_and_sens_chans = [] # used to check for duplicate radio IDs
-        channels = [] # used to check for duplicate channel numbers
-        labels = {} # map channel to label (for creating labels.dat)
+    entries = []
+    radio_ids_and_sens_chans = [] # used to check for duplicate radio IDs
+    channels = [] # used to check for duplicate channel numbers
 
-        for line in lines:
-            partition = line.partition('#') # ignore comments
-            fields = partition[0].strip().split()
-            if len(fields) == 3 or len(fields) == 4:
-                channel, label, radio_id_and_sens_chan = fields[:3]
-                
-                # "sens_chan" = sensor channel. i.e. <chX/watts> in XML
-                radio_id, dummy, sens_chan = radio_id_and_sens_chan.partition('/')
-                if sens_chan == '':
-                    # default sensor channel if nothing stated in radioIDs.dat
-                    sens_chan = 1 
-                
-                radio_id = int(radio_id)
-                sens_chan= int(sens_chan)
-                
-                key = (radio_id, sens_chan)
-                
-                CurrentCost.sensors[key] = Sensor(radio_id, sens_chan,
-                                                  channel, label)
-                
-                radio_ids_and_sens_chans.append(key)
-                channels.append(channel)
+    for line in lines:
+        partition = line.partition('#') # ignore comments
+        fields = partition[0].strip().split()
+        if len(fields) == 3 or len(fields) == 4:
+            channel, label, radio_id_and_sens_chan = fields[:3]
+            
+            # "sens_chan" = sensor channel. i.e. <chX/watts> in XML
+            radio_id, dummy, sens_chan = radio_id_and_sens_chan.partition('/')
+            if sens_chan == '':
+                # default sensor channel if nothing stated in radioIDs.dat
+                sens_chan = 1 
+            
+            radio_id = int(radio_id)
+            sens_chan= int(sens_chan)
+            never_zero = len(fields) == 4 and fields[3] == 'NEVER_ZERO'
+            
+            entries.append((channel, label, radio_id, sens_chan, never_zero))
+            radio_ids_and_sens_chans.append((radio_id, sens_chan))
+            channels.append(channel)
+
+    check_for_duplicates(radio_ids_and_sens_chans, 'radio_ids_and_sens_chans in {}'.format(filename))
+    check_for_duplicates(channels, 'channels in {}'.format(filename))
+    return entries
+
+
+def _parse_labels(filename):
+    """Parse labels.dat into a dict mapping channel to label."""
+    
+    labels = {}
+    with open(filename, 'r') as labels_fh:
+        for line in labels_fh:
+            fields = line.split()
+            if len(fields) == 2:
+                channel, label = fields
                 labels[channel] = label
-                
-            if len(fields) == 4 and fields[3] == 'NEVER_ZERO':
-                CurrentCost.sensors[key].never_zero = True;
-
-        try:                        
-            check_for_duplicates(radio_ids_and_sens_chans, 'radio_ids_and_sens_chans in {}'.format(filename))
-            check_for_duplicates(channels, 'channels in {}'.format(filename))
-        except IAMLoggerError, e: # duplicates found        
-            logging.exception(str(e))
-            raise
-        
-        # Write labels.dat file to disk
-        # First check if file exists
-        labels_filename = _directory + 'labels.dat'
+    return labels
+
+
+def _write_labels(labels):
+    """Merge labels into labels.dat, only writing if something changed."""
+    
+    # First check if file exists
+    labels_filename = _directory + 'labels.dat'
+    try:
+        existing_labels = _load_cached(labels_filename, _parse_labels)
+    except (IOError, OSError):
+        logging.info(labels_filename + ' does not yet exist. Will create.')
         existing_labels = {}
-        try:
-            labels_fh = open(labels_filename, 'r')
-        except IOError:
-            logging.info(labels_filename + ' does not yet exist. Will create.')
-        else:
-            # Load existing labels.dat file
-            lines = labels_fh.readlines()
-            labels_fh.close()
-            for line in lines:
-                fields = line.split()
-                if len(fields) == 2:
-                    channel, label = fields
-                    existing_labels[channel] = label
-                
-        # Merge existing_labels with labels if necessary
+    
+    # Merge existing_labels with labels if necessary
+    if labels == existing_labels:
+        logging.info("Existing labels.dat file already contains all "
+                     "necessary labels so not writing to labels.dat.")
+        return # don't write to labels.dat
+    
+    labels = dict(labels)
+    if existing_labels != {}:
+        logging.info("existing labels.dat is not empty and it isn't "
+                     "the same as new labels so merging the two.")
+        for e_channel, e_label in existing_labels.iteritems():
+            if e_channel not in labels:
+                labels[e_channel] = e_label
         if labels == existing_labels:
-            logging.info("Existing labels.dat file already contains all "
-                         "necessary labels so not writing to labels.dat.")
-            # don't write to labels.dat
-        else:
-            if existing_labels != {}:
-                logging.info("existing labels.dat is not empty and it isn't "
-                             "the same as new labels so merging the two.")
-                for e_channel, e_label in existing_labels.iteritems():
-                    if e_channel not in labels.keys():
-                        labels[e_channel] = e_label
-
-            logging.info("Writing {} to disk.".format(labels_filename))                    
-            labels_fh = open(labels_filename, 'w') # fh = file handle
-            channels = labels.keys()
-            channels.sort()
-            for channel_key in channels:
-                labels_fh.write('{} {}\n'.format(channel_key, 
-                                                 labels[channel_key]))
-            labels_fh.close()
+            return # nothing new to add
+    
+    logging.info("Writing {} to disk.".format(labels_filename))                    
+    with open(labels_filename, 'w') as labels_fh: # fh = file handle
+        for channel_key in sorted(labels.keys()):
+            labels_fh.write('{} {}\n'.format(channel_key, 
+                                             labels[channel_key]))
     
 
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
 def _abort_now(exception=None):
     if exception is not None:
         print_to_stdout_and_log(str(exception), logging.CRITICAL )
@@ -190,6 +488,7 @@ def _abort_now(exception=None):
     print_to_stdout_and_log("Aborting...")        
     global _abort
     _abort = True 
+    _abort_event.set()
 
 
 def _signal_handler(signal_number, frame):
@@ -214,62 +513,180 @@ class IAMLoggerError(Exception):
     """Base class for errors in iam_logger."""
 
 
+class ReplayExhausted(IAMLoggerError):
+    """Raised by ReplayCurrentCost.readline when it has no more lines."""
+
+
+class StageTimer(object):
+    """Accumulate the number of calls to, and time spent in, named stages.
+    
+    Times are inclusive: if one timed stage calls another then the
+    time is counted in both.
+    
+    """
+    
+    _STR_FORMAT = '{:>20} {:>9} {:>10} {:>10} {:>10}\n'
+    
+    def __init__(self):
+        self.stages = collections.OrderedDict() # name -> [calls, total, max]
+    
+    def add(self, stage, seconds):
+        stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+    
+    def wrap(self, stage, func):
+        """Return a version of func which times itself as stage."""
+        
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - start)
+        return timed
+    
+    def __str__(self):
+        string = StageTimer._STR_FORMAT.format('STAGE', 'CALLS', 'TOTAL(s)',
+                                               'MEAN(us)', 'MAX(us)')
+        for stage, (calls, total, max_) in self.stages.iteritems():
+            string += StageTimer._STR_FORMAT.format(stage, calls,
+                                               '{:.3f}'.format(total),
+                                               '{:.1f}'.format(total/calls*1E6),
+                                               '{:.1f}'.format(max_*1E6))
+        return string
+
+
 class TimeInfo(object):    
     """Record simple statistics about the time each Sensor is updated.
     
-    Useful for finding IAMs which produce intermittent data.
+    Useful for finding IAMs which produce intermittent data.  As well
+    as the running mean, max and min of the period between updates, 
+    TimeInfo estimates the QUANTILES of the period (in constant memory,
+    see quantile.P2Quantiles), counts gaps longer than GAP_SECONDS and
+    keeps the last WINDOW periods so recent behaviour isn't hidden by a
+    long history.  Every update is O(1).
     
     Static attributes:
             
         - HEADERS (str): column headers
+        
+        - GAP_SECONDS (float): periods longer than this count as gaps.
+          Set by the --gap_seconds command line option.
+        
+        - WINDOW (int): number of recent periods kept.
+        
+        - QUANTILES (tuple): quantiles of the period to estimate.
     
     Attributes:
     
         - last_seen (float): Unix timecode.
+        
+        - gaps (int): number of periods longer than GAP_SECONDS.
     
     """
     
-    _STR_FORMAT = '{:>7.2f}{:>7.1f}{:>7.1f}{:>7.1f}{:>7d}'
-    _STR_FORMAT_TXT = '{:>7}{:>7}{:>7}{:>7}{:>7}' 
-    HEADERS = _STR_FORMAT_TXT.format('MEAN', 'MAX', 'MIN', 'LAST', 'COUNT') 
+    _STR_FORMAT = '{:>7.2f}{:>7.1f}{:>7.1f}{:>7.1f}{:>7.1f}{:>6d}{:>7d}'
+    _STR_FORMAT_TXT = '{:>7}{:>7}{:>7}{:>7}{:>7}{:>6}{:>7}' 
+    HEADERS = _STR_FORMAT_TXT.format('MEAN', 'MAX', 'MIN', 'LAST', 'P95', 
+                                     'GAPS', 'COUNT') 
+    GAP_SECONDS = 30
+    WINDOW = 32
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    __slots__ = ('_count', '_current', '_mean', '_max', '_min', 'last_seen',
+                 'gaps', '_quantiles', '_recent', '_recent_total')
     
     def __init__(self):
         self._count = -1
+        self._current = None
+        self._mean = None
+        self._max = None
+        self._min = None
         self.last_seen =  0
+        self.gaps = 0
+        self._quantiles = None
+        self._recent = None # ring buffer of the last WINDOW periods
+        self._recent_total = 0.0
 
-    def update(self):
+    def update(self, unix_time=None):
         """Get time now. Calculate time since last update.  
         Use this to update period statistics.
+        
+        Kwargs:
+            unix_time (float): time of the update, if not now.
            
         """
-        unix_time = time.time()
+        if unix_time is None:
+            unix_time = _clock()
         self._count += 1        
         self._current = unix_time - self.last_seen
         
         if self._count == 0: # this is the first time we've run
             self._current = None
-            self._mean = None
-            self._max  = None
-            self._min  = None
+            self.last_seen = unix_time
+            return
         elif self._count == 1:
             self._mean = self._current
             self._max  = self._current
             self._min  = self._current
+            self._quantiles = quantile.P2Quantiles(TimeInfo.QUANTILES)
+            self._recent = [0.0] * TimeInfo.WINDOW
         else:
-            self._mean = (((float(self._mean) * (self._count - 1)) + self._current) 
-                         / self._count)
+            self._mean += (self._current - self._mean) / self._count
             if self._current > self._max: self._max = self._current
             if self._current < self._min: self._min = self._current
+        
+        self._quantiles.add(self._current)
+        if self._current > TimeInfo.GAP_SECONDS:
+            self.gaps += 1
+        slot = self._count % TimeInfo.WINDOW
+        self._recent_total += self._current - self._recent[slot]
+        self._recent[slot] = self._current
             
         self.last_seen = unix_time
 
+    @property
+    def count(self):
+        """Number of updates (after the first)."""
+        return self._count
+
+    def quantiles(self):
+        """Return estimates of each of QUANTILES of the period (or Nones)."""
+        if self._quantiles is None:
+            return [None] * len(TimeInfo.QUANTILES)
+        return self._quantiles.quantiles()
+
+    def recent(self):
+        """Return (mean, max) of the last WINDOW periods, or (None, None)."""
+        if self._recent is None:
+            return None, None
+        n = min(self._count, TimeInfo.WINDOW)
+        periods = self._recent if n == TimeInfo.WINDOW else self._recent[1:n+1]
+        return self._recent_total / n, max(periods)
+
+    def snapshot(self):
+        """Return the period statistics as a dict."""
+        snapshot = {'mean': self._mean, 'max': self._max, 'min': self._min,
+                    'last': self._current, 'count': self._count,
+                    'last_seen': self.last_seen, 'gaps': self.gaps}
+        for q, value in zip(TimeInfo.QUANTILES, self.quantiles()):
+            snapshot['p{:d}'.format(int(round(q * 100)))] = value
+        snapshot['recent_mean'], snapshot['recent_max'] = self.recent()
+        return snapshot
+
     def __str__(self):
         if self._count < 1:
-            return TimeInfo._STR_FORMAT_TXT.format('-','-','-','-',self._count)
+            return TimeInfo._STR_FORMAT_TXT.format('-','-','-','-','-',
+                                                   self.gaps, self._count)
         else:
             return TimeInfo._STR_FORMAT.format(self._mean, self._max, 
                                              self._min, self._current, 
-                                             self._count)
+                                             self.quantiles()[
+                                                 TimeInfo.QUANTILES.index(0.95)],
+                                             self.gaps, self._count)
 
 
 class Location(object):
@@ -278,6 +695,10 @@ class Location(object):
     The 'location'  means the combination of Current Cost instance and 
     the cc_channel on that CC and the sensor channel.
     
+    Locations are interned: use Location.get() rather than the
+    constructor so that each location is only ever allocated once and
+    can be compared and hashed by identity.
+    
     Attributes:
         sens_chan (int): the sensor channel number.  i.e. the X in <chX>
             in the CC XML.
@@ -286,7 +707,24 @@ class Location(object):
         
         current_cost (CurrentCost): a CurrentCost object.
     """
+    
+    __slots__ = ('sens_chan', 'cc_channel', 'current_cost')
+    
+    # (current_cost, cc_channel, sens_chan) -> Location
+    _interned = {}
        
+    @classmethod
+    def get(cls, sens_chan, cc_channel, current_cost):
+        """Return the interned Location, creating it if necessary."""
+        
+        key = (current_cost, cc_channel, sens_chan)
+        location = cls._interned.get(key)
+        if location is None:
+            # setdefault is atomic so racing threads get the same object
+            location = cls._interned.setdefault(key, cls(sens_chan, cc_channel,
+                                                         current_cost))
+        return location
+    
     def __init__(self, sens_chan, cc_channel, current_cost):
         """Construct a Location object.
         
@@ -364,6 +802,11 @@ class Sensor(object):
     HEADERS = _STR_FORMAT_TXT.format('LABEL', 'CHAN', 'CCsens', 'WATTS',
                                 TimeInfo.HEADERS, 'RADIOID', 'LOCATIONS') 
     
+    __slots__ = ('time_info', 'location', 'locations', 'radio_id', 'sens_chan',
+                 'channel', 'label', 'watts', 'never_zero',
+                 '_last_timecode_written_to_disk',
+                 '_last_location_written_to_disk')
+    
     def __init__(self, radio_id, sens_chan=1, channel='-', label='-'):
         """Construct a Sensor.
         
@@ -384,20 +827,27 @@ class Sensor(object):
         """
         
         self.time_info = TimeInfo()
-        self.location = '-'                        
-        self.locations = {} 
+        self.location = None
+        self.locations = {} # Location -> number of times seen there
         self.radio_id = radio_id 
         self.sens_chan = sens_chan
         self.channel = channel
         self.label = label
         self.watts = '-'
         self._last_timecode_written_to_disk = None
+        self._last_location_written_to_disk = None
         self.never_zero = False
 
-    def update(self, watts, sens_chan, cc_sens, current_cost):
+    def update(self, watts, sens_chan, cc_sens, current_cost, 
+               timestamp=None):
         """Process a new sample.
         
-        We use timestamp from local computer, not from the Current Cost.
+        We use timestamp from local computer unless CurrentCost.timestamps
+        is 'device', in which case the CurrentCost gives us a timestamp
+        derived from the Current Cost's clock.
+        
+        Several threads may hear this sensor so the caller must hold
+        CurrentCost.sensors.acquire((radio_id, sens_chan)).
         
         Args:
         
@@ -412,6 +862,11 @@ class Sensor(object):
             current_cost (CurrentCost): the Current Cost this sensor
                 appears on
         
+        Kwargs:
+        
+            timestamp (float): unix time the sample was sent, or None
+                to use the time now.
+        
         """
         
         # Sometimes the Current Cost incorrectly claims the aggregate power
@@ -420,14 +875,16 @@ class Sensor(object):
         if self.never_zero and watts == 0:
             return
         
-        self.time_info.update()
-        self.watts = watts
-        self.location = Location(sens_chan, cc_sens, current_cost) 
+        # A late-read sample which another Current Cost has already 
+        # delivered (along with later samples)
+        if timestamp is not None and timestamp < self.time_info.last_seen:
+            return
         
-        if str(self.location) in self.locations.keys():
-            self.locations[ str(self.location) ] += 1
-        else:
-            self.locations[ str(self.location) ]  = 0
+        self.time_info.update(timestamp)
+        self.watts = watts
+        location = Location.get(sens_chan, cc_sens, current_cost) 
+        self.location = location
+        self.locations[location] = self.locations.get(location, 0) + 1
         
         self.write_to_disk()
 
@@ -441,10 +898,37 @@ class Sensor(object):
                                        self.location.sens_chan,
                                        self.watts, 
                                        self.time_info, self.radio_id, 
-                                       self.locations) 
+                                       self.location_counts())
+
+    def location_counts(self):
+        """Return a dict mapping str(location) to the number of samples
+        heard there.
+        
+        """
+        # items() copies atomically, unlike iterating while a reader 
+        # thread might add a location
+        return dict((str(location), count) for
+                    location, count in self.locations.items())
+
+    def snapshot(self, now):
+        """Return this Sensor's state as a dict (see Manager.snapshot)."""
+        
+        snapshot = self.time_info.snapshot()
+        snapshot.update({'radio_id': self.radio_id, 
+                         'sens_chan': self.sens_chan,
+                         'channel': self.channel,
+                         'label': self.label,
+                         'watts': None if self.watts == '-' else self.watts,
+                         'age': now - snapshot['last_seen'],
+                         'locations': self.location_counts()})
+        return snapshot
 
     def write_to_disk(self):
-        """Dump a line of data to this Sensor's output file."""
+        """Queue a line of data for this Sensor's output file.
+        
+        The sample is handed to the _writer thread, which formats it and
+        writes it to disk in batches, so this never blocks on disk I/O.
+        """
         
         timecode = int(round(self.time_info.last_seen))
         
@@ -452,10 +936,13 @@ class Sensor(object):
         # (possibly because multiple _current cost monitors hear this sensor,
         # but can also occur when the computer fails to receive serial
         # data as soon as it's available, for example if the computer
-        # is heavily loaded with another task.  I could try to work around
-        # this problem by somehow using the timecode from the CC when
-        # the timecode from the computer makes little sense.)
+        # is heavily loaded with another task.  Running with 
+        # --timestamps device works around this by using the timecode
+        # from the CC.)
         if timecode == self._last_timecode_written_to_disk:
+            # Expected (and silent) when another Current Cost wrote it
+            if self.location is not self._last_location_written_to_disk:
+                return
             logging.warning("SENSOR: Timecode {} already written to disk. "
                          "Label={}, watts={}, location={}"
                          .format(timecode, self.label,
@@ -463,18 +950,143 @@ class Sensor(object):
             return
         
         self._last_timecode_written_to_disk = timecode
+        self._last_location_written_to_disk = self.location
+        _writer.put(self.chan, timecode, self.watts)
+    
+    @property
+    def chan(self):
+        """The channel used to name this Sensor's data file."""
+        return self.radio_id if self.channel == '-' else self.channel
         
-        if self.channel == '-':
-            chan = self.radio_id
-        else:
-            chan = self.channel
+
+class SensorRegistry(object):
+    """Thread-safe registry of every Sensor, keyed by (radio_id, sens_chan).
+    
+    Several CurrentCost threads can hear the same sensor so updates to
+    each Sensor must be serialised.  Rather than one global lock, keys
+    are spread over N_SHARDS locks so unrelated sensors rarely contend.
+    Lookups are plain dict lookups (atomic under the GIL); only creating
+    a new Sensor takes a (separate) lock.
+    
+    Usage:
+        sensor = registry.get_or_create(key, factory)
+        with registry.locked(key):
+            sensor.update(...)
+    
+    or, on hot paths, registry.acquire(key) and release the returned lock.
+    
+    Attributes:
+    
+        creations (int): number of Sensors created by get_or_create().
+    
+    """
+    
+    N_SHARDS = 16
+    
+    def __init__(self):
+        self._sensors = {}
+        self._create_lock = threading.Lock()
+        self._shard_locks = [threading.Lock() 
+                             for i in range(SensorRegistry.N_SHARDS)]
+        # Only modified while holding the corresponding shard lock:
+        self._acquisitions = [0] * SensorRegistry.N_SHARDS
+        self._contended = [0] * SensorRegistry.N_SHARDS
+        self.creations = 0
+    
+    def get_or_create(self, key, factory):
+        """Return the Sensor for key, calling factory() to create it if
+        it doesn't yet exist.
+        
+        """
+        
+        sensor = self._sensors.get(key)
+        if sensor is None:
+            with self._create_lock:
+                sensor = self._sensors.get(key) # might have been created
+                if sensor is None:
+                    sensor = factory()
+                    self._sensors[key] = sensor
+                    self.creations += 1
+        return sensor
+    
+    def get(self, key):
+        """Return the Sensor for key, or None."""
+        return self._sensors.get(key)
+    
+    def acquire(self, key):
+        """Acquire the lock for key's shard.
+        
+        Returns:
+            the lock, which the caller must release.
+        """
+        
+        shard = hash(key) % SensorRegistry.N_SHARDS
+        lock = self._shard_locks[shard]
+        if not lock.acquire(False):
+            lock.acquire()
+            self._contended[shard] += 1
+        self._acquisitions[shard] += 1
+        return lock
+    
+    @contextlib.contextmanager
+    def locked(self, key):
+        """Context manager which holds the lock for key's shard."""
+        
+        lock = self.acquire(key)
+        try:
+            yield
+        finally:
+            lock.release()
+    
+    @contextlib.contextmanager
+    def locked_all(self):
+        """Context manager which holds every shard lock, so changes made
+        to several Sensors are seen by readers all at once.
         
-        filename =  _directory + "channel_" + str(chan) + ".dat"
-        filehandle = open(filename, 'a+')
-        data = '{:d} {}\n'.format(timecode, self.watts)
-        filehandle.write(data)
-        filehandle.close()
+        get_or_create() may still be called while holding them.
+        """
         
+        for lock in self._shard_locks: # always in the same order
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._shard_locks):
+                lock.release()
+    
+    @property
+    def acquisitions(self):
+        return sum(self._acquisitions)
+    
+    @property
+    def contended(self):
+        return sum(self._contended)
+    
+    # Dict-like interface used when loading config
+    
+    def __getitem__(self, key):
+        return self._sensors[key]
+    
+    def __setitem__(self, key, sensor):
+        with self._create_lock:
+            self._sensors[key] = sensor
+    
+    def __contains__(self, key):
+        return key in self._sensors
+    
+    def __len__(self):
+        return len(self._sensors)
+    
+    def keys(self):
+        return self._sensors.keys()
+    
+    def values(self):
+        return self._sensors.values()
+    
+    def __str__(self):
+        return ('sensors={} lock acquisitions={} contended={}'
+                .format(len(self), self.acquisitions, self.contended))
+
 
 class Manager(object):
     """Singleton. Used to manage multiple CurrentCost objects.
@@ -484,19 +1096,93 @@ class Manager(object):
         current_costs (list): list of CurrentCost objects
         
         args : command line arguments
+        
+        engine (SelectEngine or ProcessEngine): reads every serial port
+            if args.engine is 'select' or 'processes', otherwise None
+            (each CurrentCost runs its own thread).
+        
+        config_watcher (ConfigWatcher): reloads config files which are
+            changed while running, or None.
+    
+    Static attributes:
+    
+        SORT_KEYS (dict): functions of (local_sensors key, Sensor) used
+            to order each CurrentCost's rows on screen.  Selected with
+            the --sort command line option.
     
     """
+    
+    RATE_WINDOW = 60 # seconds over which message rates are measured
+    
+    SORT_KEYS = {'location': lambda item: item[0],
+                 'channel': lambda item: item[1].chan,
+                 'label': lambda item: item[1].label,
+                 'watts': lambda item: (-item[1].watts if item[1].watts != '-'
+                                        else 1)}
 
     def __init__(self, current_costs, args):
         self.current_costs = current_costs
         self.args = args
+        self.engine = None
+        self.config_watcher = None
+        self.stats_exporter = None
+        self.metrics_server = None
+        self._rows = {} # Sensor -> (count, label, row) from the last frame
+        self._rate_lock = threading.Lock()
+        self._message_history = collections.deque() # (time, {port: messages})
         
     def run(self):
-        """Start each CurrentCost thread."""
+        """Start the writer thread and then either each CurrentCost
+        thread or the SelectEngine.
+        
+        """
         
         for current_cost in self.current_costs:
             current_cost.print_xml = self.args.print_xml
-            current_cost.start()
+        
+        if self.args.engine == 'processes':
+            # Fork before any other threads are started
+            self.engine = ProcessEngine(self.current_costs, self.args.workers)
+            self.engine.start_workers()
+        
+        if not self.args.print_xml:
+            _writer.start()
+            if CurrentCost.history is not None:
+                CurrentCost.history.start()
+        
+        if self.args.engine == 'select':
+            self.engine = SelectEngine(self.current_costs)
+            self.engine.start()
+        elif self.args.engine == 'processes':
+            self.engine.start()
+        else:
+            for current_cost in self.current_costs:
+                current_cost.start()
+        logging.info("MANAGER: reading {} Current Costs {:.3f}s after startup"
+                     .format(len(self.current_costs),
+                             time.time() - _start_time))
+        
+        if self.args.reload_interval > 0:
+            self.config_watcher = ConfigWatcher(self, self.args.reload_interval,
+                                                dict(_signatures))
+            self.config_watcher.start()
+        
+        if not self.args.print_xml and self.args.stats_interval > 0:
+            self.stats_exporter = stats_export.StatsExporter(
+                                          self.args.stats_file,
+                                          self.stats_text,
+                                          self.args.stats_interval)
+            self.stats_exporter.start()
+        
+        if not self.args.print_xml and self.args.metrics_port > 0:
+            self.metrics_server = metrics_server.MetricsServer(
+                                          self.snapshot,
+                                          self.args.metrics_host,
+                                          self.args.metrics_port)
+            self.metrics_server.start()
+            logging.info("MANAGER: serving metrics on http://{}:{}/metrics"
+                         .format(self.args.metrics_host,
+                                 self.args.metrics_port))
         
         # Use this main thread of control to continually
         # print out info
@@ -504,26 +1190,222 @@ class Manager(object):
             print("Press CTRL+C to stop.\n")
             signal.pause() # Note: signal.pause can't be used on Windows!
         elif self.args.no_display:
-            self.write_stats_to_file()                
+            print("Press CTRL+C to stop.\n")
+            while not _abort:
+                time.sleep(1)
         else:
             self.write_stats_to_screen()
         
         self.stop()
 
+    def add_serial_ports(self, ports):
+        """Start reading any of ports which aren't already being read.
+        
+        The new ports are all opened before any is started.  If any
+        can't be opened then none are added (so the change can be
+        retried as a whole).  Ports which are no longer listed keep
+        being read until the logger is restarted.
+        
+        Returns:
+            number of ports added.
+        """
+        
+        existing = set(current_cost.port for current_cost in self.current_costs)
+        new_ports = [port for port in ports if port not in existing]
+        removed = existing.difference(ports)
+        if removed:
+            logging.warning("MANAGER: restart to stop reading {}"
+                            .format(', '.join(sorted(removed))))
+        if not new_ports:
+            return 0
+        try:
+            new_current_costs = _open_current_costs(new_ports,
+                                                    abort_on_error=False)
+        except (OSError, serial.SerialException), e:
+            logging.warning("MANAGER: not adding {}: {}"
+                            .format(', '.join(new_ports), e))
+            return 0
+        
+        for current_cost in new_current_costs:
+            current_cost.print_xml = self.args.print_xml
+            if self.engine is not None:
+                self.engine.add(current_cost)
+            else:
+                current_cost.start()
+        # Replace (rather than extend) the list so other threads
+        # iterating over it see either the old or the new list
+        self.current_costs = self.current_costs + new_current_costs
+        print_to_stdout_and_log("MANAGER: added serial ports {}"
+                                .format(', '.join(new_ports)))
+        return len(new_current_costs)
+
     def write_stats_to_screen(self):
-        while not _abort:
-            os.system('clear')
-            print(str(self))
-            print("Press CTRL+C to stop.\n")                
-            time.sleep(1)            
+        screen = status_screen.StatusScreen()
+        try:
+            while not _abort:
+                screen.draw(self.screen_lines())
+                time.sleep(self.args.refresh)
+        finally:
+            screen.close()
+            logging.info("MANAGER: drew {} frames, rewrote {} rows"
+                         .format(screen.frames, screen.rows_written))
 
-    def write_stats_to_file(self):
-        print("Press CTRL+C to stop.\n")
-        while not _abort:
-            stats_file_handle = open("stats.dat", "w")            
-            print(str(self), file=stats_file_handle)
-            stats_file_handle.close()
-            time.sleep(60)            
+    def screen_lines(self):
+        """Return the status display as a list of lines.
+        
+        Sensor rows are only re-formatted if the Sensor has been updated
+        (or relabelled) since the last frame.
+        
+        """
+        
+        sort_key = Manager.SORT_KEYS[self.args.sort]
+        rows = {}
+        lines = []
+        for current_cost in self.current_costs:
+            lines.extend(current_cost.header().splitlines())
+            for key, sensor in sorted(current_cost.local_sensors.items(),
+                                      key=sort_key):
+                cached = self._rows.get(sensor)
+                if (cached is None or cached[0] != sensor.time_info.count or
+                    cached[1] != sensor.label):
+                    cached = (sensor.time_info.count, sensor.label,
+                              str(sensor).rstrip('\n'))
+                rows[sensor] = cached
+                lines.append(cached[2])
+            lines.extend(['', ''])
+        self._rows = rows
+        
+        lines.extend(self.summary().splitlines())
+        lines.append("Press CTRL+C to stop.")
+        return lines
+
+    def stats_text(self):
+        """Return the statistics exported to the stats file, in the
+        format given by args.stats_format.
+        
+        """
+        
+        if self.args.stats_format == 'json':
+            return stats_export.to_json(self.snapshot())
+        elif self.args.stats_format == 'line':
+            return stats_export.to_line_protocol(self.snapshot())
+        elif self.args.stats_format == 'prometheus':
+            return stats_export.to_prometheus(self.snapshot())
+        else:
+            return str(self) + "\n"
+
+    def snapshot(self):
+        """Return the state of every Sensor which has been heard, and
+        of the rest of the pipeline, as a dict suitable for export 
+        (e.g. as JSON).
+        
+        Counters and Sensors are read without taking any locks so a
+        snapshot never holds up the CurrentCost threads.  The fields of
+        a Sensor which is being updated at that moment may be one 
+        sample apart.
+        
+        Returns:
+            {'time': unix time of the snapshot,
+             'current_costs': [{'port', 'dsb', 'version', 'messages',
+                                'messages_per_second', 'hist_messages',
+                                'parse_errors', 'retries', 'reconnects',
+                                'outages', 'connected', 'downtime_seconds',
+                                'corrected_timestamps'}, ...],
+             'sensors': [{'radio_id', 'sens_chan', 'channel', 'label',
+                          'watts', 'mean', 'min', 'max', 'last', 'count',
+                          'p50', 'p95', 'p99', 'recent_mean', 'recent_max',
+                          'gaps', 'last_seen', 'age', 'locations'}, ...],
+             'writer': {'queue_depth', 'max_queue_size', 'high_water_mark',
+                        'dropped', 'samples_written', 'bytes_written',
+                        'flushes', 'flush_seconds_mean', 
+                        'flush_seconds_max'} or None}
+            where period statistics are described in TimeInfo, 'age' 
+            is the number of seconds since 'last_seen',
+            'locations' maps each location to the number of samples
+            heard there and 'messages_per_second' is measured over
+            the last RATE_WINDOW seconds of snapshots (None for the 
+            first snapshot).
+        """
+        
+        now = _clock()
+        sensors = [sensor.snapshot(now) 
+                   for sensor in CurrentCost.sensors.values()
+                   if sensor.time_info.count >= 0]
+        sensors.sort(key=lambda sensor: (sensor['radio_id'],
+                                         sensor['sens_chan']))
+        
+        messages = dict((current_cost.port, current_cost.messages)
+                        for current_cost in self.current_costs)
+        rates = self._message_rates(now, messages)
+        current_costs = []
+        for current_cost in self.current_costs:
+            reconnector = current_cost.reconnector
+            current_costs.append({'port': current_cost.port, 
+                                  'dsb': current_cost.dsb,
+                                  'version': current_cost.cc_version,
+                                  'messages': current_cost.messages,
+                                  'messages_per_second': 
+                                      rates[current_cost.port],
+                                  'hist_messages': current_cost.hist_messages,
+                                  'parse_errors': current_cost.parse_errors,
+                                  'retries': current_cost.retries,
+                                  'reconnects': None if reconnector is None
+                                      else reconnector.reconnects,
+                                  'outages': None if reconnector is None
+                                      else reconnector.outages,
+                                  'connected': None if reconnector is None
+                                      else int(reconnector.connected),
+                                  'downtime_seconds': None if reconnector is None
+                                      else reconnector.current_downtime,
+                                  'corrected_timestamps': 
+                                      None if current_cost.device_clock is None
+                                      else current_cost.device_clock.corrected})
+        
+        if _writer is None:
+            writer = None
+        else:
+            stats = _writer_pool.stats
+            writer = {'queue_depth': _writer.queue_depth,
+                      'max_queue_size': _writer.max_queue_size,
+                      'high_water_mark': _writer.high_water_mark,
+                      'dropped': _writer.dropped,
+                      'samples_written': stats.samples_written,
+                      'bytes_written': stats.bytes_written,
+                      'flushes': stats.flush_count,
+                      'flush_seconds_mean': stats.flush_latency_mean,
+                      'flush_seconds_max': stats.flush_latency_max}
+        
+        return {'time': now, 'current_costs': current_costs,
+                'sensors': sensors, 'writer': writer}
+    
+    def _message_rates(self, now, messages):
+        """Return messages per second for each port since the oldest
+        snapshot within the last RATE_WINDOW seconds.
+        
+        Args:
+            now (float): time of this snapshot.
+            messages (dict): port -> CurrentCost.messages
+        
+        Returns:
+            dict: port -> rate, or None if the port wasn't in the older
+            snapshot.
+        """
+        
+        with self._rate_lock:
+            history = self._message_history
+            history.append((now, messages))
+            while (len(history) > 2 and 
+                   now - history[1][0] >= Manager.RATE_WINDOW):
+                history.popleft()
+            then, old_messages = history[0]
+        
+        rates = {}
+        for port, count in messages.iteritems():
+            if now <= then or port not in old_messages:
+                rates[port] = None
+            else:
+                rates[port] = (count - old_messages[port]) / (now - then)
+        return rates
 
     def stop(self):
         """Gracefully attempt to bring the system to a halt.
@@ -531,20 +1413,69 @@ class Manager(object):
         Specifically we ask every CurrentCost thread to stop 
         by setting '_abort' to True and then we wait patiently
         for every CurrentCost to return from its last blocked read.
+        (The SelectEngine, if used, is woken up so stops immediately.)
+        Finally, buffered data is flushed and fsync'd to disk.
         
         """
 
+        # Don't add any more Current Costs
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+        
         # Don't exit the main thread until our
         # worker CurrentCost threads have all quit
+        if self.engine is not None:
+            print_to_stdout_and_log("Waiting for {} engine to stop..."
+                                    .format(self.args.engine))
+            self.engine.stop()
+        
         for currentCost in self.current_costs:
+            if not currentCost.is_alive():
+                continue
             print_to_stdout_and_log("Waiting for monitor {} to stop..."
                                    .format(currentCost.port))
             currentCost.join()        
+        
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        
+        if self.stats_exporter is not None:
+            self.stats_exporter.stop()
+        
+        if CurrentCost.history is not None:
+            CurrentCost.history.stop()
+        
+        # Drain the write queue then flush and fsync every channel file
+        if _writer is not None:
+            print_to_stdout_and_log("Flushing data to disk...")
+            _writer.stop()
             
     def __str__(self):
         string = ""             
         for current_cost in self.current_costs:
             string += str(current_cost)
+        
+        return string + self.summary()
+    
+    def summary(self):
+        """Return statistics about the registry, writer and rollups."""
+        
+        string = "REGISTRY: {}\n".format(CurrentCost.sensors)
+        if _writer is not None:
+            string += "WRITER: {}\n        {}\n".format(_writer,
+                                                       _writer_pool.stats)
+            if _writer.rollups is not None:
+                string += "ROLLUP: {}\n".format(_writer.rollups)
+            if _writer.journal is not None:
+                string += "JOURNAL: {}\n".format(_writer.journal)
+            if _writer.compressor is not None:
+                string += "COMPRESSOR: {}\n".format(_writer.compressor)
+        if CurrentCost.history is not None:
+            string += "HISTORY: {}\n".format(CurrentCost.history)
+        if self.config_watcher is not None:
+            string += "CONFIG WATCHER: {}\n".format(self.config_watcher)
+        if isinstance(self.engine, ProcessEngine):
+            string += "PROCESSES: {}\n".format(self.engine)
             
         return string
 
@@ -554,13 +1485,25 @@ class CurrentCost(threading.Thread):
     
     Static attributes:
     
-        sensors: dict of all Sensors, keyed by (radio_id, sens_chan)
+        sensors (SensorRegistry): all Sensors, keyed by (radio_id, sens_chan)
 
         MAX_SENSORS_PER_TRANSMITTER (int) : the transmitters for the 
             CT clamps can take 3 CT clamps per TX        
 
-        MAX_RETRIES (int): maximum number of times to re-try connecting to
-            the serial port before giving up.
+        RECONNECT_BASE, RECONNECT_CAP (float): the shortest and longest
+            seconds (before jitter) to wait between attempts to re-open
+            a failed serial port.  Attempts continue until the logger
+            stops.
+        
+        WATTS_KEYS (tuple): the XML elements holding watts for each 
+            sensor channel (MAX_SENSORS_PER_TRANSMITTER of them).
+        
+        UPDATE_KEYS (tuple): the XML elements needed by update()
+        
+        timestamps (str): 'host' to timestamp samples with the host's
+            clock when they are read, or 'device' to use each Current
+            Cost's <time> (see device_clock.DeviceClock).  Set by the 
+            --timestamps command line option.
     
     Attributes:
     
@@ -574,34 +1517,93 @@ class CurrentCost(threading.Thread):
         local_sensors (dict): Dict of Sensors on this CurrentCost,
             keyed by (cc_channel, sens_chan)
             
-        dsb (str): Days since birth. Only set after calling get_info().
+        dsb (str): Days since birth.  None until the first <msg> is read.
+        
+        cc_version (string): CurrentCost version number.  None until the
+            first <msg> is read.
+        
+        messages (int): number of <msg> lines used to update sensors.
+        
+        hist_messages (int): number of histogram messages skipped.
+        
+        parse_errors (int): number of lines of malformed XML.
+        
+        retries (int): number of attempts to re-open the serial port.
         
-        cc_version (string): CurrentCost version number.  Only set after
-            calling get_info().
+        reconnector (reconnect.Reconnector): backoff, stable device
+            identifier and reconnect statistics for the serial port.
+        
+        device_clock (device_clock.DeviceClock): converts <time> to unix
+            time if timestamps is 'device', otherwise None.
     
     """
 
-    sensors = {}
+    sensors = SensorRegistry()
     MAX_SENSORS_PER_TRANSMITTER = 3 
-    MAX_RETRIES = 10
-
-    def __init__(self, port):
-        self.port = port        
-        threading.Thread.__init__(self, name="cc_"+port)
-        self.print_xml = False
-        self.serial = None
-        self.local_sensors = {}
+    RECONNECT_BASE = 1
+    RECONNECT_CAP = 60
+    WATTS_KEYS = ('ch1/watts', 'ch2/watts', 'ch3/watts')
+    UPDATE_KEYS = ('id', 'sensor', 'time') + WATTS_KEYS
+    INFO_KEYS = UPDATE_KEYS + ('dsb', 'src') # until dsb and cc_version are known
+    timestamps = 'host'
+    history = None # history.HistoryIngester. Set by load_config()
+
+    def __init__(self, port, abort_on_error=True, open_port=True):
+        """
+        Args:
+            port (str): serial port e.g. "/dev/ttyUSB0"
+        
+        Kwargs:
+            abort_on_error (bool): if the port can't be opened then stop
+                the whole logger (as well as raising).
+            
+            open_port (bool): open the serial port now.  If False the
+                caller opens it (see WorkerEngine).
+        """
+        
+        self.port = port        
+        threading.Thread.__init__(self, name="cc_"+port)
+        self.print_xml = False
+        self.serial = None
+        self.local_sensors = {}
+        self._init_counters()
+        self.reconnector = reconnect.Reconnector(port,
+                                                 CurrentCost.RECONNECT_BASE,
+                                                 CurrentCost.RECONNECT_CAP)
+        if not open_port:
+            return
 
         try:
             self._open_port()
         except (OSError, serial.SerialException), e:
-            _abort_now(exception=e)
+            if abort_on_error:
+                _abort_now(exception=e)
             raise
-        
-        self._get_info()
 
-    def _open_port(self):
-        """Open the serial port."""
+    def _init_counters(self):
+        # Only ever incremented by the thread reading this Current Cost
+        self.messages = 0
+        self.hist_messages = 0
+        self.parse_errors = 0
+        self.retries = 0
+        # Filled in from the first <msg> rather than waiting for it here
+        self.dsb = None
+        self.cc_version = None
+        if CurrentCost.timestamps == 'device':
+            self.device_clock = device_clock.DeviceClock()
+        else:
+            self.device_clock = None
+
+    def _open_port(self, path=None):
+        """Open the serial port.
+        
+        Kwargs:
+            path (str): the device to open, if not self.port (e.g. because
+                the port has been re-enumerated under a new name).
+        """
+        
+        if path is None:
+            path = self.port
         
         if self.serial is not None and self.serial.isOpen():
             logging.info("SERIAL: Closing serial port {}\n".format(self.port))
@@ -610,17 +1612,18 @@ class CurrentCost(threading.Thread):
             except Exception:
                 pass
          
-        logging.info("SERIAL: Opening serial port {}".format(self.port))
+        logging.info("SERIAL: Opening serial port {}".format(path))
         
         try:
-            self.serial = serial.Serial(self.port, 57600)
+            self.serial = serial.Serial(path, 57600)
         except (OSError, serial.SerialException), e:
             self._handle_serial_port_error(e)
             raise
         else:
-            logging.info("SERIAL: Opened serial port {}".format(self.port))            
+            logging.info("SERIAL: Opened serial port {}".format(path))            
         
         self.serial.flushInput()
+        self.reconnector.opened(path)
 
     def _handle_serial_port_error(self, error):
         if isinstance(error, OSError):
@@ -638,7 +1641,12 @@ class CurrentCost(threading.Thread):
         try:
             if self.print_xml: # Just print XML to the screen
                 while not _abort:
-                    print(str(self.port), self.readline(), sep="\n")
+                    try:
+                        line = self.readline()
+                    except (OSError, serial.SerialException, ValueError), e:
+                        self.reconnect(e)
+                    else:
+                        print(str(self.port), line, sep="\n")
             else:            
                 while not _abort:
                     self.update()
@@ -669,29 +1677,53 @@ class CurrentCost(threading.Thread):
         
         return line
 
-    def reset_serial(self, retry_attempt):
-        """Reset the serial port.
+    def try_reconnect(self):
+        """Make one attempt to re-open the serial port, without waiting.
         
-        Args:
-            retry_attempt (int): current retry number
+        Opens whichever device the port's stable identifier (if any)
+        now points to.
         
+        Returns:
+            True if the port is open.
         """ 
                    
-        time.sleep(1) 
-        logging.warning("SERIAL: retrying... retry number {} of {}\n"
-              .format(retry_attempt, CurrentCost.MAX_RETRIES))
-            
-        # Try to flush the serial port.
-        try:
-            self.serial.flushInput()
-        except Exception: # Ignore errors.  We're going to retry anyway.
-            pass
-            
-        # Try to re-open the port.
+        self.retries += 1
+        path = self.reconnector.next_path()
+        if path != self.reconnector.path:
+            logging.warning("SERIAL: {} ({}) is now {}"
+                            .format(self.port, self.reconnector.device_id,
+                                    path))
+        
+        # Ignore errors.  We're going to retry anyway.
+        attempts = self.reconnector.backoff.attempts
         try:
-            self._open_port()
-        except Exception: # Ignore errors.  We're going to retry anyway.
-            pass
+            self._open_port(path)
+        except Exception:
+            return False
+        logging.warning("SERIAL: reconnected {} after {} attempts"
+                        .format(self.port, attempts))
+        return True
+    
+    def reconnect(self, error):
+        """Re-open the serial port after error, waiting with jittered
+        exponential backoff between attempts.  Only this CurrentCost's
+        thread waits; other ports carry on.
+        
+        Returns:
+            True if the port is open, False if the logger is stopping.
+        """
+        
+        self.reconnector.failed(error)
+        while not _abort:
+            delay = self.reconnector.delay()
+            logging.warning("SERIAL: retrying {} in {:.1f}s (attempt {})"
+                            .format(self.port, delay,
+                                    self.reconnector.backoff.attempts))
+            if _abort_event.wait(delay):
+                break
+            if self.try_reconnect():
+                return True
+        return False
         
     def read_xml(self, data):
         """Reads a line from the serial port and processes XML. 
@@ -701,53 +1733,42 @@ class CurrentCost(threading.Thread):
             
         Returns:
             data dict is returned with the correct fields
-            filled in from the XML.
-            
-        Raises:
-            IAMLoggerError: if we fail after CurrentCost.MAX_RETRIES.
+            filled in from the XML, or None if the logger is stopping.
         
         """
 
-        for retry_attempt in range(CurrentCost.MAX_RETRIES):
+        while not _abort:
             try:
                 line = self.readline()
-                tree = ET.XML(line)
-            except (OSError, serial.SerialException, ValueError): 
+                fields = cc_parser.parse(line, data.keys())
+            except (OSError, serial.SerialException, ValueError), e: 
                 # raised by readline()
-                self.reset_serial(retry_attempt)
+                self.reconnect(e)
             except ET.ParseError, e: 
                 # Catch XML errors (occasionally the _current cost 
                 # outputs malformed XML)
+                self.parse_errors += 1
                 logging.warning('XML error:\n{}\n{}'.format(str(e), line))
             else:
-                # Check if this is histogram data from the _current cost
-                # (which we're not interested in)
-                # (This could also be done by checking the size of 'line' 
-                # - this would probably be faster although
-                #  possibly the size of a "histogram" is variable)
-                if tree.findtext('hist') is not None:
+                # Histogram data from the _current cost is handed to
+                # the history thread (if any).
+                if fields is None:
+                    self.hist_messages += 1
+                    self._put_history(line, _clock())
                     continue
                 
-                for key in data.keys():
-                    data[key] = tree.findtext(key)
-                    
+                data.update(fields)
                 return data                                
-        
-        # If we get to here then we have failed after every retry    
-        raise IAMLoggerError('read_xml failed after {} retries'
-                             .format(CurrentCost.MAX_RETRIES))
+        return None
 
-    def _get_info(self):
-        """Get DSB (days since birth) and version
-        number from Current Cost monitor.
-        
-        """
-        data            = self.read_xml({'dsb': None, 'src': None})
-        self.dsb        = data['dsb'] 
-        self.cc_version = data['src']
+    def _keys(self):
+        """The keys to parse from each <msg>."""
+        if self.dsb is None:
+            return CurrentCost.INFO_KEYS
+        return CurrentCost.UPDATE_KEYS
 
     def update(self):
-        """Read data from serial port and update relevant sensor.
+        """Read data from serial port and update relevant sensors.
         
         If data from serial port reveals a novel Sensor with a radio ID
         we have not seen before then create a new Sensor (with not label
@@ -755,47 +1776,112 @@ class CurrentCost(threading.Thread):
         """
 
         # For Current Cost XML details, see currentcost.com/cc128/xml.htm
-        data = {'id': None, 'sensor': None, 'ch1/watts': None,
-                'ch2/watts': None, 'ch3/watts': None}
+        data = dict.fromkeys(self._keys())
         data = self.read_xml(data)
+        if data is not None:
+            self.process(data)
+
+    def handle_line(self, line):
+        """Process a line of XML which has already been read.
+        
+        Used by SelectEngine, which does its own reading.  Malformed
+        XML is ignored and histogram messages go to the history thread.
+        """
+        
+        try:
+            data = cc_parser.parse(line, self._keys())
+        except ET.ParseError, e:
+            self.parse_errors += 1
+            logging.warning('XML error:\n{}\n{}'.format(str(e), line))
+            return
+        
+        if data is None:
+            self.hist_messages += 1
+            self._put_history(line, _clock())
+        else:
+            self.process(data)
+
+    def _put_history(self, line, host_time):
+        """Hand a <hist> line read at host_time to the history thread."""
+
+        if CurrentCost.history is not None:
+            CurrentCost.history.put(line, host_time, self,
+                                    None if self.device_clock is None
+                                    else self.device_clock.offset)
+
+    def process(self, data, host_time=None):
+        """Update the relevant sensors from parsed <msg> data.
+        
+        Args:
+            data (dict): text of each of CurrentCost.UPDATE_KEYS (and
+                INFO_KEYS until dsb is known)
+        
+        Kwargs:
+            host_time (float): unix time the line was read, if it was
+                read earlier (e.g. by a ProcessEngine worker).  None if
+                it has just been read.
+        """
+        
+        if self.dsb is None and data.get('dsb') is not None:
+            self.dsb = data['dsb']
+            self.cc_version = data.get('src')
+        
         # radio_id, hopefully unique to an IAM (but not necessarily unique):
         radio_id   = int(data['id'])
         cc_channel = int(data['sensor']) # channel on this Current Cost
-        watts      = []
-        for sens_chan in range(1, CurrentCost.MAX_SENSORS_PER_TRANSMITTER+1):
-            chXwatts_str = 'ch{:d}/watts'.format(sens_chan)
-            chXwatts     = data[chXwatts_str]
-            # convert watts to ints
-            if chXwatts is not None:
-                chXwatts = int(chXwatts)
-            watts.append(chXwatts)
-        
-        lock = threading.Lock()
+        registry   = CurrentCost.sensors
+        self.messages += 1
+        if self.device_clock is None:
+            timestamp = host_time
+        else:
+            timestamp = self.device_clock.timestamp(data['time'],
+                            _clock() if host_time is None else host_time)
         
         # sens_chan = sensor channel (e.g. multiple CT clamps)
-        for sens_chan in range(1,CurrentCost.MAX_SENSORS_PER_TRANSMITTER+1): 
-            if watts[sens_chan-1] is not None:
-                key = (radio_id, sens_chan)
-                if key not in CurrentCost.sensors.keys():
-                    logging.info("CURRENTCOST: making new Sensor for radio ID {} and sens_chan {}"
-                         .format(radio_id, sens_chan))
-                    lock.acquire()
-                    CurrentCost.sensors[key] = Sensor(radio_id, sens_chan)
-                    lock.release()
-        
-                lock.acquire()
-                CurrentCost.sensors[key].update(watts[sens_chan-1], sens_chan, cc_channel, self)
+        for sens_chan, chXwatts_str in enumerate(CurrentCost.WATTS_KEYS, 1):
+            chXwatts = data[chXwatts_str]
+            if chXwatts is None:
+                continue
+        
+            key = (radio_id, sens_chan)
+            sensor = registry.get(key)
+            if sensor is None:
+                sensor = registry.get_or_create(key,
+                             lambda: self._new_sensor(radio_id, sens_chan))
+        
+            # Other CurrentCosts may be updating this sensor too
+            lock = registry.acquire(key)
+            try:
+                sensor.update(int(chXwatts), sens_chan, cc_channel, self,
+                              timestamp)
+            finally:
                 lock.release()
         
-                # Maintain a local dict of sensors connected to this current cost
-                self.local_sensors[(cc_channel, sens_chan)] = CurrentCost.sensors[key]
+            # Maintain a local dict of sensors connected to this current cost
+            self.local_sensors[(cc_channel, sens_chan)] = sensor
 
-    def __str__(self):
+    def _new_sensor(self, radio_id, sens_chan):
+        logging.info("CURRENTCOST: making new Sensor for radio ID {} and sens_chan {}"
+                     .format(radio_id, sens_chan))
+        return Sensor(radio_id, sens_chan)
+
+    def header(self):
+        """Return the text displayed above this CurrentCost's sensor rows."""
+        
         string  = "port      = {}\n".format(self.port)        
         string += "DSB       = {}\n".format(self.dsb)
-        string += "Version   = {}\n\n".format(self.cc_version)    
-        string += " "*41 + "|---PERIOD STATS (secs)---|\n"
+        string += "Version   = {}\n".format(self.cc_version)
+        if self.reconnector is not None:
+            string += "Serial    = {}\n".format(self.reconnector)
+        if self.device_clock is not None:
+            string += "Clock     = {}\n".format(self.device_clock)
+        string += "\n"
+        string += " "*41 + "|{:-^46}|\n".format("PERIOD STATS (secs)")
         string += Sensor.HEADERS
+        return string
+
+    def __str__(self):
+        string = self.header()
         
         cc_channels = self.local_sensors.keys() # keyed by (cc_channel number, sensor chan)
         cc_channels.sort()
@@ -809,11 +1895,867 @@ class CurrentCost(threading.Thread):
         return string
 
 
+class SelectEngine(threading.Thread):
+    """Read every CurrentCost's serial port from a single thread.
+    
+    An alternative to running one thread per CurrentCost (which blocks
+    in serial.readline()).  Serial ports are made non-blocking and
+    watched with select(); this thread frames lines itself and hands
+    each one to the CurrentCost it came from.  stop() wakes the loop
+    straight away rather than waiting for the next line to arrive.
+    
+    A port which fails is dropped from select() and re-opened later (see
+    CurrentCost.try_reconnect), with backoff delays used as select()
+    timeouts, so the other ports are read without interruption.
+    
+    Attributes:
+    
+        current_costs (list): CurrentCost objects.  Their threads are
+            not started.
+    
+    """
+    
+    MAX_LINE_LENGTH = 65536 # discard data with no newline beyond this
+    
+    def __init__(self, current_costs):
+        threading.Thread.__init__(self, name="select_engine")
+        self.current_costs = current_costs
+        self._added = Queue.Queue() # CurrentCosts to start reading
+        self._buffers = {} # fd -> bytes received after the last newline
+        self._reconnect_at = {} # CurrentCost -> time of next attempt
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+    
+    def run(self):
+        try:
+            ports = {}
+            for current_cost in self.current_costs:
+                self._watch(ports, current_cost)
+            
+            while not _abort and (ports or self._reconnect_at):
+                try:
+                    readable = select.select(ports.keys() + [self._wake_r],
+                                             [], [], self._timeout())[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                
+                for fd in readable:
+                    if fd == self._wake_r:
+                        self._wake_up(ports)
+                        continue
+                    try:
+                        self._read(fd, ports[fd])
+                    except (OSError, serial.SerialException), e:
+                        current_cost = ports.pop(fd)
+                        del self._buffers[fd]
+                        current_cost._handle_serial_port_error(e)
+                        current_cost.reconnector.failed(e)
+                        self._schedule_reconnect(current_cost)
+                
+                self._reconnect_due(ports)
+            
+            if not _abort:
+                raise IAMLoggerError('SELECT: no serial ports to read')
+        except Exception, e: # catch any exception
+            _abort_now(exception=e)
+            raise
+    
+    def _watch(self, ports, current_cost):
+        fd = current_cost.serial.fileno()
+        _set_nonblocking(fd)
+        ports[fd] = current_cost
+        self._buffers[fd] = ''
+    
+    def _wake_up(self, ports):
+        """Empty the wake pipe and watch any CurrentCosts given to add()."""
+        
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while True:
+            try:
+                self._watch(ports, self._added.get_nowait())
+            except Queue.Empty:
+                break
+    
+    def add(self, current_cost):
+        """Start reading another CurrentCost.  Called from other threads."""
+        
+        self._added.put(current_cost)
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass # pipe full: the loop is already awake
+    
+    def _read(self, fd, current_cost):
+        """Read what is available from fd and process any complete lines."""
+        
+        try:
+            data = os.read(fd, 4096)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        if not data:
+            raise OSError(errno.EIO, 'serial port closed')
+        
+        lines = (self._buffers[fd] + data).split('\n')
+        self._buffers[fd] = lines.pop() # incomplete last line
+        if len(self._buffers[fd]) > SelectEngine.MAX_LINE_LENGTH:
+            logging.warning("SELECT: discarding {} bytes with no newline from {}"
+                            .format(len(self._buffers[fd]), current_cost.port))
+            self._buffers[fd] = ''
+        
+        for line in lines:
+            if line.strip():
+                self._handle_line(current_cost, line)
+    
+    def _handle_line(self, current_cost, line):
+        if current_cost.print_xml:
+            print(str(current_cost.port), line, sep="\n")
+        else:
+            current_cost.handle_line(line)
+    
+    def _schedule_reconnect(self, current_cost):
+        delay = current_cost.reconnector.delay()
+        logging.warning("SELECT: retrying {} in {:.1f}s".format(
+                        current_cost.port, delay))
+        self._reconnect_at[current_cost] = time.time() + delay
+    
+    def _timeout(self):
+        """Return seconds select() may wait, or None to wait for input."""
+        
+        if not self._reconnect_at:
+            return None
+        return max(0, min(self._reconnect_at.values()) - time.time())
+    
+    def _reconnect_due(self, ports):
+        """Make one attempt to re-open each port whose delay has passed."""
+        
+        now = time.time()
+        for current_cost, when in self._reconnect_at.items():
+            if when > now:
+                continue
+            if current_cost.try_reconnect():
+                del self._reconnect_at[current_cost]
+                self._watch(ports, current_cost)
+            else:
+                self._schedule_reconnect(current_cost)
+    
+    def stop(self):
+        """Wake the event loop (so it notices _abort) and wait for it."""
+        
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass # pipe full: the loop is already awake
+        self.join()
+
+
+class SampleOutbox(list):
+    """Stands in for the WriterThread (_writer) in a ProcessEngine worker.
+    
+    Collects (chan, timecode, watts) samples to send to the main process.
+    
+    """
+    
+    def put(self, chan, timecode, watts):
+        self.append((chan, timecode, watts))
+
+
+class HistoryOutbox(list):
+    """Stands in for the HistoryIngester in a ProcessEngine worker.
+    
+    Collects (line, host_time, clock_offset) to send to the main process.
+    
+    """
+    
+    def put(self, line, host_time, current_cost, clock_offset=None):
+        self.append((line, host_time, clock_offset))
+
+
+class WorkerEngine(SelectEngine):
+    """The SelectEngine of a ProcessEngine worker process.
+    
+    Lines are handled exactly as by a SelectEngine, updating this
+    process's copy of the Sensor registry, but the samples and <hist>
+    lines which would go to the writer and history threads are collected
+    in outboxes (see SampleOutbox and HistoryOutbox).  Everything read by
+    one os.read() is sent to the main process as one batch.  At most
+    every SYNC_SECONDS (and whenever a port is opened or fails) the
+    state of each Sensor which has been updated and the counters of
+    each port, which are only needed for display and export, are sent
+    too.
+    
+    Commands from the main process (new radio IDs, serial ports to add)
+    arrive over the same connection, which is watched in place of the
+    SelectEngine's wake pipe.
+    
+    """
+    
+    SYNC_SECONDS = 1
+    
+    def __init__(self, current_costs, connection, samples, hist_lines):
+        """
+        Args:
+            current_costs (list): CurrentCosts with open serial ports.
+            
+            connection (multiprocessing.Connection): to the main process.
+            
+            samples (SampleOutbox): the worker's _writer.
+            
+            hist_lines (HistoryOutbox): the worker's CurrentCost.history
+                (or None).
+        """
+        
+        SelectEngine.__init__(self, current_costs)
+        self.connection = connection
+        self.samples = samples
+        self.hist_lines = hist_lines
+        self._synced = {} # Sensor -> TimeInfo.count when last sent
+        self._last_sync = time.time()
+        self._unsynced = False # lines read since the last sync
+        # Commands wake the loop instead of the wake pipe
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._wake_r = connection.fileno()
+    
+    def run(self):
+        try:
+            SelectEngine.run(self)
+        finally:
+            self._sync()
+    
+    def _wake_up(self, ports):
+        """Carry out every command waiting on the connection."""
+        
+        while self.connection.poll():
+            try:
+                command = self.connection.recv()
+            except EOFError: # the main process has gone
+                _abort_now()
+                return
+            if command[0] == 'radio_ids':
+                _apply_radio_ids(command[1])
+            elif command[0] == 'add':
+                self._add(ports, *command[1:])
+    
+    def _add(self, ports, port, print_xml):
+        """Open and start reading a serial port added while running."""
+        
+        current_cost = CurrentCost(port, open_port=False)
+        current_cost.print_xml = print_xml
+        self.current_costs.append(current_cost)
+        try:
+            current_cost._open_port()
+        except (OSError, serial.SerialException):
+            self._schedule_reconnect(current_cost)
+        else:
+            self._watch(ports, current_cost)
+    
+    def _read(self, fd, current_cost):
+        SelectEngine._read(self, fd, current_cost)
+        self._send(current_cost)
+        self._unsynced = True
+    
+    def _timeout(self):
+        timeout = SelectEngine._timeout(self)
+        if self._unsynced:
+            sync_in = max(0, self._last_sync + WorkerEngine.SYNC_SECONDS -
+                             time.time())
+            if timeout is None or sync_in < timeout:
+                timeout = sync_in
+        return timeout
+    
+    def _reconnect_due(self, ports):
+        SelectEngine._reconnect_due(self, ports)
+        if (self._unsynced and
+            time.time() - self._last_sync >= WorkerEngine.SYNC_SECONDS):
+            self._sync()
+    
+    def _watch(self, ports, current_cost):
+        SelectEngine._watch(self, ports, current_cost)
+        self._sync()
+    
+    def _schedule_reconnect(self, current_cost):
+        SelectEngine._schedule_reconnect(self, current_cost)
+        self._sync()
+    
+    def _send(self, current_cost):
+        """Send the samples and <hist> lines read from current_cost."""
+        
+        hist_lines = [] if self.hist_lines is None else self.hist_lines
+        if not self.samples and not hist_lines:
+            return
+        self.connection.send(('batch', current_cost.port, self.samples,
+                              hist_lines))
+        del self.samples[:]
+        del hist_lines[:]
+    
+    def _sync(self):
+        """Send the counters of every port and the state of every Sensor
+        updated since the last sync."""
+        
+        counters = {}
+        for current_cost in self.current_costs:
+            reconnector = current_cost.reconnector
+            counters[current_cost.port] = {
+                'messages': current_cost.messages,
+                'parse_errors': current_cost.parse_errors,
+                'hist_messages': current_cost.hist_messages,
+                'retries': current_cost.retries,
+                'dsb': current_cost.dsb,
+                'cc_version': current_cost.cc_version,
+                'device_clock': current_cost.device_clock,
+                'reconnector': {'path': reconnector.path,
+                                'connected': reconnector.connected,
+                                'attempts': reconnector.attempts,
+                                'reconnects': reconnector.reconnects,
+                                'outages': reconnector.outages,
+                                'downtime': reconnector.current_downtime}}
+        
+        states = []
+        for current_cost in self.current_costs:
+            for sensor in set(current_cost.local_sensors.values()):
+                count = sensor.time_info.count
+                if count < 0 or self._synced.get(sensor) == count:
+                    continue # never updated, or unchanged
+                self._synced[sensor] = count
+                location = sensor.location
+                states.append(((sensor.radio_id, sensor.sens_chan),
+                               sensor.watts, sensor.time_info,
+                               (location.current_cost.port,
+                                location.cc_channel, location.sens_chan),
+                               [(loc.current_cost.port, loc.cc_channel,
+                                 loc.sens_chan, n)
+                                for loc, n in sensor.locations.iteritems()]))
+        self.connection.send(('sync', counters, states))
+        self._last_sync = time.time()
+        self._unsynced = False
+
+
+class ProcessEngine(threading.Thread):
+    """Read serial ports and update Sensors in worker processes.
+    
+    The serial ports are shared round-robin between forked worker
+    processes, each of which runs a WorkerEngine.  Workers do all of the
+    per-line and per-sensor work (reading, parsing, the device clock,
+    Sensor.update() and TimeInfo, the same-second duplicate check) on
+    their own copies of the Sensor registry, so it is spread over as
+    many cores as there are workers.
+    
+    This thread only merges what the workers send: batches of finished
+    (chan, timecode, watts) samples, which are passed to the writer in
+    one go (WriterThread.put_many), <hist> lines, which are passed to the
+    history thread, and, every WorkerEngine.SYNC_SECONDS, the counters
+    of each port and the state of each Sensor, which are copied into
+    this process for the display and stats.  The writer, channel files
+    and rollups are only ever touched by this process.
+    
+    A sensor heard by Current Costs in different workers is updated in
+    each of them, so both send its samples.  A sample is only written if
+    it is newer than the last one another worker wrote for its channel;
+    the others are counted as duplicates.  (With one thread per Current
+    Cost the same samples are discarded by Sensor.update().)
+    
+    Workers are only forked by start_workers(), before any other thread
+    is started (a fork while other threads run could copy a lock they
+    hold, e.g. logging's, into the worker).  Serial ports added while
+    running are opened by the worker with the fewest ports, and changes
+    to radioIDs.dat are sent to every worker (see apply_radio_ids).
+    
+    stop() sends each worker SIGTERM and then reads until every worker
+    has closed its connection, so nothing which has been read is lost.
+    
+    Attributes:
+    
+        current_costs (list): CurrentCost objects.  Their threads are
+            not started and their serial ports are closed in this
+            process; their counters are updated by this thread.
+        
+        batches (int): batches received from the workers.
+        
+        duplicates (int): samples not written because a newer (or the
+            same) sample had been written for their channel.
+    
+    """
+    
+    def __init__(self, current_costs, n_workers):
+        threading.Thread.__init__(self, name="process_engine")
+        self.current_costs = current_costs
+        self.n_workers = max(1, min(n_workers, len(current_costs)))
+        self.batches = 0
+        self.duplicates = 0
+        self._ports = dict((current_cost.port, current_cost)
+                           for current_cost in current_costs)
+        self._workers = {} # fd -> (connection, multiprocessing.Process)
+        self._port_counts = {} # fd -> number of ports the worker reads
+        self._last_written = {} # chan -> (timecode, worker fd) last written
+        self._stopping = False
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+    
+    def start_workers(self):
+        """Fork the worker processes.  Call before starting other threads."""
+        
+        for i in range(self.n_workers):
+            current_costs = self.current_costs[i::self.n_workers]
+            fd, worker = self._spawn(current_costs)
+            self._workers[fd] = worker
+            self._port_counts[fd] = len(current_costs)
+        logging.info("PROCESSES: {} worker processes reading {} serial ports"
+                     .format(self.n_workers, len(self.current_costs)))
+    
+    def _spawn(self, current_costs):
+        """Start a worker process for current_costs.
+        
+        Returns:
+            (fd, (connection, process))
+        """
+        
+        connection, worker_connection = multiprocessing.Pipe()
+        # The worker closes its copies of this process's ends, so each
+        # side sees EOF as soon as the other exits
+        inherited = [connection] + [other for other, process in
+                                    self._workers.values()]
+        process = multiprocessing.Process(
+                      target=ProcessEngine._worker,
+                      args=(current_costs, worker_connection, inherited),
+                      name="worker_" + "_".join(current_cost.port for 
+                                                current_cost in current_costs))
+        process.daemon = True
+        process.start()
+        worker_connection.close()
+        for current_cost in current_costs:
+            current_cost.serial.close() # the worker has its own copy
+        return connection.fileno(), (connection, process)
+    
+    @staticmethod
+    def _worker(current_costs, connection, inherited):
+        """The body of a worker process."""
+        
+        def stop(signal_number, frame):
+            global _abort
+            _abort = True
+            _abort_event.set()
+        
+        global _writer
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # stopped by the parent
+        signal.signal(signal.SIGTERM, stop)
+        for other in inherited:
+            other.close()
+        _writer = SampleOutbox()
+        if CurrentCost.history is not None:
+            CurrentCost.history = HistoryOutbox()
+        try:
+            WorkerEngine(current_costs, connection, _writer,
+                         CurrentCost.history).run()
+        finally:
+            connection.close()
+    
+    def run(self):
+        try:
+            while self._workers:
+                try:
+                    readable = select.select(self._workers.keys() +
+                                             [self._wake_r], [], [])[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                
+                for fd in readable:
+                    if fd == self._wake_r:
+                        self._wake_up()
+                    else:
+                        self._receive(fd)
+        except Exception, e: # catch any exception
+            _abort_now(exception=e)
+            raise
+    
+    def _wake_up(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def _receive(self, fd):
+        connection, process = self._workers[fd]
+        try:
+            message = connection.recv()
+        except EOFError:
+            del self._workers[fd]
+            connection.close()
+            process.join()
+            if not self._stopping:
+                raise IAMLoggerError('PROCESSES: {} exited with code {}'
+                                     .format(process.name, process.exitcode))
+            return
+        
+        if message[0] == 'batch':
+            self._merge_batch(fd, *message[1:])
+        else:
+            self._merge_sync(*message[1:])
+    
+    def _merge_batch(self, fd, port, samples, hist_lines):
+        """Write samples read from port by the worker on fd and pass on
+        its <hist> lines."""
+        
+        self.batches += 1
+        last_written = self._last_written
+        fresh = []
+        for sample in samples:
+            # Each worker has already discarded its own duplicates
+            chan, timecode = sample[0], sample[1]
+            last = last_written.get(chan)
+            if last is not None and last[1] != fd and timecode <= last[0]:
+                self.duplicates += 1
+                continue
+            last_written[chan] = (timecode, fd)
+            fresh.append(sample)
+        _writer.put_many(fresh)
+        
+        if CurrentCost.history is not None:
+            for line, host_time, clock_offset in hist_lines:
+                CurrentCost.history.put(line, host_time, self._ports[port],
+                                        clock_offset)
+    
+    def _merge_sync(self, counters, states):
+        """Copy the counters of a worker's ports and the state of its
+        Sensors into this process."""
+        
+        for port, port_counters in counters.iteritems():
+            current_cost = self._ports[port]
+            for key, value in port_counters.pop('reconnector').iteritems():
+                setattr(current_cost.reconnector, key, value)
+            for key, value in port_counters.iteritems():
+                setattr(current_cost, key, value)
+        
+        registry = CurrentCost.sensors
+        for key, watts, time_info, location, locations in states:
+            sensor = registry.get(key)
+            if sensor is None:
+                sensor = registry.get_or_create(key, lambda: Sensor(*key))
+            with registry.locked(key):
+                for port, cc_channel, sens_chan, count in locations:
+                    current_cost = self._ports[port]
+                    sensor.locations[Location.get(sens_chan, cc_channel,
+                                                  current_cost)] = count
+                    current_cost.local_sensors[(cc_channel, sens_chan)] = sensor
+                # A sensor heard in two workers shows the latest state
+                if time_info.last_seen >= sensor.time_info.last_seen:
+                    port, cc_channel, sens_chan = location
+                    sensor.time_info = time_info
+                    sensor.watts = watts
+                    sensor.location = Location.get(sens_chan, cc_channel,
+                                                   self._ports[port])
+    
+    def add(self, current_cost):
+        """Start reading another CurrentCost (whose port has been opened,
+        to check it can be).  Called from other threads.
+        
+        The port is closed here and re-opened by the worker reading the
+        fewest ports.  If it can't be, the worker retries it as it would
+        a port which had failed.
+        """
+        
+        current_cost.serial.close()
+        self._ports[current_cost.port] = current_cost
+        self.current_costs = self.current_costs + [current_cost]
+        fd = min(self._port_counts, key=self._port_counts.get)
+        self._port_counts[fd] += 1
+        self._workers[fd][0].send(('add', current_cost.port,
+                                   current_cost.print_xml))
+    
+    def apply_radio_ids(self, entries):
+        """Send radioIDs.dat entries (see _parse_radio_ids) to every worker.
+        Called from other threads."""
+        
+        for connection, process in self._workers.values():
+            connection.send(('radio_ids', entries))
+    
+    def stop(self):
+        """Stop the workers and wait for their last samples."""
+        
+        self._stopping = True
+        for connection, process in self._workers.values():
+            if process.is_alive():
+                process.terminate()
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+        self.join()
+    
+    def __str__(self):
+        return 'workers={} batches={} duplicates={}'.format(
+                   len(self._workers), self.batches, self.duplicates)
+
+
+class ConfigWatcher(threading.Thread):
+    """Apply changes to radioIDs.dat and config.xml without restarting.
+    
+    Polls the mtime and size of each file every interval seconds (so
+    needs nothing beyond the standard library, unlike inotify).  When
+    radioIDs.dat changes, load_radio_id_mapping() updates the Sensors in
+    place.  When config.xml changes, serial ports which have been added
+    are opened and started alongside the existing ones.  Other changes
+    to config.xml (e.g. the data directory) need a restart.
+    
+    A file which can't be parsed is logged and left in effect until it
+    changes again.
+    
+    Changes are detected against the signature each file had when it
+    was parsed at startup (see _signatures), so an edit made while the
+    ports were being opened is still applied.
+    
+    Attributes:
+    
+        reloads (int): number of changes applied.
+        
+        errors (int): number of changes which couldn't be applied.
+    
+    """
+    
+    FILENAMES = ('radioIDs.dat', 'config.xml')
+    
+    def __init__(self, manager, interval=5, signatures=None):
+        """
+        Args:
+            manager (Manager)
+        
+        Kwargs:
+            interval (float): seconds between polls.
+            
+            signatures (dict): filename -> (mtime, size) when the file was
+                last parsed (or None if it was missing).  Files not given
+                are compared against their signature now.
+        """
+        
+        threading.Thread.__init__(self, name="config_watcher")
+        self.daemon = True
+        self.manager = manager
+        self.interval = interval
+        self.reloads = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+        signatures = {} if signatures is None else signatures
+        self._signatures = dict((filename,
+                                 signatures[filename] if filename in signatures
+                                 else _file_signature(filename))
+                                for filename in ConfigWatcher.FILENAMES)
+    
+    def run(self):
+        while not self._stop_event.wait(self.interval) and not _abort:
+            for filename in ConfigWatcher.FILENAMES:
+                signature = _file_signature(filename)
+                if signature != self._signatures[filename]:
+                    self._signatures[filename] = signature
+                    self.reload(filename)
+    
+    def reload(self, filename):
+        logging.info("CONFIG WATCHER: {} changed".format(filename))
+        try:
+            if filename == 'radioIDs.dat':
+                entries = load_radio_id_mapping(filename)
+                engine = self.manager.engine
+                if entries is not None and isinstance(engine, ProcessEngine):
+                    engine.apply_radio_ids(entries)
+            else:
+                self.manager.add_serial_ports(load_serial_ports(filename))
+        except (IAMLoggerError, IOError, OSError, ET.ParseError), e:
+            self.errors += 1
+            logging.warning("CONFIG WATCHER: not applying {}: {}"
+                            .format(filename, e))
+        else:
+            self.reloads += 1
+    
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+    
+    def __str__(self):
+        return 'reloads={} errors={}'.format(self.reloads, self.errors)
+
+
+class ReplayCurrentCost(CurrentCost):
+    """A CurrentCost which reads recorded XML lines instead of a serial port.
+    
+    Lines are given to feed() and then consumed by readline() as
+    read_xml() asks for them.  No thread is started.
+    
+    """
+    
+    def __init__(self, port):
+        threading.Thread.__init__(self, name="replay_"+port)
+        self.port = port
+        self.print_xml = False
+        self.serial = None
+        self.local_sensors = {}
+        self._init_counters()
+        self.reconnector = None
+        self._lines = collections.deque()
+    
+    def feed(self, line):
+        self._lines.append(line)
+    
+    def readline(self):
+        try:
+            return self._lines.popleft()
+        except IndexError:
+            raise ReplayExhausted()
+
+
+class Replay(object):
+    """Push recorded Current Cost XML through the full logging pipeline.
+    
+    The recording can be the output of --print_xml (a line naming the
+    serial port before each line of XML) or just lines of XML.
+    
+    Sample timestamps come from a virtual clock which follows the
+    <time> in each message, starting from the time the replay started.
+    Messages are replayed as fast as possible or, if speed is given,
+    at speed times real time.
+    
+    Attributes:
+    
+        sources (dict): ReplayCurrentCost for each port, keyed by port.
+        
+        timer (StageTimer): time spent in each pipeline stage.
+    
+    """
+    
+    _TIME_RE = re.compile(r'<time>(\d\d):(\d\d):(\d\d)</time>')
+    
+    def __init__(self, filename, speed=0):
+        """
+        Args:
+            filename (str): file of recorded XML.
+        
+        Kwargs:
+            speed (float): replay speed multiplier. 0 = as fast as possible.
+        """
+        
+        self.filename = filename
+        self.speed = speed
+        self.sources = collections.OrderedDict()
+        self.timer = StageTimer()
+        self._virtual_time = time.time()
+        self._last_device_time = None
+    
+    def clock(self):
+        return self._virtual_time
+    
+    def _advance_clock(self, line):
+        """Move the virtual clock on to the <time> given in line.
+        
+        Returns:
+            the number of seconds the clock moved.
+        """
+        
+        match = Replay._TIME_RE.search(line)
+        if match is None:
+            return 0
+        hours, minutes, seconds = [int(field) for field in match.groups()]
+        device_time = hours*3600 + minutes*60 + seconds
+        if self._last_device_time is None:
+            delta = 0
+        else:
+            delta = device_time - self._last_device_time
+            if delta < -43200: # the device clock passed midnight
+                delta += 86400
+            if delta < 0: # out of order; don't move the clock backwards
+                return 0
+        self._last_device_time = device_time
+        self._virtual_time += delta
+        return delta
+    
+    def _instrument(self):
+        """Time each stage of the pipeline."""
+        
+        ReplayCurrentCost.read_xml = self.timer.wrap('read_xml',
+                                                     CurrentCost.read_xml)
+        ReplayCurrentCost.update = self.timer.wrap('CurrentCost.update',
+                                                   CurrentCost.update)
+        Sensor.update = self.timer.wrap('Sensor.update', Sensor.update)
+        Sensor.write_to_disk = self.timer.wrap('write_to_disk',
+                                               Sensor.write_to_disk)
+    
+    def run(self):
+        """Replay every line in the file.
+        
+        Returns:
+            a report (str) of throughput and per-stage latency.
+        """
+        
+        global _clock
+        _clock = self.clock
+        self._instrument()
+        _writer.start()
+        if CurrentCost.history is not None:
+            CurrentCost.history.start()
+        
+        port = 'replay'
+        n_messages = 0
+        start = time.time()
+        with open(self.filename) as fh:
+            for line in fh:
+                if _abort:
+                    break
+                if not line.lstrip().startswith('<'):
+                    if line.strip():
+                        port = line.strip()
+                    continue
+                
+                delta = self._advance_clock(line)
+                if self.speed and delta:
+                    time.sleep(delta / self.speed)
+                
+                source = self.sources.get(port)
+                if source is None:
+                    source = ReplayCurrentCost(port)
+                    self.sources[port] = source
+                source.feed(line)
+                n_messages += 1
+                try:
+                    source.update()
+                except ReplayExhausted:
+                    pass # histogram or malformed line: nothing to update
+        
+        pipeline_time = time.time() - start
+        drain_start = time.time()
+        if CurrentCost.history is not None:
+            CurrentCost.history.stop()
+        _writer.stop()
+        self.timer.add('writer drain', time.time() - drain_start)
+        elapsed = time.time() - start
+        
+        report  = "Replayed {} messages from {} port(s) in {:.3f}s\n".format(
+                                   n_messages, len(self.sources), elapsed)
+        report += "{:.0f} messages/sec through the reader threads' stages\n" \
+                  .format(n_messages / pipeline_time if pipeline_time else 0)
+        report += "{:.0f} messages/sec including writing to disk\n\n".format(
+                                   n_messages / elapsed if elapsed else 0)
+        report += str(self.timer)
+        report += "\nWRITER: {}\n        {}\n".format(_writer, _writer_pool.stats)
+        return report
+
+
 #==============================================================================
 # MAIN FUNCTION
 #==============================================================================
 
 def main():    
+    global _start_time
+    _start_time = time.time()
+    
     # Process command line args
     parser = argparse.ArgumentParser(description='Log data from multiple '
                                      'Current Cost IAMs.')
@@ -828,10 +2770,102 @@ def main():
                         'the monitor(s) to std out. Do not log data. '
                         '(May not work on Windows)')
     
+    parser.add_argument('--refresh', dest='refresh', type=float, default=1,
+                        help='Seconds between updates of the on-screen '
+                        'display (default: 1)')
+    
+    parser.add_argument('--sort', dest='sort', default='location',
+                        choices=sorted(Manager.SORT_KEYS), help='Order of '
+                        'sensors on screen (default: location, i.e. Current '
+                        'Cost sensor number then channel)')
+    
+    parser.add_argument('--stats_file', dest='stats_file', type=str,
+                        default='stats.dat', help='File to export statistics '
+                        'to. It is replaced atomically (default: stats.dat)')
+    
+    parser.add_argument('--stats_format', dest='stats_format', default='text',
+                        choices=stats_export.FORMATS, help='text: the table '
+                        'shown on screen. json: JSON. line: InfluxDB line '
+                        'protocol. prometheus: Prometheus text format '
+                        '(default: text)')
+    
+    parser.add_argument('--stats_interval', dest='stats_interval', type=float,
+                        default=60, help='Seconds between exports to '
+                        'STATS_FILE. 0 disables the export (default: 60)')
+    
+    parser.add_argument('--timestamps', dest='timestamps', default='host',
+                        choices=['host', 'device'], help='host: timestamp '
+                        'samples when they are read. device: use the Current '
+                        'Cost clock (corrected to the host clock) so samples '
+                        'read late, e.g. when the host is busy, keep their '
+                        'own times (default: host)')
+    
+    parser.add_argument('--gap_seconds', dest='gap_seconds', type=float,
+                        default=TimeInfo.GAP_SECONDS, help='Count a gap for a '
+                        'sensor whenever this many seconds pass between '
+                        'samples (default: {})'.format(TimeInfo.GAP_SECONDS))
+    
+    parser.add_argument('--metrics_port', dest='metrics_port', type=int,
+                        default=0, help='Serve Prometheus metrics on '
+                        'http://METRICS_HOST:METRICS_PORT/metrics and JSON on '
+                        '/metrics.json. 0 disables the server (default: 0)')
+    
+    parser.add_argument('--metrics_host', dest='metrics_host', type=str,
+                        default='127.0.0.1', help='Address for the metrics '
+                        'server to listen on (default: 127.0.0.1)')
+    
+    parser.add_argument('--reload_interval', dest='reload_interval',
+                        type=float, default=5, help='Seconds between checks '
+                        'for changes to radioIDs.dat and config.xml, which '
+                        'are applied without restarting. 0 disables '
+                        'reloading (default: 5)')
+    
+    parser.add_argument('--engine', dest='engine',
+                        choices=['threads', 'select', 'processes'],
+                        default='threads', help='threads: one thread per '
+                        'serial port. select: read every serial port from one '
+                        'event loop thread. processes: read serial ports and '
+                        'update sensors in --workers worker processes; this '
+                        'process only writes their samples (default: threads)')
+    
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes for --engine '
+                        'processes.  Serial ports are shared between them '
+                        '(default: number of CPUs)')
+    
+    parser.add_argument('--rebuild_index', dest='rebuild_index', type=str,
+                        default=None, metavar='DIRECTORY',
+                        help='Rebuild the time index for every channel_N.dat '
+                        'file in DIRECTORY then exit. Do not run this on a '
+                        'directory iam_logger is currently logging to.')
+    
+    parser.add_argument('--index_minutes', dest='index_minutes', type=int,
+                        default=60, help='Block length used by '
+                        '--rebuild_index (default: 60)')
+    
+    parser.add_argument('--replay', dest='replay', type=str, default=None,
+                        metavar='FILE', help='Instead of reading serial '
+                        'ports, push recorded XML (e.g. the output of '
+                        '--print_xml) through the logging pipeline then print '
+                        'a performance report.')
+    
+    parser.add_argument('--replay_speed', dest='replay_speed', type=float,
+                        default=0, help='Replay at this multiple of real '
+                        'time. 0 = as fast as possible (default: 0)')
+    
+    parser.add_argument('--replay_directory', dest='replay_directory',
+                        type=str, default='replay_output/', help='Directory '
+                        'to write replayed data to (default: replay_output/)')
+    
     parser.add_argument('--log', dest='loglevel', type=str, default='DEBUG',
                         help='DEBUG or INFO or WARNING (default: DEBUG)')
     
     args = parser.parse_args()
+    
+    if args.rebuild_index:
+        storage.rebuild_indexes(args.rebuild_index, args.index_minutes * 60)
+        return
 
     # Set up logging
     numeric_level = getattr(logging, args.loglevel.upper(), None)
@@ -846,6 +2880,17 @@ def main():
     
     logging.debug('\nMAIN: iam_logger.py starting up. Unixtime = {:.0f}'
                   .format(time.time()))
+    
+    TimeInfo.GAP_SECONDS = args.gap_seconds
+    CurrentCost.timestamps = args.timestamps
+
+    if args.replay:
+        load_config(open_serial_ports=False, directory=args.replay_directory)
+        recover_data()
+        signal.signal(signal.SIGINT,  _signal_handler)
+        print(Replay(args.replay, args.replay_speed).run())
+        logging.shutdown()
+        return
 
     # Check if iam_logger.py is being run using nohup
     if not os.isatty(sys.stdout.fileno()):
@@ -855,6 +2900,11 @@ def main():
 
     # load config files and initialise Current Costs
     current_costs = load_config()    
+    config_seconds = time.time() - _start_time
+    recover_data()
+    logging.info("MAIN: loaded config in {:.3f}s and recovered data in {:.3f}s"
+                 .format(config_seconds,
+                         time.time() - _start_time - config_seconds))
     
     # register SIGINT and SIGTERM handler
     logging.info("MAIN: setting signal handlers")
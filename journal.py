@@ -0,0 +1,274 @@
+"""Write-ahead journal so samples survive kill -9 and power cuts.
+
+The writer thread appends every batch of samples to <directory>/journal.wal
+before handing them to the ChannelWriterPool, which may hold them in
+memory for flush_interval seconds.  Each append is flushed to the OS
+straight away (so a killed process only loses samples still queued for
+the writer thread) and the journal is fsync'd at most once every
+commit_interval seconds (group commit), so a power cut also loses at
+most commit_interval seconds of journalled samples, without an fsync
+per sample.
+
+Once the channel files have been fsync'd (every checkpoint_seconds, or
+once the journal grows past checkpoint_bytes, and at shutdown) the
+journal is emptied.
+
+Each record is one line:
+
+    <chan> <timecode> <watts> <crc32 of the preceding text, in hex>
+
+so a torn or corrupt record at the end of the journal is detected and
+ignored.  recover() is run at startup, before the writer thread starts.
+It truncates torn lines from the channel files and then re-writes any
+journalled sample which is newer than the last sample in its channel
+file.
+
+Rollups are not journalled: the bucket open when the process died is
+lost (as it always has been).
+
+"""
+
+from __future__ import print_function, division
+import os
+import time
+import zlib
+import logging
+import storage
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class Journal(object):
+    """Append-only journal of (chan, timecode, watts) samples.
+
+    Only used by the writer thread, so not thread safe.
+
+    Attributes:
+
+        filename (str)
+
+        records (int): samples appended since startup.
+
+        commits (int): number of fsyncs.
+
+        checkpoints (int): number of times the journal has been emptied.
+
+    """
+
+    FILENAME = 'journal.wal'
+
+    def __init__(self, filename, commit_interval=1.0, checkpoint_seconds=600,
+                 checkpoint_bytes=1 << 20):
+        """
+        Args:
+            filename (str): usually <directory>/journal.wal.
+
+        Kwargs:
+            commit_interval (float): maximum seconds between fsyncs.
+                0 fsyncs after every batch.
+
+            checkpoint_seconds (float): empty the journal (after the
+                channel files have been fsync'd) this often.
+
+            checkpoint_bytes (int): or once the journal is this big.
+        """
+
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.checkpoint_seconds = checkpoint_seconds
+        self.checkpoint_bytes = checkpoint_bytes
+        self.records = 0
+        self.commits = 0
+        self.checkpoints = 0
+        self._fh = None # opened on the first append
+        self._size = 0
+        self._uncommitted = False
+        self._last_commit = time.time()
+        self._last_checkpoint = time.time()
+
+    def append(self, items):
+        """Append (chan, timecode, watts) tuples and hand them to the OS."""
+
+        if not items:
+            return
+        if self._fh is None:
+            self._fh = open(self.filename, 'ab')
+            self._size = os.fstat(self._fh.fileno()).st_size
+        data = ''.join([encode(*item) for item in items])
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+        self.records += len(items)
+        self._uncommitted = True
+
+    def commit(self):
+        """fsync everything appended so far."""
+
+        if self._uncommitted:
+            os.fsync(self._fh.fileno())
+            self.commits += 1
+            self._uncommitted = False
+        self._last_commit = time.time()
+
+    def commit_if_due(self):
+        if (self._uncommitted and
+            time.time() - self._last_commit >= self.commit_interval):
+            self.commit()
+
+    def checkpoint_due(self):
+        return (self._size >= self.checkpoint_bytes or
+                (self._size and
+                 time.time() - self._last_checkpoint >= self.checkpoint_seconds))
+
+    def checkpoint(self):
+        """Empty the journal.  Every sample appended so far must already
+        have been fsync'd to the channel files.
+
+        The truncation itself isn't fsync'd: if it is lost then recover()
+        skips samples which are already in the channel files.
+        """
+
+        if self._fh is not None and self._size:
+            self._fh.truncate(0)
+            self._size = 0
+            self._uncommitted = False
+            self.checkpoints += 1
+        self._last_checkpoint = time.time()
+
+    def close(self):
+        if self._fh is not None:
+            self.commit()
+            self._fh.close()
+            self._fh = None
+
+    def __str__(self):
+        return ('records={} commits={} checkpoints={} size={}B'
+                .format(self.records, self.commits, self.checkpoints,
+                        self._size))
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def encode(chan, timecode, watts):
+    text = '{} {:d} {}'.format(chan, timecode, watts)
+    return '{} {:08x}\n'.format(text, zlib.crc32(text) & 0xffffffff)
+
+
+def read(filename):
+    """Return (list of (chan, timecode, watts), number of bad bytes).
+
+    Reading stops at the first torn or corrupt record.
+    """
+
+    samples = []
+    good_bytes = 0
+    try:
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+    except IOError:
+        return samples, 0
+
+    for line in data.splitlines(True):
+        if not line.endswith('\n'):
+            break
+        try:
+            text, crc = line.rsplit(' ', 1)
+            if int(crc, 16) != zlib.crc32(text) & 0xffffffff:
+                break
+            chan, timecode, watts = text.split(' ')
+            samples.append((chan, int(timecode), int(watts)))
+        except ValueError:
+            break
+        good_bytes += len(line)
+    return samples, len(data) - good_bytes
+
+
+def recover(pool, journal=None):
+    """Repair pool's channel files after a crash and replay the journal.
+
+    Must be called before anything else writes to pool.
+
+    - Truncates torn last lines from text channel files and segments
+      (binary files have partial records truncated when the pool opens
+      them).
+    - Rebuilds time indexes which point beyond the end of their data.
+    - Writes journalled samples newer than the last sample already in
+      their channel file, fsyncs the channel files and empties the
+      journal.
+
+    Args:
+        pool (storage.ChannelWriterPool)
+
+    Kwargs:
+        journal (Journal): or None if journalling is disabled.
+
+    Returns:
+        dict with the number of 'torn_bytes' truncated from channel
+        files, 'rebuilt_indexes', journal 'records' read, 'bad_bytes'
+        at the end of the journal and 'replayed' samples.
+    """
+
+    result = {'torn_bytes': 0, 'rebuilt_indexes': 0, 'records': 0,
+              'bad_bytes': 0, 'replayed': 0}
+    text = isinstance(pool.backend, storage.TextBackend)
+
+    segments = storage.list_segments(pool.directory, pool.backend.EXTENSION)
+
+    if journal is not None:
+        samples, result['bad_bytes'] = read(journal.filename)
+        result['records'] = len(samples)
+        if result['bad_bytes']:
+            logging.warning("JOURNAL: ignoring {} bytes of torn or corrupt "
+                            "records at the end of {}"
+                            .format(result['bad_bytes'], journal.filename))
+    else:
+        samples = []
+
+    last_timecodes = {}
+    for chan, filenames in segments.iteritems():
+        # Only plain files can have been being written to
+        for filename in filenames:
+            if not text or filename.endswith(storage.COMPRESSED_EXTENSION):
+                continue
+            torn = storage.truncate_partial_line(filename)
+            if torn:
+                logging.warning("RECOVERY: truncated {} byte partial line "
+                                "from {}".format(torn, filename))
+                result['torn_bytes'] += torn
+            if pool.index_seconds and _index_is_stale(filename):
+                logging.warning("RECOVERY: rebuilding stale index for {}"
+                                .format(filename))
+                storage.rebuild_index(filename, pool.index_seconds)
+                result['rebuilt_indexes'] += 1
+        last_timecodes[chan] = storage.last_timecode(filenames[-1])
+
+    for chan, timecode, watts in samples:
+        last_timecode = last_timecodes.get(chan)
+        if last_timecode is None or timecode > last_timecode:
+            pool.write_sample(chan, timecode, watts)
+            last_timecodes[chan] = timecode
+            result['replayed'] += 1
+
+    if journal is not None:
+        pool.flush(fsync=True)
+        if os.path.exists(journal.filename):
+            with open(journal.filename, 'r+b') as fh:
+                fh.truncate(0)
+    return result
+
+
+def _index_is_stale(data_filename):
+    """True if the index of data_filename points beyond its data."""
+
+    index_filename = storage.TimeIndex.filename_for(data_filename)
+    try:
+        index = storage.TimeIndex.load(index_filename)
+    except (IOError, storage.StorageError):
+        return False # the pool starts a new index itself
+    return bool(index.offsets) and (index.offsets[-1] >=
+                                    os.path.getsize(data_filename))
@@ -0,0 +1,203 @@
+#! /usr/bin/python
+"""Merge channel files recorded by several iam_logger instances.
+
+A single IAM is often heard by more than one EnviR base unit so, when
+several loggers run in parallel, the same channel ends up in several
+channel_N.dat (or .bin) files.  merge() combines any number of these
+sources into a single series with one sample per timecode, using NumPy
+operations over whole arrays so millions of rows take seconds.
+
+When sources disagree about the watts at a timecode, the conflict is
+resolved using one of POLICIES:
+
+    first : take the value from the earliest source given (default)
+    max   : take the largest value
+    min   : take the smallest value
+    mean  : take the (rounded) mean value
+    error : raise MergeConflictError
+
+Usage:
+    ./merge_channels.py OUTPUT SOURCE [SOURCE ...] [--policy POLICY]
+
+OUTPUT is written in binary format if it ends with .bin, otherwise text.
+
+"""
+
+from __future__ import print_function, division
+import argparse
+import numpy as np
+import storage
+import channel_reader
+
+POLICIES = ('first', 'max', 'min', 'mean', 'error')
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class MergeConflictError(Exception):
+    """Raised by merge() with policy='error' when sources disagree."""
+
+
+class MergeReport(object):
+    """Statistics describing a merge.
+
+    Attributes:
+
+        rows_in (int): total samples across every source.
+
+        rows_out (int): samples in the merged series.
+
+        duplicates (int): timecodes seen more than once.
+
+        conflicts (int): timecodes where sources gave different watts.
+
+        rows_per_source (list): number of samples in each source.
+
+    """
+
+    def __init__(self, rows_per_source, rows_out, duplicates, conflicts):
+        self.rows_per_source = rows_per_source
+        self.rows_in = sum(rows_per_source)
+        self.rows_out = rows_out
+        self.duplicates = duplicates
+        self.conflicts = conflicts
+
+    def __str__(self):
+        return ('rows in={} (per source: {}) rows out={} duplicate timecodes={}'
+                ' conflicts={}'.format(self.rows_in, self.rows_per_source,
+                                       self.rows_out, self.duplicates,
+                                       self.conflicts))
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def merge_arrays(sources, policy='first'):
+    """Merge several (timecodes, watts) series into one.
+
+    Args:
+        sources (list): list of (timecodes, watts) array pairs, in order
+            of priority.
+
+    Kwargs:
+        policy (str): one of POLICIES.
+
+    Returns:
+        (timecodes, watts, report): int64 arrays sorted by timecode with
+        one sample per timecode, and a MergeReport.
+
+    Raises:
+        ValueError: if policy is not recognised.
+        MergeConflictError: if policy is 'error' and sources disagree.
+    """
+
+    if policy not in POLICIES:
+        raise ValueError("Unknown policy '{}'. Must be one of {}"
+                         .format(policy, POLICIES))
+
+    rows_per_source = [len(timecodes) for timecodes, watts in sources]
+    if sum(rows_per_source) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty.copy(), MergeReport(rows_per_source, 0, 0, 0)
+
+    timecodes = np.concatenate([np.asarray(t, dtype=np.int64)
+                                for t, w in sources])
+    watts = np.concatenate([np.asarray(w, dtype=np.int64) for t, w in sources])
+    priority = np.repeat(np.arange(len(sources)), rows_per_source)
+
+    # Sort by timecode then by source priority (lexsort's last key is primary)
+    order = np.lexsort((priority, timecodes))
+    timecodes = timecodes[order]
+    watts = watts[order]
+
+    # Index of the first row of each group of identical timecodes
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(timecodes)) + 1))
+    counts = np.diff(np.concatenate((starts, [len(timecodes)])))
+
+    group_max = np.maximum.reduceat(watts, starts)
+    group_min = np.minimum.reduceat(watts, starts)
+    conflicting = group_max != group_min
+    n_conflicts = int(np.count_nonzero(conflicting))
+
+    if policy == 'error' and n_conflicts:
+        first = timecodes[starts[conflicting][0]]
+        raise MergeConflictError("{} conflicting timecodes, first at {}"
+                                 .format(n_conflicts, first))
+
+    if policy == 'max':
+        merged_watts = group_max
+    elif policy == 'min':
+        merged_watts = group_min
+    elif policy == 'mean':
+        merged_watts = np.round(np.add.reduceat(watts, starts) / counts)
+        merged_watts = merged_watts.astype(np.int64)
+    else: # 'first' or 'error' (where every group agrees)
+        merged_watts = watts[starts]
+
+    report = MergeReport(rows_per_source, len(starts),
+                         int(np.count_nonzero(counts > 1)), n_conflicts)
+    return timecodes[starts], merged_watts, report
+
+
+def merge(filenames, policy='first', start=None, end=None):
+    """Merge several channel files into one series.
+
+    Args:
+        filenames (list): channel_N.dat or channel_N.bin files, in order
+            of priority.
+
+    Kwargs:
+        policy (str): one of POLICIES.
+        start, end (int): only merge samples with start <= timecode < end.
+
+    Returns:
+        (timecodes, watts, report). See merge_arrays().
+    """
+
+    sources = []
+    for filename in filenames:
+        with channel_reader.open_channel(filename) as reader:
+            sources.append(reader.read(start, end))
+    return merge_arrays(sources, policy)
+
+
+def save(filename, timecodes, watts):
+    """Write a series to filename (binary if it ends in .bin, else text)."""
+
+    if filename.endswith(storage.BinaryBackend.EXTENSION):
+        records = np.zeros(len(timecodes), dtype=storage.BinaryBackend.DTYPE)
+        records['timecode'] = timecodes
+        records['watts'] = watts
+        with open(filename, 'wb') as fh:
+            fh.write(storage.BinaryBackend.header())
+            records.tofile(fh)
+    else:
+        np.savetxt(filename, np.column_stack((timecodes, watts)), fmt='%d')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge channel files from '
+                                     'several iam_logger instances.')
+    parser.add_argument('output', help='merged file to write')
+    parser.add_argument('sources', nargs='+', help='channel files, in order '
+                        'of priority')
+    parser.add_argument('--policy', choices=POLICIES, default='first',
+                        help='how to resolve conflicts (default: first)')
+    parser.add_argument('--start', type=int, default=None,
+                        help='first unix timecode to include')
+    parser.add_argument('--end', type=int, default=None,
+                        help='unix timecode to stop before')
+    args = parser.parse_args()
+
+    timecodes, watts, report = merge(args.sources, args.policy,
+                                     args.start, args.end)
+    save(args.output, timecodes, watts)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
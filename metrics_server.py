@@ -0,0 +1,100 @@
+"""Embedded HTTP server exposing live metrics from iam_logger.
+
+Serves:
+
+    /metrics       Prometheus text exposition format
+    /metrics.json  the same snapshot as JSON
+
+Each request builds a fresh snapshot by calling the snapshot function
+given to MetricsServer (normally Manager.snapshot), which reads counters
+without taking any locks, so scrapes never hold up the threads reading
+the Current Costs.  Requests are handled one at a time on the server's
+own thread.  By default the server only listens on localhost.
+
+"""
+
+from __future__ import print_function, division
+import BaseHTTPServer
+import logging
+import threading
+import stats_export
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers GET requests for /metrics and /metrics.json."""
+
+    FORMATS = {'/metrics': (stats_export.to_prometheus,
+                            'text/plain; version=0.0.4'),
+               '/metrics.json': (stats_export.to_json, 'application/json')}
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path not in MetricsHandler.FORMATS:
+            self.send_error(404, "Try /metrics or /metrics.json")
+            return
+
+        formatter, content_type = MetricsHandler.FORMATS[path]
+        try:
+            body = formatter(self.server.snapshot())
+        except Exception:
+            logging.exception("METRICS: failed to build snapshot")
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.requests += 1
+
+    def log_message(self, format, *args):
+        logging.debug("METRICS: " + format % args)
+
+
+class MetricsServer(threading.Thread):
+    """Thread running an HTTP server for MetricsHandler.
+
+    Attributes:
+
+        address (tuple): (host, port) the server is listening on.
+
+    """
+
+    def __init__(self, snapshot, host='127.0.0.1', port=9090):
+        """
+        Args:
+            snapshot (callable): returns a snapshot dict (see
+                Manager.snapshot).
+
+        Kwargs:
+            host (str): address to listen on.
+            port (int): port to listen on.  0 picks a free port.
+
+        Raises:
+            socket.error: if the address can't be bound.
+        """
+
+        threading.Thread.__init__(self, name="metrics_server")
+        self.daemon = True
+        self._server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self._server.snapshot = snapshot
+        self._server.requests = 0
+        self.address = self._server.server_address
+
+    @property
+    def requests(self):
+        """Number of metrics requests served."""
+        return self._server.requests
+
+    def run(self):
+        self._server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self.join()
@@ -0,0 +1,128 @@
+"""Streaming quantile estimation in constant memory.
+
+P2Quantiles implements the extended P-square algorithm (Jain & Chlamtac,
+1985; Raatikainen, 1987).  It estimates several quantiles of a stream at
+once from 2m + 3 "markers" (for m quantiles), each of which is nudged
+towards its ideal position with a piecewise-parabolic fit as samples
+arrive.  Every update costs O(m) and no samples are stored once the
+first 2m + 3 have been seen.
+
+    estimator = P2Quantiles((0.5, 0.95, 0.99))
+    for x in samples:
+        estimator.add(x)
+    p50, p95, p99 = estimator.quantiles()
+
+"""
+
+from __future__ import print_function, division
+import math
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class P2Quantiles(object):
+    """Estimates fixed quantiles of a stream of numbers.
+
+    Attributes:
+
+        probabilities (tuple): the quantiles being estimated, e.g. 0.95.
+
+        count (int): number of samples added.
+
+    """
+
+    __slots__ = ('probabilities', 'count', '_heights', '_positions',
+                 '_increments')
+
+    def __init__(self, probabilities=(0.5, 0.95, 0.99)):
+        self.probabilities = tuple(sorted(probabilities))
+        self.count = 0
+
+        # Markers sit at the minimum, each quantile, half way between
+        # neighbouring quantiles and at the maximum.
+        increments = [0.0]
+        for p in self.probabilities:
+            increments.append((increments[-1] + p) / 2)
+            increments.append(p)
+        increments.append((increments[-1] + 1.0) / 2)
+        increments.append(1.0)
+        n_markers = len(increments)
+
+        self._increments = increments
+        self._heights = [] # the first n_markers samples, until they're sorted
+        self._positions = range(1, n_markers + 1)
+
+    def add(self, x):
+        """Add a sample."""
+
+        self.count += 1
+        heights = self._heights
+        n_markers = len(self._increments)
+
+        if self.count <= n_markers:
+            heights.append(x)
+            if self.count == n_markers:
+                heights.sort()
+            return
+
+        # Find the cell k containing x, extending the extremes if needed
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[-1]:
+            heights[-1] = x
+            k = n_markers - 2
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+
+        positions = self._positions
+        increments = self._increments
+        for i in xrange(k + 1, n_markers):
+            positions[i] += 1
+
+        # Move interior markers which are now more than one step away
+        # from their desired positions (1 + (count - 1) * increment)
+        steps = self.count - 1
+        for i in xrange(1, n_markers - 1):
+            d = 1 + steps * increments[i] - positions[i]
+            if ((d >= 1 and positions[i + 1] - positions[i] > 1) or
+                (d <= -1 and positions[i - 1] - positions[i] < -1)):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, d)
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        h = self._heights
+        n = self._positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+                   (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+                   (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, d):
+        h = self._heights
+        n = self._positions
+        return h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+
+    def quantiles(self):
+        """Return the current estimate of each quantile, in the order of
+        self.probabilities, or None for each if no samples have been added.
+        """
+
+        if self.count == 0:
+            return [None] * len(self.probabilities)
+
+        if self.count < len(self._increments):
+            # Not enough samples for the markers yet: use the nearest rank
+            samples = sorted(self._heights)
+            return [samples[max(0, int(math.ceil(p * len(samples))) - 1)]
+                    for p in self.probabilities]
+
+        return [self._heights[2 * (i + 1)]
+                for i in range(len(self.probabilities))]
@@ -0,0 +1,190 @@
+"""Reconnect serial ports with jittered exponential backoff.
+
+When a Current Cost's serial port fails (e.g. the USB cable is pulled)
+only that port is affected: it waits for a backoff delay and tries
+again, for as long as the logger runs.  Other ports carry on reading.
+
+Delays double after each failed attempt, from base up to cap seconds,
+and are jittered (each is a random point in the upper half of the
+current delay) so several ports which fail together don't retry in
+lock-step.  The delay resets once a port reconnects.
+
+USB serial adapters can come back under a different name (/dev/ttyUSB0
+may return as /dev/ttyUSB1).  When a port is first opened its stable
+identifier is looked up in /dev/serial/by-id (which udev populates from
+the adapter's vendor, product and serial number) and reconnects open
+whichever device that identifier now points to.  If the port has no
+such identifier, the configured name is re-opened.
+
+"""
+
+from __future__ import print_function, division
+import os
+import random
+import time
+
+BY_ID_DIRECTORY = '/dev/serial/by-id'
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class Backoff(object):
+    """Jittered exponential backoff delays.
+
+    Attributes:
+
+        attempts (int): delays given since the last reset().
+
+    """
+
+    def __init__(self, base=1, cap=60, factor=2, rng=random.random):
+        """
+        Kwargs:
+            base (float): seconds before the first retry (before jitter).
+
+            cap (float): maximum delay in seconds (before jitter).
+
+            factor (float): delay multiplier after each attempt.
+
+            rng (callable): returns a random float in [0, 1).
+        """
+
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.rng = rng
+        self.attempts = 0
+
+    def next(self):
+        """Return the number of seconds to wait before the next attempt."""
+
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay / 2 * (1 + self.rng())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Reconnector(object):
+    """The reconnect state and statistics of one serial port.
+
+    Only used by the thread reading the port, so not thread safe.
+
+    Attributes:
+
+        port (str): the configured serial port, e.g. "/dev/ttyUSB0".
+
+        device_id (str): the port's name in /dev/serial/by-id, or None.
+
+        path (str): the device currently (or last) opened.
+
+        connected (bool)
+
+        attempts (int): attempts to re-open the port.
+
+        reconnects (int): successful re-opens.
+
+        outages (int): number of times the port has failed.
+
+        downtime (float): seconds spent disconnected in finished outages.
+
+        last_error (str): the error which caused the latest outage.
+
+    """
+
+    def __init__(self, port, base=1, cap=60, rng=random.random,
+                 clock=time.time):
+        self.port = port
+        self.path = port
+        self.device_id = None
+        self.connected = False
+        self.attempts = 0
+        self.reconnects = 0
+        self.outages = 0
+        self.downtime = 0.0
+        self.last_error = None
+        self.backoff = Backoff(base, cap, rng=rng)
+        self._clock = clock
+        self._disconnected_at = None
+
+    def opened(self, path):
+        """Record that path has been opened."""
+
+        self.path = path
+        if self.device_id is None:
+            self.device_id = device_id(path)
+        if self._disconnected_at is not None:
+            self.downtime += self._clock() - self._disconnected_at
+            self._disconnected_at = None
+            self.reconnects += 1
+        self.connected = True
+        self.backoff.reset()
+
+    def failed(self, error):
+        """Record that the port has failed (if it was connected)."""
+
+        if self.connected:
+            self.connected = False
+            self.outages += 1
+            self.last_error = str(error)
+            self._disconnected_at = self._clock()
+
+    def next_path(self):
+        """Return the device to try next, counting the attempt."""
+
+        self.attempts += 1
+        if self.device_id is not None:
+            path = find_port(self.device_id)
+            if path is not None:
+                return path
+        return self.port
+
+    def delay(self):
+        """Return seconds to wait before the next attempt."""
+        return self.backoff.next()
+
+    @property
+    def current_downtime(self):
+        """Seconds disconnected, including any outage in progress."""
+
+        if self._disconnected_at is None:
+            return self.downtime
+        return self.downtime + self._clock() - self._disconnected_at
+
+    def __str__(self):
+        return ('{} attempts={} reconnects={} outages={} downtime={:.0f}s'
+                .format('connected' if self.connected else 'DISCONNECTED',
+                        self.attempts, self.reconnects, self.outages,
+                        self.current_downtime))
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def device_id(port, directory=BY_ID_DIRECTORY):
+    """Return the name of the link in directory which points to port,
+    or None (e.g. not Linux, or not a USB serial device)."""
+
+    target = os.path.realpath(port)
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return None
+    for name in names:
+        if os.path.realpath(os.path.join(directory, name)) == target:
+            return name
+    return None
+
+
+def find_port(device_id, directory=BY_ID_DIRECTORY):
+    """Return the device the device_id link points to now, or None."""
+
+    link = os.path.join(directory, device_id)
+    if not os.path.exists(link):
+        return None
+    return os.path.realpath(link)
@@ -0,0 +1,350 @@
+"""Incremental downsampling of channel data into fixed-size time buckets.
+
+RollupStage is fed every sample written by iam_logger (by the writer
+thread) and keeps, for each channel and each configured bucket size, a
+running count, mean, min, max and energy for the current bucket.  When a
+sample arrives for a later bucket the finished bucket is appended to
+
+    <directory>/rollup_<N>min/channel_<chan>.dat
+
+as a line of "<bucket start> <mean watts> <min> <max> <count> <Wh>".
+
+Energy is integrated by holding each reading until the next sample.
+Gaps longer than max_gap seconds (or one bucket, whichever is shorter)
+are treated as missing data so they contribute no energy, and buckets
+with no samples at all are not written.  Samples which arrive out of
+order are still counted if their bucket is open.  Samples for buckets
+which have already been written are counted in late_samples and then
+dropped.
+
+The bucket open at shutdown is written too.  If, after a restart, a
+channel's first sample falls in that same bucket then the row is
+removed from the file and the bucket carries on from it, so each bucket
+has a single row.  Energy across the restart gap is not integrated.
+
+Rows backfilled from the Current Cost's own history (see the history
+module) have a count of 0 and are kept apart, in
+
+    <directory>/rollup_<N>min/backfill/channel_<chan>.dat
+
+so the live files stay in time order.  read_rows() merges the two: a
+backfilled row is only used where there is no live row with the same
+start time.
+
+"""
+
+from __future__ import print_function, division
+import os
+import logging
+import storage
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class Bucket(object):
+    """Statistics for one time bucket of one channel."""
+
+    __slots__ = ('start', 'count', 'total', 'min', 'max', 'watt_seconds')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.watt_seconds = 0.0
+
+    def add(self, watts):
+        self.count += 1
+        self.total += watts
+        if self.min is None or watts < self.min:
+            self.min = watts
+        if self.max is None or watts > self.max:
+            self.max = watts
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def watt_hours(self):
+        return self.watt_seconds / 3600
+
+    def __str__(self):
+        return '{:d} {:.1f} {} {} {:d} {:.3f}\n'.format(self.start, self.mean,
+                                                        self.min, self.max,
+                                                        self.count,
+                                                        self.watt_hours)
+
+    @classmethod
+    def parse(cls, line):
+        """Return the Bucket written as line (by __str__)."""
+
+        start, mean, low, high, count, watt_hours = line.split()
+        bucket = cls(int(start))
+        bucket.count = int(count)
+        bucket.total = float(mean) * bucket.count
+        bucket.min = float(low) if '.' in low else int(low)
+        bucket.max = float(high) if '.' in high else int(high)
+        bucket.watt_seconds = float(watt_hours) * 3600
+        return bucket
+
+
+class ChannelRollup(object):
+    """Rolls up one channel's samples into buckets of a single size.
+
+    Attributes:
+
+        bucket_seconds (int)
+
+        max_gap (int): longest gap (in seconds) between samples which
+            is integrated for energy.
+
+        late_samples (int): samples dropped because their bucket had
+            already been finished.
+
+    """
+
+    def __init__(self, bucket_seconds, max_gap=60):
+        self.bucket_seconds = bucket_seconds
+        self.max_gap = min(max_gap, bucket_seconds)
+        self.late_samples = 0
+        self._bucket = None
+        self._last_timecode = None
+        self._last_watts = None
+
+    def add(self, timecode, watts):
+        """Add a sample.
+
+        Returns:
+            the finished Bucket if this sample closed one, otherwise None.
+        """
+
+        start = timecode - (timecode % self.bucket_seconds)
+        bucket = self._bucket
+
+        if bucket is None:
+            self._bucket = Bucket(start)
+            self._bucket.add(watts)
+            self._last_timecode = timecode
+            self._last_watts = watts
+            return None
+
+        if start < bucket.start:
+            self.late_samples += 1
+            return None
+
+        if self._last_timecode is None:
+            # Resumed after a restart: nothing to integrate from.
+            bucket.add(watts)
+            self._last_timecode = timecode
+            self._last_watts = watts
+            return None
+
+        if timecode < self._last_timecode:
+            # Out of order but its bucket is still open.  Don't integrate.
+            bucket.add(watts)
+            return None
+
+        gap = timecode - self._last_timecode
+        integrate = gap <= self.max_gap
+        finished = None
+
+        if start == bucket.start:
+            if integrate:
+                bucket.watt_seconds += self._last_watts * gap
+        else:
+            finished = bucket
+            self._bucket = Bucket(start)
+            if integrate:
+                # max_gap <= bucket_seconds so the gap spans at most
+                # the end of the old bucket and the start of the new one.
+                bucket_end = bucket.start + self.bucket_seconds
+                bucket.watt_seconds += (self._last_watts *
+                                        (bucket_end - self._last_timecode))
+                self._bucket.watt_seconds += self._last_watts * (timecode - start)
+
+        self._bucket.add(watts)
+        self._last_timecode = timecode
+        self._last_watts = watts
+        return finished
+
+    def resume(self, bucket):
+        """Carry on adding to bucket (written before a restart)."""
+
+        self._bucket = bucket
+        self._last_timecode = None
+        self._last_watts = None
+
+    def flush(self):
+        """Return the open Bucket (or None) and forget it."""
+
+        bucket = self._bucket
+        self._bucket = None
+        self._last_timecode = None
+        self._last_watts = None
+        return bucket
+
+
+class RollupStage(object):
+    """Rolls up every channel into several bucket sizes and saves buckets.
+
+    Not thread safe: should only be fed by a single thread (the writer).
+
+    Attributes:
+
+        bucket_seconds (list): bucket sizes in seconds.
+
+        pools (dict): storage.ChannelWriterPool for each bucket size.
+
+        backfill_pools (dict): storage.ChannelWriterPool for rows
+            backfilled from history, for each bucket size.
+
+    """
+
+    def __init__(self, directory, bucket_seconds, max_gap=60, **pool_kwargs):
+        """
+        Args:
+            directory (str): data directory (ending in '/').  Rollups are
+                written to sub-directories of this.
+
+            bucket_seconds (list of ints): bucket sizes, in seconds.
+
+        Kwargs:
+            max_gap (int): see ChannelRollup.
+
+            pool_kwargs: passed to each storage.ChannelWriterPool.
+        """
+
+        self.bucket_seconds = sorted(set(bucket_seconds))
+        self.max_gap = max_gap
+        self.pools = {}
+        self.backfill_pools = {}
+        self._rollups = {} # (chan, bucket_seconds) -> ChannelRollup
+
+        pool_kwargs['index_seconds'] = 0
+        for seconds in self.bucket_seconds:
+            subdir = rollup_directory(directory, seconds)
+            backfill_subdir = os.path.join(subdir, 'backfill', '')
+            if not os.path.isdir(backfill_subdir):
+                os.makedirs(backfill_subdir)
+            self.pools[seconds] = storage.ChannelWriterPool(subdir,
+                                                            **pool_kwargs)
+            self.backfill_pools[seconds] = storage.ChannelWriterPool(
+                                               backfill_subdir, **pool_kwargs)
+
+    def add(self, chan, timecode, watts):
+        """Add a sample to every rollup of chan."""
+
+        for seconds in self.bucket_seconds:
+            key = (chan, seconds)
+            rollup = self._rollups.get(key)
+            if rollup is None:
+                rollup = ChannelRollup(seconds, self.max_gap)
+                self._resume(chan, rollup, timecode)
+                self._rollups[key] = rollup
+            finished = rollup.add(timecode, watts)
+            if finished is not None:
+                self.pools[seconds].write(chan, str(finished))
+
+    def _resume(self, chan, rollup, timecode):
+        """Resume the bucket written at the last shutdown if timecode is
+        in it, removing its row."""
+
+        seconds = rollup.bucket_seconds
+        start = timecode - (timecode % seconds)
+        line = self.pools[seconds].pop_last_line(chan, '{:d} '.format(start))
+        if line is None:
+            return
+        try:
+            bucket = Bucket.parse(line)
+        except ValueError:
+            logging.warning("ROLLUP: can't resume from '{}' in {}"
+                            .format(line.strip(),
+                                    self.pools[seconds].filename(chan)))
+            self.pools[seconds].write(chan, line)
+            return
+        if bucket.count:
+            rollup.resume(bucket)
+        else:
+            # Backfilled from history: superseded by the live row
+            logging.debug("ROLLUP: dropped backfilled row {}"
+                          .format(line.strip()))
+
+    def open_bucket(self, chan, seconds):
+        """Return the start of chan's open bucket of seconds, or None.
+
+        Safe to call from another thread (e.g. the history thread).
+        """
+
+        rollup = self._rollups.get((chan, seconds))
+        bucket = None if rollup is None else rollup._bucket
+        return None if bucket is None else bucket.start
+
+    def flush_if_due(self):
+        for pool in self.pools.itervalues():
+            pool.flush_if_due()
+
+    def close(self):
+        """Write every open bucket then flush and close all rollup files."""
+
+        for (chan, seconds), rollup in self._rollups.iteritems():
+            bucket = rollup.flush()
+            if bucket is not None:
+                self.pools[seconds].write(chan, str(bucket))
+        for pool in self.pools.values() + self.backfill_pools.values():
+            pool.close()
+        logging.info("ROLLUP: late samples dropped: {}"
+                     .format(self.late_samples))
+
+    @property
+    def late_samples(self):
+        return sum(rollup.late_samples for rollup in self._rollups.itervalues())
+
+    def __str__(self):
+        return 'buckets(s)={} late={}'.format(self.bucket_seconds,
+                                              self.late_samples)
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def rollup_directory(directory, seconds):
+    """The directory (ending in '/') of the rollups of seconds buckets."""
+
+    return os.path.join(directory, 'rollup_{:d}min'.format(seconds // 60), '')
+
+
+def read_rows(directory, chan, seconds):
+    """Read chan's rollup rows, with backfilled rows merged in.
+
+    Args:
+        directory (str): the data directory.
+        chan: the channel.
+        seconds (int): the bucket size.
+
+    Returns:
+        list of Buckets sorted by start time.  Where there are several
+        rows for one bucket the last live row wins.
+    """
+
+    subdir = rollup_directory(directory, seconds)
+    buckets = {}
+    for filename in (os.path.join(subdir, 'backfill',
+                                  'channel_{}.dat'.format(chan)),
+                     os.path.join(subdir, 'channel_{}.dat'.format(chan))):
+        try:
+            with open(filename) as fh:
+                for line in fh:
+                    try:
+                        bucket = Bucket.parse(line)
+                    except ValueError:
+                        continue # torn last line
+                    buckets[bucket.start] = bucket
+        except IOError:
+            pass
+    return [buckets[start] for start in sorted(buckets)]
@@ -0,0 +1,291 @@
+"""Periodically export iam_logger's statistics to a file.
+
+The file is replaced atomically: each export is written to a temporary
+file in the same directory which is then renamed over the old file, so
+readers only ever see a complete export.  (The temporary file is not
+fsync'd; after a crash the previous or next export will do.)
+
+Statistics are given as a snapshot dict built by Manager.snapshot() and
+can be written in one of FORMATS:
+
+    text       : the human-readable table shown on screen
+    json       : the snapshot as a JSON object
+    line       : InfluxDB line protocol, one line per sensor, location,
+                 port and for the writer
+    prometheus : Prometheus text exposition format (e.g. for the node
+                 exporter's textfile collector)
+
+"""
+
+from __future__ import print_function, division
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+FORMATS = ('text', 'json', 'line', 'prometheus')
+
+# Keys of the 'sensors', 'current_costs' and 'writer' parts of a snapshot
+PERIOD_STATS = ('mean', 'min', 'max', 'last', 'p50', 'p95', 'p99',
+                'recent_mean', 'recent_max')
+PORT_COUNTERS = ('messages', 'hist_messages', 'parse_errors', 'retries',
+                 'reconnects', 'outages', 'corrected_timestamps')
+WRITER_COUNTERS = ('dropped', 'samples_written', 'bytes_written', 'flushes')
+WRITER_GAUGES = ('queue_depth', 'high_water_mark')
+WRITER_LATENCIES = ('flush_seconds_mean', 'flush_seconds_max')
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class StatsExporter(threading.Thread):
+    """Thread which calls build() every interval seconds and writes the
+    string it returns to filename.
+
+    Attributes:
+
+        exports (int): number of successful exports.
+
+        errors (int): number of exports which failed.
+
+    """
+
+    def __init__(self, filename, build, interval=60):
+        threading.Thread.__init__(self, name="stats_exporter")
+        self.daemon = True
+        self.filename = filename
+        self.build = build
+        self.interval = interval
+        self.exports = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            self.export()
+            self._stop_event.wait(self.interval)
+            if self._stop_event.is_set():
+                break
+
+    def export(self):
+        try:
+            write_atomic(self.filename, self.build())
+        except (IOError, OSError), e:
+            self.errors += 1
+            logging.warning("STATS: failed to write {}: {}"
+                            .format(self.filename, e))
+        else:
+            self.exports += 1
+
+    def stop(self):
+        """Stop the thread after writing one last export."""
+        self._stop_event.set()
+        self.join()
+        self.export()
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def write_atomic(filename, data):
+    """Replace filename with data without readers seeing a partial file.
+
+    The file keeps the mode of the file it replaces or, for a new file,
+    gets the mode open() would give it (mkstemp's 0600 would stop other
+    users, e.g. the node exporter, from reading it).
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.stats_',
+                                        suffix='.tmp')
+    try:
+        os.fchmod(fd, _mode_for(filename))
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        os.rename(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
+
+def _mode_for(filename):
+    """The permission bits a file written to filename should have."""
+
+    try:
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
+
+
+def to_json(snapshot):
+    return json.dumps(snapshot, sort_keys=True, indent=1) + '\n'
+
+
+def to_line_protocol(snapshot):
+    """Format a snapshot as InfluxDB line protocol.
+
+    Sensors are written as 'iam_sensor' points tagged with radio_id,
+    sens_chan, channel and label.  The number of samples heard at each
+    location is written as 'iam_location' points, each Current Cost's
+    counters as 'iam_port' points and the writer's as an 'iam_writer'
+    point.  Fields which are not yet known (e.g. the mean period of a
+    sensor seen only once) are left out.
+    """
+
+    timestamp = ' {:d}\n'.format(int(snapshot['time'] * 1E9))
+    lines = []
+    for sensor in snapshot['sensors']:
+        tags = ','.join('{}={}'.format(key, _escape(sensor[key]))
+                        for key in ('radio_id', 'sens_chan', 'channel',
+                                    'label'))
+        fields = []
+        for key in ('watts', 'count', 'gaps'):
+            if sensor[key] is not None:
+                fields.append('{}={:d}i'.format(key, sensor[key]))
+        for key in PERIOD_STATS + ('age',):
+            if sensor[key] is not None:
+                fields.append('{}={!r}'.format(key, float(sensor[key])))
+        if fields:
+            lines.append('iam_sensor,' + tags + ' ' + ','.join(fields) +
+                         timestamp)
+        for location, count in sorted(sensor['locations'].iteritems()):
+            lines.append('iam_location,' + tags + ',location=' +
+                         _escape(location) + ' count={:d}i'.format(count) +
+                         timestamp)
+
+    for port in snapshot.get('current_costs', []):
+        fields = _line_fields(port, PORT_COUNTERS + ('connected',),
+                              ('messages_per_second', 'downtime_seconds'))
+        lines.append('iam_port,port=' + _escape(port['port']) + ' ' +
+                     fields + timestamp)
+
+    writer = snapshot.get('writer')
+    if writer is not None:
+        fields = _line_fields(writer, WRITER_COUNTERS + WRITER_GAUGES,
+                              WRITER_LATENCIES)
+        lines.append('iam_writer ' + fields + timestamp)
+    return ''.join(lines)
+
+
+def to_prometheus(snapshot):
+    """Format a snapshot in the Prometheus text exposition format."""
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        """samples is a list of (labels dict, value)."""
+        samples = [(labels, value) for labels, value in samples
+                   if value is not None]
+        if not samples:
+            return
+        lines.append('# HELP {} {}\n'.format(name, help_text))
+        lines.append('# TYPE {} {}\n'.format(name, kind))
+        for labels, value in samples:
+            if labels:
+                label_text = ','.join('{}="{}"'.format(key, _quote(labels[key]))
+                                      for key in sorted(labels))
+                lines.append('{}{{{}}} {}\n'.format(name, label_text,
+                                                    _number(value)))
+            else:
+                lines.append('{} {}\n'.format(name, _number(value)))
+
+    sensors = [(dict((key, sensor[key]) for key in ('radio_id', 'sens_chan',
+                                                    'channel', 'label')),
+                sensor) for sensor in snapshot['sensors']]
+    metric('iam_sensor_watts', 'gauge', 'Latest power reading.',
+           [(labels, sensor['watts']) for labels, sensor in sensors])
+    metric('iam_sensor_updates', 'gauge', 'Number of updates after the '
+           'first (the COUNT column).',
+           [(labels, sensor['count']) for labels, sensor in sensors])
+    metric('iam_sensor_last_seen_seconds', 'gauge', 'Unix time of the '
+           'latest reading.',
+           [(labels, sensor['last_seen']) for labels, sensor in sensors])
+    metric('iam_sensor_age_seconds', 'gauge', 'Seconds since the latest '
+           'reading.', [(labels, sensor['age']) for labels, sensor in sensors])
+    period = []
+    for labels, sensor in sensors:
+        for stat in PERIOD_STATS:
+            period.append((dict(labels, stat=stat), sensor[stat]))
+    metric('iam_sensor_period_seconds', 'gauge', 'Time between readings.',
+           period)
+    metric('iam_sensor_gaps_total', 'counter', 'Gaps between readings '
+           'longer than --gap_seconds.',
+           [(labels, sensor['gaps']) for labels, sensor in sensors])
+    locations = []
+    for labels, sensor in sensors:
+        for location, count in sorted(sensor['locations'].iteritems()):
+            locations.append((dict(labels, location=location), count))
+    metric('iam_sensor_location_samples_total', 'counter', 'Samples heard '
+           'at each Current Cost location.', locations)
+
+    ports = snapshot.get('current_costs', [])
+    for key, help_text in (('messages', 'Messages used to update sensors.'),
+                           ('hist_messages', 'Histogram messages skipped.'),
+                           ('parse_errors', 'Lines of malformed XML.'),
+                           ('retries', 'Attempts to re-open the serial '
+                            'port.'),
+                           ('reconnects', 'Serial port reconnections.'),
+                           ('outages', 'Serial port failures.'),
+                           ('corrected_timestamps', 'Messages read late '
+                            'whose timestamps were corrected.')):
+        metric('iam_port_{}_total'.format(key), 'counter', help_text,
+               [({'port': port['port']}, port[key]) for port in ports])
+    metric('iam_port_messages_per_second', 'gauge', 'Recent message rate.',
+           [({'port': port['port']}, port['messages_per_second'])
+            for port in ports])
+    metric('iam_port_connected', 'gauge', '1 if the serial port is open.',
+           [({'port': port['port']}, port['connected']) for port in ports])
+    metric('iam_port_downtime_seconds_total', 'counter', 'Time spent '
+           'disconnected.',
+           [({'port': port['port']}, port['downtime_seconds'])
+            for port in ports])
+
+    writer = snapshot.get('writer')
+    if writer is not None:
+        for key in WRITER_COUNTERS:
+            metric('iam_writer_{}_total'.format(key), 'counter',
+                   key.replace('_', ' ').capitalize() + '.',
+                   [({}, writer[key])])
+        for key in WRITER_GAUGES + WRITER_LATENCIES:
+            metric('iam_writer_{}'.format(key), 'gauge',
+                   key.replace('_', ' ').capitalize() + '.',
+                   [({}, writer[key])])
+
+    return ''.join(lines)
+
+
+def _line_fields(values, integer_keys, float_keys):
+    """Return line protocol fields for the keys in values which aren't None."""
+    fields = ['{}={:d}i'.format(key, values[key]) for key in integer_keys
+              if values[key] is not None]
+    fields += ['{}={!r}'.format(key, float(values[key])) for key in float_keys
+               if values[key] is not None]
+    return ','.join(fields)
+
+
+def _number(value):
+    """Format a Prometheus sample value without losing precision."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def _quote(value):
+    """Escape a Prometheus label value."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _escape(value):
+    """Escape a line protocol tag value."""
+    value = str(value)
+    for char in ('\\', ',', '=', ' '):
+        value = value.replace(char, '\\' + char)
+    return value
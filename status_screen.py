@@ -0,0 +1,115 @@
+"""Incremental full-screen status display using ANSI escape codes.
+
+StatusScreen.draw() is given the complete frame as a list of lines and
+only rewrites the terminal rows which differ from the previous frame, by
+moving the cursor to each changed row.  No subprocess (e.g. 'clear') is
+run and unchanged rows cost nothing to redraw.
+
+Lines are truncated to the terminal width (so they never wrap and push
+later rows down) and frames taller than the terminal are cut short with
+a note saying how many lines are hidden.  The whole screen is redrawn
+whenever the terminal is resized.
+
+"""
+
+from __future__ import print_function, division
+import fcntl
+import struct
+import sys
+import termios
+
+CLEAR_SCREEN = '\x1b[H\x1b[2J'
+CLEAR_LINE = '\x1b[K'
+CLEAR_BELOW = '\x1b[J'
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+MOVE_TO = '\x1b[{:d};1H' # 1-based row
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class StatusScreen(object):
+    """Draws successive frames of text, rewriting only changed rows.
+
+    Attributes:
+
+        frames (int): number of frames drawn.
+
+        rows_written (int): number of rows rewritten across every frame.
+
+    """
+
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.frames = 0
+        self.rows_written = 0
+        self._lines = [] # the lines currently on screen
+        self._size = None
+
+    def draw(self, lines):
+        """Display lines (a list of strings without newlines)."""
+
+        height, width = terminal_size(self.stream)
+        out = []
+        if (height, width) != self._size:
+            out.append(HIDE_CURSOR + CLEAR_SCREEN)
+            self._lines = []
+            self._size = (height, width)
+
+        # Leave the bottom row free so the terminal never scrolls
+        height = max(height, 3)
+        if len(lines) > height - 1:
+            hidden = len(lines) - (height - 2)
+            lines = lines[:height - 2]
+            lines.append('... {} more lines (enlarge the terminal to see them)'
+                         .format(hidden))
+
+        old_lines = self._lines
+        n_old = len(old_lines)
+        new_lines = []
+        for row, line in enumerate(lines):
+            if len(line) >= width:
+                line = line[:width - 1]
+            new_lines.append(line)
+            if row >= n_old or old_lines[row] != line:
+                out.append(MOVE_TO.format(row + 1) + line + CLEAR_LINE)
+                self.rows_written += 1
+
+        if len(new_lines) < n_old:
+            out.append(MOVE_TO.format(len(new_lines) + 1) + CLEAR_BELOW)
+
+        if out:
+            self.stream.write(''.join(out))
+            self.stream.flush()
+        self._lines = new_lines
+        self.frames += 1
+
+    def close(self):
+        """Leave the cursor below the last frame and make it visible."""
+
+        self.stream.write(MOVE_TO.format(len(self._lines) + 1) + SHOW_CURSOR)
+        self.stream.flush()
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+
+def terminal_size(stream=sys.stdout):
+    """Return (rows, columns) of the terminal attached to stream.
+
+    Falls back to (24, 80) if stream isn't a terminal.
+    """
+
+    try:
+        rows, columns = struct.unpack('hh', fcntl.ioctl(stream.fileno(),
+                                                        termios.TIOCGWINSZ,
+                                                        '1234'))
+    except (IOError, AttributeError, ValueError):
+        return 24, 80
+    if rows <= 0 or columns <= 0:
+        return 24, 80
+    return rows, columns
@@ -0,0 +1,1333 @@
+"""Storage layer for iam_logger: getting samples from Sensors onto disk.
+
+Sensor.write_to_disk used to open, append to and close channel_N.dat for
+every single sample.  ChannelWriterPool keeps a bounded number of channel
+files open and batches writes so that the disk (usually an SD card) sees
+one write per flush rather than one open/write/close per sample.
+
+WriterThread moves all of that off the CurrentCost reader threads: readers
+just enqueue (chan, timecode, watts) tuples and a single writer thread
+formats and writes them in batches.
+
+The on-disk format is pluggable.  TextBackend writes the traditional
+"<unixtime> <watts>" lines to channel_N.dat.  BinaryBackend writes
+fixed-width records to channel_N.bin which can be memory-mapped straight
+into a NumPy array with load_binary().
+
+Text channel files get a sparse time index: a channel_N.idx sidecar
+which records the byte offset of the first sample in every block of
+index_seconds.  Readers use it to find a timecode with a binary search
+over the (small) index plus one small read of the data file.
+rebuild_indexes() creates the sidecars for existing data directories.
+
+Channel files can be rotated by day or by month (UTC).  Each channel is
+then written to dated segments (channel_N.2013-02-04.dat or
+channel_N.2013-02.dat) and, once a channel moves on to a new segment,
+the closed segment is gzipped (channel_N.2013-02-04.dat.gz) by a
+SegmentCompressor thread running at low priority.  channel_reader reads
+across plain and compressed segments.
+
+"""
+
+from __future__ import print_function, division
+import calendar
+import collections
+import gzip
+import re
+import threading
+import Queue
+import struct
+import bisect
+import time
+import os
+import zlib
+import logging
+
+#==============================================================================
+# CLASSES
+#==============================================================================
+
+
+class StorageError(Exception):
+    """Raised when a channel file can't be used by a storage backend."""
+
+
+class TextBackend(object):
+    """Human-readable "<unixtime> <watts>\\n" lines in channel_N.dat."""
+
+    NAME = 'text'
+    EXTENSION = '.dat'
+    INDEXED = True # variable-width records need a TimeIndex to seek
+
+    def encode(self, timecode, watts):
+        return '{:d} {}\n'.format(timecode, watts)
+
+    def open(self, filename):
+        """Open filename for appending.
+
+        If the last line of an existing file is incomplete (e.g. after
+        a power cut) then it is truncated.
+        """
+
+        partial = truncate_partial_line(filename)
+        if partial:
+            logging.warning("WRITER: truncated {} byte partial line from {}"
+                            .format(partial, filename))
+        return open(filename, 'a')
+
+
+class BinaryBackend(object):
+    """Fixed-width little-endian binary records in channel_N.bin.
+
+    Each file starts with an 8 byte header: the magic string 'IAMB',
+    a uint16 format version and a uint16 record size.  This is followed
+    by one record per sample: uint32 unix timecode then int32 watts.
+
+    """
+
+    NAME = 'binary'
+    EXTENSION = '.bin'
+    INDEXED = False # fixed-width records can be binary-searched directly
+    MAGIC = 'IAMB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHH')
+    RECORD = struct.Struct('<Ii')
+    DTYPE = [('timecode', '<u4'), ('watts', '<i4')] # NumPy dtype of RECORD
+
+    def encode(self, timecode, watts):
+        return BinaryBackend.RECORD.pack(timecode, watts)
+
+    def open(self, filename):
+        """Open filename for appending, writing or checking its header.
+
+        If the last record in an existing file is incomplete (e.g. after
+        a power cut) then the partial record is truncated.
+
+        Raises:
+            StorageError: if the file has an unrecognised header.
+        """
+
+        fh = open(filename, 'ab')
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            fh.write(BinaryBackend.header())
+            return fh
+
+        with open(filename, 'rb') as header_fh:
+            check_binary_header(header_fh.read(BinaryBackend.HEADER.size),
+                                filename)
+
+        partial = (size - BinaryBackend.HEADER.size) % BinaryBackend.RECORD.size
+        if partial:
+            logging.warning("WRITER: truncating {} byte partial record from {}"
+                            .format(partial, filename))
+            fh.truncate(size - partial)
+        return fh
+
+    @staticmethod
+    def header():
+        return BinaryBackend.HEADER.pack(BinaryBackend.MAGIC,
+                                         BinaryBackend.VERSION,
+                                         BinaryBackend.RECORD.size)
+
+
+class TimeIndex(object):
+    """Sparse time index sidecar (channel_N.idx) for a channel data file.
+
+    The file has a 12 byte header: the magic string 'IAMX', a uint16
+    format version, a uint16 record size and the uint32 block length in
+    seconds.  Then one record per block of data: the uint32 start time
+    of the block and the uint64 byte offset of the first sample in that
+    block.
+
+    Attributes:
+        filename (str)
+
+        block_seconds (int)
+
+        timecodes (list): start time of each block, ascending.
+
+        offsets (list): byte offset of the first sample in each block.
+
+    """
+
+    EXTENSION = '.idx'
+    MAGIC = 'IAMX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHI')
+    RECORD = struct.Struct('<IQ')
+
+    def __init__(self, filename, block_seconds, timecodes=None, offsets=None):
+        self.filename = filename
+        self.block_seconds = block_seconds
+        self.timecodes = [] if timecodes is None else timecodes
+        self.offsets = [] if offsets is None else offsets
+
+    @staticmethod
+    def filename_for(data_filename):
+        return os.path.splitext(data_filename)[0] + TimeIndex.EXTENSION
+
+    @staticmethod
+    def load(filename):
+        """Load an index file.
+
+        Raises:
+            IOError: if filename can't be read.
+            StorageError: if filename has an unrecognised header.
+        """
+
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        block_seconds = TimeIndex._check_header(data, filename)
+        timecodes = []
+        offsets = []
+        record_size = TimeIndex.RECORD.size
+        end = len(data) - (len(data) - TimeIndex.HEADER.size) % record_size
+        for pos in xrange(TimeIndex.HEADER.size, end, record_size):
+            timecode, offset = TimeIndex.RECORD.unpack_from(data, pos)
+            timecodes.append(timecode)
+            offsets.append(offset)
+        return TimeIndex(filename, block_seconds, timecodes, offsets)
+
+    @staticmethod
+    def _check_header(data, filename):
+        """Return block_seconds from the header at the start of data."""
+
+        if len(data) < TimeIndex.HEADER.size:
+            raise StorageError("{} is too short to be an index file"
+                               .format(filename))
+        magic, version, record_size, block_seconds = \
+            TimeIndex.HEADER.unpack_from(data)
+        if (magic != TimeIndex.MAGIC or version != TimeIndex.VERSION or
+            record_size != TimeIndex.RECORD.size or block_seconds == 0):
+            raise StorageError("{} has an unrecognised header".format(filename))
+        return block_seconds
+
+    def append(self, entries):
+        """Append (block start timecode, byte offset) entries to the file."""
+
+        with open(self.filename, 'ab') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                fh.write(TimeIndex.HEADER.pack(TimeIndex.MAGIC,
+                                               TimeIndex.VERSION,
+                                               TimeIndex.RECORD.size,
+                                               self.block_seconds))
+            fh.write(''.join(TimeIndex.RECORD.pack(timecode, offset)
+                             for timecode, offset in entries))
+        for timecode, offset in entries:
+            self.timecodes.append(timecode)
+            self.offsets.append(offset)
+
+    def block_start(self, timecode):
+        return timecode - (timecode % self.block_seconds)
+
+    def bounds(self, timecode, size):
+        """Return (lo, hi) byte offsets which bracket timecode.
+
+        Every sample before lo is earlier than timecode and the sample
+        at hi (if any) is not.  Entries beyond size (the length of the
+        data file) are ignored.
+        """
+
+        i = bisect.bisect_right(self.timecodes, timecode)
+        lo = self.offsets[i - 1] if i > 0 else 0
+        hi = self.offsets[i] if i < len(self.offsets) else size
+        return min(lo, size), min(hi, size)
+
+
+class WriterStats(object):
+    """Counters describing the work done by a ChannelWriterPool.
+
+    Attributes:
+
+        bytes_written (int): total bytes handed to the OS.
+
+        samples_written (int): total number of lines written.
+
+        flush_count (int): number of batched flushes.
+
+        flush_latency_total (float): total seconds spent flushing.
+
+        flush_latency_max (float): slowest single flush, in seconds.
+
+        opens (int): number of times a channel file was opened.
+
+        evictions (int): number of times a file was closed to keep the
+            number of open files below max_open_files.
+
+        rotations (int): number of times a channel moved to a new segment.
+
+    """
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.samples_written = 0
+        self.flush_count = 0
+        self.flush_latency_total = 0.0
+        self.flush_latency_max = 0.0
+        self.opens = 0
+        self.evictions = 0
+        self.rotations = 0
+
+    def record_flush(self, latency):
+        self.flush_count += 1
+        self.flush_latency_total += latency
+        if latency > self.flush_latency_max:
+            self.flush_latency_max = latency
+
+    @property
+    def flush_latency_mean(self):
+        if self.flush_count == 0:
+            return 0.0
+        return self.flush_latency_total / self.flush_count
+
+    def __str__(self):
+        return ('bytes={} samples={} flushes={} flush_ms(mean/max)={:.2f}/{:.2f}'
+                ' opens={} evictions={} rotations={}'
+                .format(self.bytes_written, self.samples_written,
+                        self.flush_count, self.flush_latency_mean * 1000,
+                        self.flush_latency_max * 1000, self.opens,
+                        self.evictions, self.rotations))
+
+
+class ChannelWriterPool(object):
+    """Buffered writer for per-channel data files.
+
+    Keeps up to max_open_files channel files open (least recently used
+    files are closed first).  Data is held in memory until either
+    flush_bytes bytes are pending or flush_interval seconds have passed
+    since the last flush, at which point every pending buffer is written.
+
+    Samples are written by the WriterThread alone (reader threads only
+    queue them; journal recovery writes before the WriterThread starts).
+    The one other thread is the history thread, which writes backfilled
+    rollup rows and flushes the live rollup pools so it can read them.
+    The lock protects the open files, pending buffers and index state
+    from that overlap.  stats is read by other threads without it.
+
+    Attributes:
+
+        directory (str): directory to write channel files to.  Must end
+            with '/'.
+
+        backend (TextBackend or BinaryBackend): the on-disk format.
+
+        index_seconds (int): block length of the TimeIndex maintained for
+            each channel (if the backend is INDEXED).  0 disables indexing.
+
+        rotate (str): 'none', 'day' or 'month'.  See ROTATIONS.
+
+        stats (WriterStats)
+
+    """
+
+    def __init__(self, directory, backend=None, max_open_files=32,
+                 flush_interval=10.0, flush_bytes=4096, index_seconds=3600,
+                 rotate='none', on_rotate=None):
+        """
+        Args:
+            directory (str): directory to write channel files to.
+
+        Kwargs:
+            backend: the on-disk format.  Defaults to TextBackend().
+
+            max_open_files (int): maximum number of file handles to
+                keep open at once.
+
+            flush_interval (float): maximum seconds data may sit in memory.
+
+            flush_bytes (int): flush once this many bytes are pending.
+
+            index_seconds (int): block length for the time index.
+
+            rotate (str): 'none' to write every sample for a channel to
+                channel_N<extension>, or 'day' or 'month' to write dated
+                segments.
+
+            on_rotate (callable): called with the filename of each
+                segment which is closed by rotation (e.g.
+                SegmentCompressor.put).  Called with the pool's lock held.
+
+        Raises:
+            StorageError: if rotate is not recognised.
+        """
+
+        if rotate not in ROTATIONS:
+            raise StorageError("Unknown rotation '{}'. Must be one of {}"
+                               .format(rotate, sorted(ROTATIONS.keys())))
+
+        self.directory = directory
+        self.backend = TextBackend() if backend is None else backend
+        self.max_open_files = max(1, max_open_files)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.index_seconds = index_seconds if self.backend.INDEXED else 0
+        self.stats = WriterStats()
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict() # chan -> open file, LRU order
+        self._unsynced = set() # files closed (e.g. evicted) without an fsync
+        self._pending = collections.OrderedDict() # chan -> list of strings
+        self._pending_bytes = 0
+        self._last_flush = time.time()
+        self._indexes = {} # chan -> TimeIndex
+        self._offsets = {} # chan -> size of data file including pending data
+        self._last_block = {} # chan -> start of the newest block with data
+        self._pending_index = collections.defaultdict(list) # chan -> entries
+        self.rotate = rotate
+        self.on_rotate = on_rotate
+        self._segments = {} # chan -> segment currently written to
+        if rotate != 'none' and os.path.isdir(directory):
+            # Carry on with the newest existing segment of each channel
+            for chan, filenames in list_segments(directory,
+                                                 self.backend.EXTENSION).iteritems():
+                self._segments[chan] = parse_channel_filename(
+                                           os.path.basename(filenames[-1]))[1]
+
+    def filename(self, chan):
+        """The file chan is currently being written to."""
+
+        segment = self._segments.get(str(chan))
+        return (self.directory + "channel_" + str(chan) +
+                ('.' + segment if segment else '') + self.backend.EXTENSION)
+
+    def write_sample(self, chan, timecode, watts):
+        """Encode a sample using the backend, index it and queue it."""
+
+        data = self.backend.encode(timecode, watts)
+        chan = str(chan) # 7, '7' and the journal's '7' are the same file
+        with self._lock:
+            if self.rotate != 'none':
+                self._rotate_if_due(chan, timecode)
+            if self.index_seconds:
+                self._index_sample(chan, timecode, len(data))
+            self._append(chan, data)
+
+    def write(self, chan, data):
+        """Queue a string of data for appending to channel chan's file.
+
+        Flushes every pending buffer if a threshold has been crossed.
+        """
+
+        chan = str(chan)
+        with self._lock:
+            self._append(chan, data)
+
+    def pop_last_line(self, chan, prefix):
+        """Remove the last line of chan's file if it starts with prefix.
+
+        For text files which aren't indexed (e.g. rollups, where the
+        row written at shutdown is replaced when its bucket is resumed).
+
+        Returns:
+            the removed line, or None if it didn't match (or there is
+            no file).
+        """
+
+        chan = str(chan)
+        with self._lock:
+            if chan in self._pending:
+                self._flush()
+            if chan in self._files:
+                self._close_file(chan)
+            try:
+                fh = open(self.filename(chan), 'r+b')
+            except IOError:
+                return None
+            with fh:
+                size = os.fstat(fh.fileno()).st_size
+                fh.seek(max(0, size - 4096))
+                tail = fh.read()
+                if not tail.endswith('\n'):
+                    return None
+                line = tail[tail.rfind('\n', 0, len(tail) - 1) + 1:]
+                if not line.startswith(prefix):
+                    return None
+                fh.truncate(size - len(line))
+                return line
+
+    def _append(self, chan, data):
+        self._pending.setdefault(chan, []).append(data)
+        self._pending_bytes += len(data)
+        self.stats.samples_written += 1
+        if (self._pending_bytes >= self.flush_bytes or
+            time.time() - self._last_flush >= self.flush_interval):
+            self._flush()
+
+    def _rotate_if_due(self, chan, timecode):
+        """Move chan on to the segment for timecode if that's newer.
+
+        Segments never go backwards so a late sample is written to the
+        current segment rather than re-opening a closed one.
+        """
+
+        segment = segment_name(timecode, self.rotate)
+        current = self._segments.get(chan)
+        if current is not None and segment <= current:
+            return
+
+        old_filename = self.filename(chan)
+        if current is not None:
+            if chan in self._pending:
+                self._flush()
+            if chan in self._files:
+                self._close_file(chan)
+            for state in (self._indexes, self._offsets, self._last_block,
+                          self._pending_index):
+                state.pop(chan, None)
+            self.stats.rotations += 1
+        self._segments[chan] = segment
+
+        if (current is not None and self.on_rotate is not None and
+            os.path.exists(old_filename)):
+            self.on_rotate(old_filename)
+
+    def _index_sample(self, chan, timecode, length):
+        """Record an index entry if this sample starts a new block."""
+
+        index = self._indexes.get(chan)
+        if index is None:
+            index = self._load_index(chan)
+            filename = self.filename(chan)
+            self._offsets[chan] = (os.path.getsize(filename)
+                                   if os.path.exists(filename) else 0)
+            # Only index blocks which start after the existing data
+            # (which may not be indexed at all) otherwise an entry might
+            # not point at the first sample in its block.
+            last_blocks = [index.timecodes[-1]] if index.timecodes else []
+            last_timecode = last_text_timecode(filename)
+            if last_timecode is not None:
+                last_blocks.append(index.block_start(last_timecode))
+            self._last_block[chan] = max(last_blocks) if last_blocks else None
+
+        block_start = index.block_start(timecode)
+        if self._last_block[chan] is None or block_start > self._last_block[chan]:
+            self._pending_index[chan].append((block_start, self._offsets[chan]))
+            self._last_block[chan] = block_start
+        self._offsets[chan] += length
+
+    def _load_index(self, chan):
+        """Load (or start) the TimeIndex for chan."""
+
+        filename = TimeIndex.filename_for(self.filename(chan))
+        try:
+            index = TimeIndex.load(filename)
+        except IOError:
+            index = TimeIndex(filename, self.index_seconds)
+        except StorageError, e:
+            logging.warning("WRITER: {}. Starting a new index.".format(e))
+            os.remove(filename)
+            index = TimeIndex(filename, self.index_seconds)
+
+        if index.block_seconds != self.index_seconds:
+            logging.warning("WRITER: {} has {} second blocks, not {}. "
+                            "Starting a new index.".format(filename,
+                             index.block_seconds, self.index_seconds))
+            os.remove(filename)
+            index = TimeIndex(filename, self.index_seconds)
+
+        self._indexes[chan] = index
+        return index
+
+    def flush_if_due(self):
+        """Flush if flush_interval seconds have passed since the last flush."""
+
+        with self._lock:
+            if (self._pending_bytes and
+                time.time() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self, fsync=False):
+        """Write all pending data to the OS.
+
+        Kwargs:
+            fsync (bool): if True then also ask the OS to commit every
+                file written since the last fsync (including files which
+                have since been closed) to the physical disk.
+        """
+
+        with self._lock:
+            self._flush(fsync)
+
+    def close(self):
+        """Flush, fsync and close every file.  Called on shutdown."""
+
+        with self._lock:
+            self._flush()
+            for chan in list(self._files.keys()):
+                self._close_file(chan)
+            self._fsync_closed()
+            logging.info("WRITER: closed all channel files. {}"
+                         .format(self.stats))
+
+    def _flush(self, fsync=False):
+        start = time.time()
+        for chan, chunks in self._pending.iteritems():
+            data = ''.join(chunks)
+            fh = self._get_file(chan)
+            fh.write(data)
+            fh.flush()
+            self.stats.bytes_written += len(data)
+
+        # Only index data once it has been handed to the OS
+        for chan, entries in self._pending_index.iteritems():
+            if entries:
+                self._indexes[chan].append(entries)
+        self._pending_index.clear()
+
+        if fsync:
+            for fh in self._files.itervalues():
+                os.fsync(fh.fileno())
+            # Evicted and rotated files too, or a journal checkpoint
+            # could discard samples which are only in the page cache
+            self._fsync_closed()
+
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._last_flush = time.time()
+        self.stats.record_flush(self._last_flush - start)
+
+    def _get_file(self, chan):
+        """Return an open file handle for chan, opening it if necessary."""
+
+        try:
+            fh = self._files.pop(chan)
+        except KeyError:
+            while len(self._files) >= self.max_open_files:
+                lru_chan = next(iter(self._files))
+                self._close_file(lru_chan)
+                self.stats.evictions += 1
+            fh = self.backend.open(self.filename(chan))
+            self.stats.opens += 1
+
+        self._files[chan] = fh # (re-)insert as most recently used
+        return fh
+
+    def _close_file(self, chan):
+        fh = self._files.pop(chan)
+        try:
+            fh.close()
+        except (IOError, OSError), e:
+            logging.warning("WRITER: error closing {}: {}"
+                            .format(self.filename(chan), str(e)))
+        self._unsynced.add(self.filename(chan))
+
+    def _fsync_closed(self):
+        """fsync every file closed since it was last fsync'd.
+
+        Files which have since been removed (e.g. compressed segments,
+        which SegmentCompressor fsyncs itself) are skipped.
+        """
+
+        for filename in self._unsynced:
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._unsynced.clear()
+
+
+class WriterThread(threading.Thread):
+    """Single thread which drains a queue of samples into a ChannelWriterPool.
+
+    Reader threads call put() which never touches the disk.  If the queue
+    is full then put() either blocks until there is space (policy='block')
+    or discards the sample (policy='drop').  Discarded samples are counted
+    and this thread logs how many at most every DROP_REPORT_SECONDS.
+
+    put_many() queues a list of samples as a single item, which counts
+    as one against max_queue_size.
+
+    Attributes:
+
+        pool (ChannelWriterPool)
+
+        rollups (rollup.RollupStage): also fed every sample, or None.
+
+        journal (journal.Journal): every sample is appended to this
+            before it is written to the channel files, or None.
+
+        compressor (SegmentCompressor): started and stopped with this
+            thread, or None.
+
+        policy (str): 'block' or 'drop'.
+
+        high_water_mark (int): largest queue depth seen so far.
+
+        dropped (int): number of samples discarded because the queue was full.
+
+    """
+
+    POLICIES = ('block', 'drop')
+    DROP_REPORT_SECONDS = 10
+    PUT_TIMEOUT = 1 # seconds between checks that this thread is alive
+    BATCH_SIZE = 256 # maximum number of samples to take per batch
+    _STOP = None # sentinel put on the queue to ask the thread to finish
+
+    def __init__(self, pool, max_queue_size=10000, policy='block',
+                 on_error=None, rollups=None, journal=None, compressor=None):
+        """
+        Args:
+            pool (ChannelWriterPool)
+
+        Kwargs:
+            max_queue_size (int): maximum number of queued samples.
+
+            policy (str): 'block' or 'drop'.  What put() does when the
+                queue is full.
+
+            on_error (callable): called with the exception if the writer
+                thread dies.
+
+            rollups (rollup.RollupStage): optional.
+
+            journal (journal.Journal): optional write-ahead journal.
+
+            compressor (SegmentCompressor): optional.
+
+        Raises:
+            ValueError: if policy is not recognised.
+        """
+
+        if policy not in WriterThread.POLICIES:
+            raise ValueError("Unknown queue policy '{}'. Must be one of {}"
+                             .format(policy, WriterThread.POLICIES))
+
+        threading.Thread.__init__(self, name="writer")
+        self.daemon = True
+        self.pool = pool
+        self.rollups = rollups
+        self.journal = journal
+        self.compressor = compressor
+        self.policy = policy
+        self.high_water_mark = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+        self._last_drop_report = time.time()
+        self._queue = Queue.Queue(max(1, max_queue_size))
+        self._on_error = on_error
+
+    def start(self):
+        if self.compressor is not None:
+            self.compressor.start()
+        threading.Thread.start(self)
+
+    def put(self, chan, timecode, watts):
+        """Enqueue a sample for writing.  Called from reader threads."""
+
+        self._enqueue((chan, timecode, watts), 1)
+
+    def put_many(self, samples):
+        """Enqueue a list of (chan, timecode, watts) samples at once (e.g.
+        a batch from a ProcessEngine worker).  The list is not copied."""
+
+        if samples:
+            self._enqueue(samples, len(samples))
+
+    def _enqueue(self, item, n_samples):
+        if self.policy == 'block':
+            while True:
+                try:
+                    self._queue.put(item, timeout=WriterThread.PUT_TIMEOUT)
+                    break
+                except Queue.Full:
+                    # Don't wait forever for a writer which has died
+                    if not self.is_alive():
+                        raise StorageError("WRITER: writer thread has "
+                                           "stopped. Can't queue {}"
+                                           .format(item))
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except Queue.Full:
+                self.dropped += n_samples # logged by the writer thread
+                return
+
+        depth = self._queue.qsize()
+        if depth > self.high_water_mark:
+            self.high_water_mark = depth
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=1)
+                except Queue.Empty:
+                    self._report_drops()
+                    if self.journal is not None:
+                        self.journal.commit_if_due()
+                    self.pool.flush_if_due()
+                    if self.rollups is not None:
+                        self.rollups.flush_if_due()
+                    continue
+
+                # Grab whatever else is waiting, up to BATCH_SIZE samples
+                batch = item if isinstance(item, list) else [item]
+                while len(batch) < WriterThread.BATCH_SIZE:
+                    try:
+                        item = self._queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if isinstance(item, list):
+                        batch.extend(item)
+                    else:
+                        batch.append(item)
+
+                stop = WriterThread._STOP in batch
+                if stop:
+                    batch.remove(WriterThread._STOP)
+
+                if self.journal is not None:
+                    self.journal.append(batch)
+                    self.journal.commit_if_due()
+
+                for item in batch:
+                    self.pool.write_sample(*item)
+                    if self.rollups is not None:
+                        self.rollups.add(*item)
+
+                if self.journal is not None and self.journal.checkpoint_due():
+                    # Everything in the journal is safely in the channel
+                    # files after this so the journal can be emptied
+                    self.pool.flush(fsync=True)
+                    self.journal.checkpoint()
+
+                self._report_drops()
+                if stop:
+                    break
+        except Exception, e:
+            logging.exception("WRITER: writer thread failed")
+            if self._on_error is not None:
+                self._on_error(e)
+            raise
+
+    def _report_drops(self, force=False):
+        """Log the number of samples dropped since the last report."""
+
+        dropped = self.dropped - self._dropped_reported
+        now = time.time()
+        if dropped and (force or now - self._last_drop_report >=
+                                  WriterThread.DROP_REPORT_SECONDS):
+            logging.warning("WRITER: queue full. Dropped {} samples since "
+                            "last report ({} in total)"
+                            .format(dropped, self.dropped))
+            self._dropped_reported += dropped
+            self._last_drop_report = now
+
+    def stop(self):
+        """Write every queued sample, then flush, fsync and close all files.
+
+        Must only be called once the reader threads have stopped.
+        """
+
+        if self.is_alive():
+            self._queue.put(WriterThread._STOP)
+            self.join()
+        self._report_drops(force=True)
+        self.pool.close()
+        if self.journal is not None:
+            self.journal.checkpoint()
+            self.journal.close()
+        if self.rollups is not None:
+            self.rollups.close()
+        if self.compressor is not None:
+            self.compressor.stop()
+
+    @property
+    def queue_depth(self):
+        """Number of samples waiting to be written."""
+        return self._queue.qsize()
+
+    @property
+    def max_queue_size(self):
+        return self._queue.maxsize
+
+    def __str__(self):
+        return ('queue={}/{} high_water={} dropped={} policy={}'
+                .format(self._queue.qsize(), self._queue.maxsize,
+                        self.high_water_mark, self.dropped, self.policy))
+
+
+class SegmentCompressor(threading.Thread):
+    """Gzips closed channel segments in the background.
+
+    Segments are queued by ChannelWriterPool's on_rotate callback.  When
+    the thread starts it also queues any plain segment which isn't the
+    newest for its channel (e.g. one closed just before a crash).  The
+    thread lowers its own priority (on Linux the nice value is per
+    thread) and pauses between chunks so the loggers aren't held up.
+
+    Attributes:
+
+        segments (int): number of segments compressed.
+
+        bytes_in (int): bytes of channel data compressed.
+
+        bytes_out (int): size of the compressed files written.
+
+        errors (int): number of segments which couldn't be compressed.
+
+    """
+
+    NICENESS = 19
+
+    def __init__(self, directory, extension, level=6, pause=0.01):
+        """
+        Args:
+            directory (str): the ChannelWriterPool's directory.
+            extension (str): the backend's EXTENSION.
+
+        Kwargs:
+            level (int): gzip compression level.
+            pause (float): seconds to sleep after compressing each chunk.
+        """
+
+        threading.Thread.__init__(self, name="compressor")
+        self.daemon = True
+        self.directory = directory
+        self.extension = extension
+        self.level = level
+        self.pause = pause
+        self.segments = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        self._queue = Queue.Queue()
+        self._stop_event = threading.Event()
+
+    def put(self, filename):
+        """Queue a closed segment for compression."""
+        self._queue.put(filename)
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def run(self):
+        try:
+            os.nice(SegmentCompressor.NICENESS)
+        except OSError:
+            pass
+
+        for filenames in list_segments(self.directory,
+                                       self.extension).itervalues():
+            for filename in filenames[:-1]:
+                if not filename.endswith(COMPRESSED_EXTENSION):
+                    self.put(filename)
+
+        while not self._stop_event.is_set():
+            filename = self._queue.get()
+            if filename is None:
+                break
+            self.compress(filename)
+
+    def compress(self, filename):
+        if not os.path.exists(filename):
+            return # already compressed
+        start = time.time()
+        try:
+            bytes_in, bytes_out = compress_segment(filename, self.level,
+                                                   pause=self.pause)
+        except (IOError, OSError), e:
+            self.errors += 1
+            logging.warning("COMPRESSOR: failed to compress {}: {}"
+                            .format(filename, e))
+            tmp_filename = filename + COMPRESSED_EXTENSION + '.tmp'
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return
+        self.segments += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        logging.info("COMPRESSOR: compressed {} ({} bytes) in {:.1f}s"
+                     .format(filename, bytes_in, time.time() - start))
+
+    def stop(self):
+        """Stop after the segment currently being compressed.  Anything
+        still queued is compressed when the next compressor starts.
+        """
+
+        self._stop_event.set()
+        self._queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def __str__(self):
+        return ('segments={} bytes_in={} bytes_out={} backlog={} errors={}'
+                .format(self.segments, self.bytes_in, self.bytes_out,
+                        self.backlog, self.errors))
+
+
+#==============================================================================
+# FUNCTIONS
+#==============================================================================
+
+BACKENDS = {TextBackend.NAME: TextBackend, BinaryBackend.NAME: BinaryBackend}
+
+# Rotation period -> strftime format of the segment name (in UTC)
+ROTATIONS = {'none': None, 'day': '%Y-%m-%d', 'month': '%Y-%m'}
+COMPRESSED_EXTENSION = '.gz'
+_CHANNEL_FILENAME = re.compile(r'^channel_([^.]+)'
+                               r'(?:\.(\d{4}-\d{2}(?:-\d{2})?))?'
+                               r'(\.dat|\.bin)(\.gz)?$')
+
+
+def get_backend(name):
+    """Return a new storage backend given its name ('text' or 'binary').
+
+    Raises:
+        StorageError: if name is not a known backend.
+    """
+
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise StorageError("Unknown storage backend '{}'. Must be one of {}"
+                           .format(name, sorted(BACKENDS.keys())))
+
+
+def segment_name(timecode, rotate):
+    """Return the name of the segment containing timecode, e.g. '2013-02-04'."""
+    return time.strftime(ROTATIONS[rotate], time.gmtime(timecode))
+
+
+def segment_bounds(segment):
+    """Return (start, end) unix times covered by a segment name.
+
+    Returns (None, None) for '' (an unrotated channel file).
+    """
+
+    if not segment:
+        return None, None
+    fields = [int(field) for field in segment.split('-')]
+    if len(fields) == 3:
+        start = calendar.timegm((fields[0], fields[1], fields[2], 0, 0, 0))
+        return start, start + 24 * 60 * 60
+    year, month = fields
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (calendar.timegm((year, month, 1, 0, 0, 0)),
+            calendar.timegm((next_year, next_month, 1, 0, 0, 0)))
+
+
+def parse_channel_filename(name):
+    """Split a channel file's basename into its parts.
+
+    Returns:
+        (chan, segment, extension, compressed) or None if name isn't a
+        channel file.  segment is '' for unrotated files.
+    """
+
+    match = _CHANNEL_FILENAME.match(name)
+    if match is None:
+        return None
+    chan, segment, extension, compressed = match.groups()
+    return chan, segment or '', extension, bool(compressed)
+
+
+def list_segments(directory, extension=None):
+    """Find every channel file in directory.
+
+    Kwargs:
+        extension (str): only list files with this data extension
+            (e.g. '.dat'), compressed or not.
+
+    Returns:
+        dict mapping chan (str) to a list of filenames, oldest segment
+        first.  An unrotated channel_N.dat comes before any segment and
+        a compressed segment comes before a plain file of the same
+        segment (which can only hold later samples).
+    """
+
+    segments = collections.defaultdict(list)
+    for name in os.listdir(directory):
+        parts = parse_channel_filename(name)
+        if parts is None or (extension is not None and parts[2] != extension):
+            continue
+        chan, segment, _, compressed = parts
+        segments[chan].append(((segment, not compressed),
+                               os.path.join(directory, name)))
+    return dict((chan, [filename for _, filename in sorted(files)])
+                for chan, files in segments.iteritems())
+
+
+def last_timecode(filename):
+    """Return the timecode of the last sample in any channel file
+    (text or binary, plain or compressed), or None.
+    """
+
+    if not filename.endswith(COMPRESSED_EXTENSION):
+        if filename.endswith(BinaryBackend.EXTENSION):
+            return last_binary_timecode(filename)
+        return last_text_timecode(filename)
+
+    try:
+        data = read_compressed(filename)
+    except (IOError, StorageError):
+        return None
+    if filename.endswith(BinaryBackend.EXTENSION + COMPRESSED_EXTENSION):
+        end = len(data) - (len(data) - BinaryBackend.HEADER.size) % \
+                          BinaryBackend.RECORD.size
+        if end <= BinaryBackend.HEADER.size:
+            return None
+        return BinaryBackend.RECORD.unpack(
+                   data[end - BinaryBackend.RECORD.size:end])[0]
+    lines = data[:data.rfind('\n') + 1].splitlines()
+    try:
+        return int(lines[-1].split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def read_compressed(filename):
+    """Return the decompressed contents of a gzipped segment.
+
+    A compressed segment may hold several gzip members (if a plain file
+    was compressed onto an existing segment); they are concatenated.
+
+    Raises:
+        IOError: if the file can't be read.
+        StorageError: if the file is corrupt.
+    """
+
+    try:
+        with gzip.open(filename, 'rb') as fh:
+            return fh.read()
+    except (EOFError, IOError, zlib.error), e:
+        if isinstance(e, IOError) and not os.path.exists(filename):
+            raise
+        raise StorageError("{} is not a valid compressed segment: {}"
+                           .format(filename, e))
+
+
+def compress_segment(filename, level=6, chunk_size=1 << 16, pause=0.0):
+    """Gzip a closed segment to filename + '.gz' and delete the original
+    (and its index).
+
+    If the compressed file already exists then the segment is added to
+    it.  The new compressed file is written to a temporary file, fsync'd
+    and then renamed over the old one, so a crash never loses data.
+
+    Kwargs:
+        level (int): gzip compression level.
+        chunk_size (int): bytes compressed at a time.
+        pause (float): seconds to sleep between chunks, to limit the
+            I/O load on the disk being logged to.
+
+    Returns:
+        (bytes compressed, size of the compressed file)
+    """
+
+    gz_filename = filename + COMPRESSED_EXTENSION
+    tmp_filename = gz_filename + '.tmp'
+    bytes_in = 0
+    with open(tmp_filename, 'wb') as out_fh:
+        if os.path.exists(gz_filename):
+            with open(gz_filename, 'rb') as old_fh:
+                while True:
+                    chunk = old_fh.read(chunk_size)
+                    if not chunk:
+                        break
+                    out_fh.write(chunk)
+        with open(filename, 'rb') as in_fh:
+            gz = gzip.GzipFile(filename=os.path.basename(filename), mode='wb',
+                               compresslevel=level, fileobj=out_fh)
+            while True:
+                chunk = in_fh.read(chunk_size)
+                if not chunk:
+                    break
+                gz.write(chunk)
+                bytes_in += len(chunk)
+                if pause:
+                    time.sleep(pause)
+            gz.close()
+        out_fh.flush()
+        os.fsync(out_fh.fileno())
+        bytes_out = out_fh.tell()
+
+    os.rename(tmp_filename, gz_filename)
+    os.remove(filename)
+    index_filename = TimeIndex.filename_for(filename)
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    return bytes_in, bytes_out
+
+
+def check_binary_header(header, filename):
+    """Raise StorageError if header isn't a BinaryBackend header."""
+
+    if len(header) < BinaryBackend.HEADER.size:
+        raise StorageError("{} is too short to be a binary channel file"
+                           .format(filename))
+    magic, version, record_size = BinaryBackend.HEADER.unpack(
+                                         header[:BinaryBackend.HEADER.size])
+    if (magic != BinaryBackend.MAGIC or version != BinaryBackend.VERSION or
+        record_size != BinaryBackend.RECORD.size):
+        raise StorageError("{} has an unrecognised header: magic={!r} "
+                           "version={} record_size={}"
+                           .format(filename, magic, version, record_size))
+
+
+def load_binary(filename, mode='r'):
+    """Memory-map a binary channel file as a NumPy structured array.
+
+    Nothing is read from disk until the array is used so this is cheap
+    even for very large files.
+
+    Args:
+        filename (str): a channel_N.bin file written by BinaryBackend.
+
+    Kwargs:
+        mode (str): numpy.memmap mode. Default 'r' (read only).
+
+    Returns:
+        numpy.memmap with fields 'timecode' (uint32) and 'watts' (int32).
+
+    Raises:
+        StorageError: if filename has an unrecognised header.
+    """
+
+    import numpy as np # only needed by analysis code, not by the logger
+
+    with open(filename, 'rb') as fh:
+        check_binary_header(fh.read(BinaryBackend.HEADER.size), filename)
+    size = os.path.getsize(filename)
+    n_records = (size - BinaryBackend.HEADER.size) // BinaryBackend.RECORD.size
+    dtype = np.dtype(BinaryBackend.DTYPE)
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode=mode,
+                     offset=BinaryBackend.HEADER.size, shape=(n_records,))
+
+
+def last_text_timecode(filename):
+    """Return the timecode of the last line of a text channel file.
+
+    Returns None if the file doesn't exist, is empty or the last
+    line can't be parsed.
+    """
+
+    try:
+        with open(filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            fh.seek(max(0, size - 256))
+            tail = fh.read()
+    except IOError:
+        return None
+
+    lines = tail.splitlines()
+    if not lines:
+        return None
+    try:
+        return int(lines[-1].split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def last_binary_timecode(filename):
+    """Return the timecode of the last record of a binary channel file.
+
+    Returns None if the file doesn't exist or has no complete records.
+    """
+
+    try:
+        with open(filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            n_records = ((size - BinaryBackend.HEADER.size) //
+                         BinaryBackend.RECORD.size)
+            if n_records <= 0:
+                return None
+            fh.seek(BinaryBackend.HEADER.size +
+                    (n_records - 1) * BinaryBackend.RECORD.size)
+            record = fh.read(BinaryBackend.RECORD.size)
+    except IOError:
+        return None
+    return BinaryBackend.RECORD.unpack(record)[0]
+
+
+def truncate_partial_line(filename, chunk_size=4096):
+    """Remove anything after the last newline in filename.
+
+    Returns:
+        number of bytes removed (0 if the file is missing or complete).
+    """
+
+    try:
+        fh = open(filename, 'r+b')
+    except IOError:
+        return 0
+
+    with fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return 0
+        fh.seek(size - 1)
+        if fh.read(1) == '\n':
+            return 0
+
+        # Search backwards for the last newline
+        end = size
+        keep = 0
+        while end > 0:
+            start = max(0, end - chunk_size)
+            fh.seek(start)
+            newline = fh.read(end - start).rfind('\n')
+            if newline != -1:
+                keep = start + newline + 1
+                break
+            end = start
+        fh.truncate(keep)
+        return size - keep
+
+
+def rebuild_index(data_filename, block_seconds=3600):
+    """(Re)create the TimeIndex sidecar for a text channel file.
+
+    Must not be run on a file which iam_logger is currently writing to.
+
+    Returns:
+        TimeIndex
+    """
+
+    index_filename = TimeIndex.filename_for(data_filename)
+    tmp_filename = index_filename + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+
+    entries = []
+    offset = 0
+    last_block = None
+    with open(data_filename, 'rb') as fh:
+        for line in fh:
+            if not line.endswith('\n'): # incomplete last line
+                break
+            try:
+                timecode = int(line.split(None, 1)[0])
+            except (ValueError, IndexError):
+                logging.warning("INDEX: ignoring bad line at byte {} of {}"
+                                .format(offset, data_filename))
+            else:
+                block_start = timecode - (timecode % block_seconds)
+                if last_block is None or block_start > last_block:
+                    entries.append((block_start, offset))
+                    last_block = block_start
+            offset += len(line)
+
+    index = TimeIndex(tmp_filename, block_seconds)
+    index.append(entries)
+    os.rename(tmp_filename, index_filename)
+    index.filename = index_filename
+    return index
+
+
+def rebuild_indexes(directory, block_seconds=3600):
+    """Rebuild the TimeIndex for every text channel file in directory."""
+
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('channel_') and name.endswith(TextBackend.EXTENSION):
+            filename = os.path.join(directory, name)
+            index = rebuild_index(filename, block_seconds)
+            print("Indexed {} ({} blocks)".format(filename,
+                                                  len(index.timecodes)))
@@ -0,0 +1,193 @@
+#! /usr/bin/python
+"""Stress test for the locking around CurrentCost.sensors.
+
+Simulates many base units which all hear the same IAMs: every thread
+feeds a message for every sensor at every (simulated) second, and the
+threads move from one second to the next in lock-step so they all
+contend for the same sensors at the same time.  Each sensor must end up
+with exactly one sample per second on disk; anything else means samples
+were lost or duplicated.
+
+Usage:
+    ./stress_registry.py [--threads N] [--sensors N] [--seconds N]
+                         [--unlocked]
+
+--unlocked replaces the registry's locks with no-ops, to check that the
+test can actually detect races.  To make a race (nearly) certain rather
+than just likely, it also makes each Sensor.update() yield to other
+threads part way through.  An exception in any thread is a FAIL.
+
+"""
+
+from __future__ import print_function, division
+import argparse
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import storage
+import channel_reader
+import iam_logger
+
+START = 1360000000
+
+
+class BarrierAborted(Exception):
+    pass
+
+
+class Barrier(object):
+    """Block until n threads have called wait()."""
+
+    def __init__(self, n):
+        self.n = n
+        self._count = 0
+        self._generation = 0
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def wait(self):
+        """Raises BarrierAborted if abort() has been called."""
+
+        with self._cond:
+            if self._aborted:
+                raise BarrierAborted()
+            generation = self._generation
+            self._count += 1
+            if self._count == self.n:
+                self._count = 0
+                self._generation += 1
+                self._cond.notify_all()
+            else:
+                while generation == self._generation and not self._aborted:
+                    self._cond.wait()
+                if self._aborted:
+                    raise BarrierAborted()
+
+    def abort(self):
+        """Release every waiting thread (and any which arrive later)."""
+
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+
+class DummyLock(object):
+    def release(self):
+        pass
+
+
+def feeder(index, radio_ids, seconds, barrier, now, errors):
+    try:
+        current_cost = iam_logger.ReplayCurrentCost('stress_{}'.format(index))
+        order = list(radio_ids)
+        for second in xrange(seconds):
+            now.value = START + second
+            random.shuffle(order)
+            for radio_id in order:
+                current_cost.process({'id': str(radio_id),
+                                      'sensor': str(radio_id % 10),
+                                      'ch1/watts': str(second),
+                                      'ch2/watts': None, 'ch3/watts': None})
+            barrier.wait()
+    except BarrierAborted:
+        pass # another thread failed
+    except Exception, e:
+        errors.append('{}: {!r}'.format(threading.current_thread().name, e))
+        barrier.abort()
+
+
+def yielding(method):
+    """Wrap method so that it lets other threads run before starting."""
+
+    def wrapper(*args, **kwargs):
+        time.sleep(0)
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def check(directory, radio_ids, seconds):
+    """Return (lost, duplicated) sample counts across every sensor."""
+
+    expected = set(xrange(START, START + seconds))
+    lost = duplicated = 0
+    for radio_id in radio_ids:
+        timecodes, watts = channel_reader.read_channel(directory, radio_id)
+        timecodes = list(timecodes)
+        duplicated += len(timecodes) - len(set(timecodes))
+        lost += len(expected - set(timecodes))
+    return lost, duplicated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test the sensor '
+                                     'registry locking.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of simulated base units (default: 8)')
+    parser.add_argument('--sensors', type=int, default=50,
+                        help='number of IAMs heard by every unit (default: 50)')
+    parser.add_argument('--seconds', type=int, default=500,
+                        help='number of simulated seconds (default: 500)')
+    parser.add_argument('--unlocked', action='store_true',
+                        help='disable the registry locks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    sys.setcheckinterval(1) # switch threads as often as possible
+
+    directory = tempfile.mkdtemp(prefix='stress_registry_') + '/'
+    iam_logger._writer_pool = storage.ChannelWriterPool(directory)
+    iam_logger._writer = storage.WriterThread(iam_logger._writer_pool)
+    iam_logger._writer.start()
+
+    registry = iam_logger.CurrentCost.sensors
+    if args.unlocked:
+        registry.acquire = lambda key: DummyLock()
+        # Widen the window between Sensor.update()'s checks and writes
+        iam_logger.TimeInfo.update = yielding(iam_logger.TimeInfo.update)
+        iam_logger.Sensor.write_to_disk = yielding(
+                                              iam_logger.Sensor.write_to_disk)
+
+    # Each feeder thread sets its own idea of "now"
+    now = threading.local()
+    iam_logger._clock = lambda: now.value
+
+    radio_ids = range(1000, 1000 + args.sensors)
+    barrier = Barrier(args.threads)
+    errors = []
+    threads = [threading.Thread(target=feeder,
+                                args=(i, radio_ids, args.seconds, barrier, now,
+                                      errors))
+               for i in range(args.threads)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    iam_logger._writer.stop()
+
+    lost, duplicated = check(directory, radio_ids, args.seconds)
+    shutil.rmtree(directory)
+
+    n_messages = args.threads * args.sensors * args.seconds
+    print("{} threads x {} sensors x {} seconds = {} messages in {:.1f}s"
+          .format(args.threads, args.sensors, args.seconds, n_messages,
+                  elapsed))
+    print("REGISTRY:", registry, "created={}".format(registry.creations))
+    print("WRITER:", iam_logger._writer)
+    print("lost={} duplicated={}".format(lost, duplicated))
+    for error in errors:
+        print("ERROR:", error)
+    if errors or lost or duplicated or registry.creations != args.sensors:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()